@@ -0,0 +1,106 @@
+from pathlib import Path
+
+import pytest
+
+from benchmarks.harness import (
+    DEFAULT_MAX_TIME,
+    DEFAULT_MIN_ROUNDS,
+    DEFAULT_THRESHOLD,
+    Benchmark,
+    BenchmarkSettings,
+    BenchmarkStats,
+    format_summary,
+    load_baseline,
+    machine_info,
+    regression,
+    write_results,
+)
+
+RESULTS = pytest.StashKey[dict[str, BenchmarkStats]]()
+BASELINE = pytest.StashKey[dict | None]()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("bench", "pyserver microbenchmarks")
+    group.addoption(
+        "--bench-json",
+        type=Path,
+        help="write the results to this JSON file, e.g. to keep as a baseline",
+    )
+    group.addoption(
+        "--bench-compare",
+        type=Path,
+        help="fail benchmarks that regressed against this results file",
+    )
+    group.addoption(
+        "--bench-threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="slowdown of the median, as a fraction, that counts as a "
+        f"regression (default {DEFAULT_THRESHOLD})",
+    )
+    group.addoption("--bench-min-rounds", type=int, default=DEFAULT_MIN_ROUNDS)
+    group.addoption(
+        "--bench-max-time",
+        type=float,
+        default=DEFAULT_MAX_TIME,
+        help="seconds spent on each benchmark once its minimum rounds ran "
+        f"(default {DEFAULT_MAX_TIME})",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("--bench-threshold", 0) < 0:
+        raise pytest.UsageError("--bench-threshold cannot be negative")
+    config.stash[RESULTS] = {}
+    compare = config.getoption("--bench-compare", None)
+    config.stash[BASELINE] = load_baseline(compare) if compare else None
+
+
+@pytest.fixture
+def benchmark(request):
+    config = request.config
+    baseline = config.stash[BASELINE]
+    threshold = config.getoption("--bench-threshold")
+
+    def record(name: str, stats: BenchmarkStats) -> None:
+        config.stash[RESULTS][name] = stats
+        regressed = baseline and regression(name, stats, baseline, threshold)
+        if regressed:
+            pytest.fail(
+                f"{name} regressed {regressed.change:+.1%}: median "
+                f"{regressed.current * 1000:.3f}ms against "
+                f"{regressed.baseline * 1000:.3f}ms in the baseline",
+                pytrace=False,
+            )
+
+    return Benchmark(
+        request.node.name,
+        BenchmarkSettings(
+            min_rounds=config.getoption("--bench-min-rounds"),
+            max_time=config.getoption("--bench-max-time"),
+        ),
+        on_result=record,
+    )
+
+
+def pytest_sessionfinish(session):
+    path = session.config.getoption("--bench-json", None)
+    results = session.config.stash.get(RESULTS, {})
+    if path and results:
+        write_results(path, results)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = config.stash.get(RESULTS, {})
+    if not results:
+        return
+    baseline = config.stash.get(BASELINE, None)
+    terminalreporter.section("benchmarks")
+    for line in format_summary(results, baseline):
+        terminalreporter.write_line(line)
+    if baseline is not None and baseline.get("machine") != machine_info():
+        terminalreporter.write_line(
+            "note: the baseline was recorded on a different machine or "
+            "environment; compare with care"
+        )
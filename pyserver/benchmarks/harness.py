@@ -0,0 +1,215 @@
+"""Timing, JSON results and baseline comparison for the microbenchmarks.
+
+Shaped like pytest-benchmark, so the suite needs nothing beyond pytest and
+runs offline: a test calls the `benchmark` fixture with the function to time
+and its arguments, and gets the function's result back.
+
+    def test_parse(benchmark):
+        env = benchmark(parse, text)
+
+Functions that mutate their input take `benchmark.pedantic(function, setup)`,
+where `setup()` returns a fresh `(args, kwargs)` before every untimed call.
+
+A call is timed in rounds: a warm-up call calibrates how many iterations
+make a round last at least `MIN_ROUND_SECONDS`, then rounds run until there
+are `min_rounds` of them and `max_time` has passed. Results are seconds per
+call. Baselines are compared on the median, which is the statistic least
+moved by a stray GC pause or a noisy neighbour.
+"""
+
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+RESULTS_VERSION = 1
+MIN_ROUND_SECONDS = 0.001
+DEFAULT_MIN_ROUNDS = 5
+DEFAULT_MAX_TIME = 1.0
+DEFAULT_THRESHOLD = 0.2
+
+
+@dataclass
+class BenchmarkSettings:
+    min_rounds: int = DEFAULT_MIN_ROUNDS
+    # seconds of rounds per benchmark, once min_rounds have run
+    max_time: float = DEFAULT_MAX_TIME
+
+
+@dataclass
+class BenchmarkStats:
+    rounds: int
+    iterations: int
+    min: float
+    max: float
+    mean: float
+    median: float
+    stddev: float
+
+    @classmethod
+    def from_times(cls, times: list[float], iterations: int) -> "BenchmarkStats":
+        return cls(
+            rounds=len(times),
+            iterations=iterations,
+            min=min(times),
+            max=max(times),
+            mean=statistics.fmean(times),
+            median=statistics.median(times),
+            stddev=statistics.stdev(times) if len(times) > 1 else 0.0,
+        )
+
+
+@dataclass
+class Regression:
+    name: str
+    baseline: float
+    current: float
+
+    @property
+    def change(self) -> float:
+        return self.current / self.baseline - 1
+
+
+class Benchmark:
+    """The `benchmark` fixture: times one function per test."""
+
+    def __init__(
+        self,
+        name: str,
+        settings: BenchmarkSettings,
+        on_result: Callable[[str, BenchmarkStats], None] | None = None,
+    ):
+        self.name = name
+        self.settings = settings
+        # called inside the test, so a regression it raises fails the test
+        self.on_result = on_result
+        self.stats: BenchmarkStats | None = None
+
+    def __call__(self, function: Callable[..., Any], *args: Any, **kwargs: Any):
+        gc.collect()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        warm_up = time.perf_counter() - start
+        iterations = max(1, int(MIN_ROUND_SECONDS / max(warm_up, 1e-9)))
+
+        def timed_round() -> float:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                function(*args, **kwargs)
+            return (time.perf_counter() - start) / iterations
+
+        self._run(timed_round, iterations)
+        return result
+
+    def pedantic(
+        self,
+        function: Callable[..., Any],
+        setup: Callable[[], tuple[tuple, dict[str, Any]]],
+    ):
+        """Time `function(*args, **kwargs)` once per round, with a fresh
+        `(args, kwargs) = setup()` outside the timing each time."""
+        gc.collect()
+        args, kwargs = setup()
+        result = function(*args, **kwargs)
+
+        def timed_round() -> float:
+            args, kwargs = setup()
+            start = time.perf_counter()
+            function(*args, **kwargs)
+            return time.perf_counter() - start
+
+        self._run(timed_round, 1)
+        return result
+
+    def _run(self, timed_round: Callable[[], float], iterations: int) -> None:
+        if self.stats is not None:
+            raise RuntimeError(f"{self.name} already ran its benchmark")
+        times: list[float] = []
+        deadline = time.perf_counter() + self.settings.max_time
+        while len(times) < self.settings.min_rounds or time.perf_counter() < deadline:
+            times.append(timed_round())
+        self.stats = BenchmarkStats.from_times(times, iterations)
+        if self.on_result is not None:
+            self.on_result(self.name, self.stats)
+
+
+def machine_info() -> dict[str, str]:
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "pytrilogy": metadata.version("pytrilogy"),
+    }
+
+
+def results_document(results: dict[str, BenchmarkStats]) -> dict[str, Any]:
+    return {
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": machine_info(),
+        "benchmarks": {name: asdict(stats) for name, stats in sorted(results.items())},
+    }
+
+
+def write_results(path: Path, results: dict[str, BenchmarkStats]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results_document(results), indent=2) + "\n")
+
+
+def load_baseline(path: Path) -> dict[str, Any]:
+    baseline = json.loads(path.read_text())
+    if baseline.get("version") != RESULTS_VERSION:
+        raise ValueError(
+            f"{path} holds version {baseline.get('version')} results; "
+            f"expected version {RESULTS_VERSION}"
+        )
+    return baseline
+
+
+def regression(
+    name: str, stats: BenchmarkStats, baseline: dict[str, Any], threshold: float
+) -> Regression | None:
+    """`name` as a regression if its median is more than `threshold` (a
+    fraction) slower than the baseline's; benchmarks new since the baseline
+    never are."""
+    previous = baseline["benchmarks"].get(name)
+    if previous is None:
+        return None
+    if stats.median > previous["median"] * (1 + threshold):
+        return Regression(name, previous["median"], stats.median)
+    return None
+
+
+def format_summary(
+    results: dict[str, BenchmarkStats], baseline: dict[str, Any] | None
+) -> list[str]:
+    """One line per benchmark: median and spread in ms, and the change from
+    the baseline when there is one."""
+    width = max(len(name) for name in results)
+    lines = [
+        f"{'benchmark':<{width}} {'median ms':>10} {'min ms':>10} "
+        f"{'stddev ms':>10} {'rounds':>7}"
+        + (f" {'vs baseline':>12}" if baseline else "")
+    ]
+    for name, stats in sorted(results.items()):
+        line = (
+            f"{name:<{width}} {stats.median * 1000:>10.3f} {stats.min * 1000:>10.3f} "
+            f"{stats.stddev * 1000:>10.3f} {stats.rounds:>7}"
+        )
+        if baseline is not None:
+            previous = baseline["benchmarks"].get(name)
+            change = (
+                f"{stats.median / previous['median'] - 1:+.1%}" if previous else "new"
+            )
+            line += f" {change:>12}"
+        lines.append(line)
+    return lines
@@ -0,0 +1,172 @@
+"""Microbenchmarks for the pyserver hot paths, over synthetic models of three
+sizes.
+
+Each model is a chain of `depth` files, each one importing the previous as
+`parent`, with `width` measures, attributes and aggregates per file, so
+both the import graph and the concept count grow with the size.
+"""
+
+from dataclasses import dataclass
+
+import pytest
+from trilogy import Dialects, Environment
+from trilogy.parser import parse_text
+
+from common import flatten_lineage
+from diagnostics import StatementCache, get_diagnostics
+from env_helpers import (
+    fork_environment,
+    model_to_response,
+    normalize_relative_imports,
+    parse_env_from_full_model,
+)
+from io_models import ModelInSchema, ModelSourceInSchema
+from query_helpers import (
+    PARSE_CONFIG,
+    filters_to_conditional,
+    generate_single_query,
+    query_to_output,
+)
+
+# name -> (files, concepts of each kind per file)
+MODEL_SIZES = {"small": (1, 5), "medium": (4, 20), "large": (8, 50)}
+EXTRA_FILTERS = ["entity.value_0 > :minimum", "entity.label_0 = :label"]
+PARAMETERS: dict[str, str | int | float] = {":minimum": 3, ":label": "x"}
+DIALECT = Dialects.DUCK_DB.default_renderer()
+
+
+def model_source(index: int, width: int) -> str:
+    lines = [f"import entity_{index - 1} as parent;\n"] if index else []
+    lines.append(f"key id int; # entity {index} identifier")
+    for column in range(width):
+        lines.append(f"property id.value_{column} int; # measure {column}")
+        lines.append(f"property id.label_{column} string; # attribute {column}")
+    lines.extend(
+        f"auto total_{column} <- sum(value_{column});" for column in range(width)
+    )
+    columns = ["id:id"]
+    columns.extend(f"value_{column}:value_{column}" for column in range(width))
+    columns.extend(f"label_{column}:label_{column}" for column in range(width))
+    if index:
+        columns.append("parent_id:parent.id")
+    mapped = ",\n    ".join(columns)
+    lines.append(
+        f"\ndatasource entity_{index}(\n    {mapped}\n)\n"
+        f"grain(id)\naddress entity_{index};\n"
+    )
+    return "\n".join(lines)
+
+
+@dataclass
+class SyntheticModel:
+    sources: list[ModelSourceInSchema]
+    # a query reaching from the last file back to the first
+    query: str
+    imports: str
+    environment: Environment
+
+
+@pytest.fixture(scope="module", params=list(MODEL_SIZES))
+def model(request) -> SyntheticModel:
+    depth, width = MODEL_SIZES[request.param]
+    sources = [
+        ModelSourceInSchema(
+            alias=f"entity_{index}", contents=model_source(index, width)
+        )
+        for index in range(depth)
+    ]
+    imports = f"import entity_{depth - 1} as entity;"
+    environment, _ = parse_text(
+        imports, parse_env_from_full_model(sources), parse_config=PARSE_CONFIG
+    )
+    ancestor = "parent." * (depth - 1)
+    query = (
+        f"{imports}\nselect\n    entity.id,\n    entity.label_0,\n"
+        f"    entity.{ancestor}label_1,\n    sum(entity.value_0) as total\n"
+        "order by total desc;"
+    )
+    return SyntheticModel(sources, query, imports, environment)
+
+
+def test_parse_env_from_full_model(benchmark, model):
+    # the function only builds the import resolver; the imports it enables
+    # are where the cost is, so they are parsed too
+    def parse_model() -> Environment:
+        environment, _ = parse_text(
+            model.imports,
+            parse_env_from_full_model(model.sources),
+            parse_config=PARSE_CONFIG,
+        )
+        return environment
+
+    environment = benchmark(parse_model)
+    assert len(environment.concepts) == len(model.environment.concepts)
+
+
+def test_normalize_relative_imports(benchmark, model):
+    text = "\n".join([model.query, *(source.contents for source in model.sources)])
+    normalized = benchmark(normalize_relative_imports, text, "models/nested/current")
+    assert normalized.startswith("import models.nested.entity_")
+
+
+def test_model_to_response(benchmark, model):
+    response = benchmark(
+        model_to_response, ModelInSchema(name="synthetic", sources=model.sources)
+    )
+    assert len(response.sources) == len(model.sources)
+
+
+def test_get_diagnostics(benchmark, model):
+    # a new cache every round, so each one pays for parsing and analysis
+    response = benchmark.pedantic(
+        get_diagnostics,
+        setup=lambda: (
+            (model.query, model.sources),
+            {"statement_cache": StatementCache()},
+        ),
+    )
+    assert response.items == []
+    assert response.completion_items
+
+
+def test_generate_single_query(benchmark, model):
+    # parsing the query adds to the environment, so each round gets a fork
+    target, columns, *_ = benchmark.pedantic(
+        generate_single_query,
+        setup=lambda: (
+            (model.query, fork_environment(model.environment), DIALECT),
+            {"extra_filters": EXTRA_FILTERS, "parameters": PARAMETERS},
+        ),
+    )
+    assert target is not None
+    assert len(columns) == 4
+
+
+def test_filters_to_conditional(benchmark, model):
+    conditional = benchmark.pedantic(
+        filters_to_conditional,
+        setup=lambda: (
+            (EXTRA_FILTERS, PARAMETERS, fork_environment(model.environment)),
+            {},
+        ),
+    )
+    assert conditional is not None
+
+
+def test_flatten_lineage(benchmark, model):
+    concepts = list(model.environment.concepts.values())
+
+    def flatten_all() -> int:
+        return sum(len(flatten_lineage(concept)) for concept in concepts)
+
+    assert benchmark(flatten_all) > 0
+
+
+def test_query_to_output(benchmark, model):
+    target, columns, results, select_count, _ = generate_single_query(
+        model.query, fork_environment(model.environment), DIALECT
+    )
+    output = benchmark(
+        query_to_output, target, columns, results, None, DIALECT, select_count
+    )
+    assert output.generated_sql
@@ -0,0 +1,227 @@
+"""Content-addressed store of model source texts.
+
+A request can send a model source as `{alias, sha256}` in place of its
+contents. The router fills in contents the server already has and answers
+409 with the hashes it does not. The client then uploads only those, either
+with `POST /blobs` or by repeating the request with their contents inline.
+Upload size and JSON decode cost then follow what changed, not model size.
+
+Blobs live in a byte-bounded in-memory LRU. With a spill directory set,
+every blob is also written there. Server processes sharing the directory
+then see each other's uploads, and evicted blobs can be read back.
+
+Settings come from the environment:
+
+- `TRILOGY_BLOB_STORE_BYTES`: in-memory budget (default 64 MiB)
+- `TRILOGY_BLOB_SPILL_DIR`: optional directory for the on-disk copy
+- `TRILOGY_BLOB_SPILL_BYTES`: on-disk budget (default 512 MiB); the oldest
+  files are pruned beyond it
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from io_models import ModelSourceInSchema
+
+DEFAULT_BLOB_STORE_BYTES = 64 * 1024 * 1024
+DEFAULT_BLOB_SPILL_BYTES = 512 * 1024 * 1024
+# prune the spill directory after this many writes
+SPILL_SWEEP_INTERVAL = 64
+
+
+def blob_digest(contents: str) -> str:
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+
+def _is_digest(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class MissingBlobs(LookupError):
+    """Source hashes the store does not have, in request order."""
+
+    def __init__(self, hashes: list[str]):
+        super().__init__(f"Unknown source hashes: {', '.join(hashes)}")
+        self.hashes = hashes
+
+
+class BlobMismatch(ValueError):
+    pass
+
+
+@dataclass
+class BlobStoreStats:
+    hits: int = 0
+    spill_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+    max_bytes: int = 0
+
+
+class BlobStore:
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_BLOB_STORE_BYTES,
+        spill_dir: Path | None = None,
+        max_spill_bytes: int = DEFAULT_BLOB_SPILL_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        # digest -> (contents, accounted bytes)
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._size_bytes = 0
+        self._spill_writes = 0
+        self._hits = 0
+        self._spill_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "BlobStore":
+        spill_dir = os.environ.get("TRILOGY_BLOB_SPILL_DIR")
+        return cls(
+            max_bytes=int(
+                os.environ.get("TRILOGY_BLOB_STORE_BYTES", DEFAULT_BLOB_STORE_BYTES)
+            ),
+            spill_dir=Path(spill_dir) if spill_dir else None,
+            max_spill_bytes=int(
+                os.environ.get("TRILOGY_BLOB_SPILL_BYTES", DEFAULT_BLOB_SPILL_BYTES)
+            ),
+        )
+
+    def put(self, contents: str, digest: str | None = None) -> str:
+        digest = digest or blob_digest(contents)
+        self._remember(digest, contents)
+        if self.spill_dir is not None:
+            self._spill(digest, contents)
+        return digest
+
+    def get(self, digest: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+                self._hits += 1
+                return entry[0]
+        contents = self._read_spill(digest)
+        with self._lock:
+            if contents is None:
+                self._misses += 1
+                return None
+            self._spill_hits += 1
+        self._remember(digest, contents)
+        return contents
+
+    def resolve(self, sources: list[ModelSourceInSchema]) -> list[ModelSourceInSchema]:
+        """`sources` with every hash-only entry's contents filled in.
+
+        Inline contents that carry a hash are checked and stored, so a
+        client can answer a 409 by resending the request with them.
+        Raises MissingBlobs for hashes the store does not have, and
+        BlobMismatch when inline contents do not match their hash.
+        """
+        resolved: list[ModelSourceInSchema] = []
+        missing: list[str] = []
+        for source in sources:
+            if source.sha256 is None:
+                resolved.append(source)
+            elif source.contents is not None:
+                if blob_digest(source.contents) != source.sha256:
+                    raise BlobMismatch(
+                        f"Contents of source {source.alias!r} do not match its sha256"
+                    )
+                self.put(source.contents, source.sha256)
+                resolved.append(source)
+            else:
+                contents = self.get(source.sha256)
+                if contents is None:
+                    missing.append(source.sha256)
+                else:
+                    resolved.append(source.model_copy(update={"contents": contents}))
+        if missing:
+            raise MissingBlobs(missing)
+        return resolved
+
+    def stats(self) -> BlobStoreStats:
+        with self._lock:
+            return BlobStoreStats(
+                hits=self._hits,
+                spill_hits=self._spill_hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                entries=len(self._entries),
+                size_bytes=self._size_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def _remember(self, digest: str, contents: str) -> None:
+        cost = len(contents.encode("utf-8"))
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return
+            self._entries[digest] = (contents, cost)
+            self._size_bytes += cost
+            while self._size_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size_bytes -= evicted
+                self._evictions += 1
+
+    def _spill_path(self, digest: str) -> Path | None:
+        if self.spill_dir is None or not _is_digest(digest):
+            return None
+        return self.spill_dir / digest
+
+    def _spill(self, digest: str, contents: str) -> None:
+        path = self._spill_path(digest)
+        if path is None or path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write-then-rename, so readers never see a partial blob
+        tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(contents.encode("utf-8"))
+        os.replace(tmp, path)
+        with self._lock:
+            self._spill_writes += 1
+            sweep = self._spill_writes % SPILL_SWEEP_INTERVAL == 0
+        if sweep:
+            self._sweep_spill()
+
+    def _read_spill(self, digest: str) -> str | None:
+        path = self._spill_path(digest)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes().decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def _sweep_spill(self) -> None:
+        """Remove the oldest spilled blobs beyond the on-disk budget."""
+        assert self.spill_dir is not None
+        files: list[tuple[float, int, Path]] = []
+        for path in self.spill_dir.iterdir():
+            if not _is_digest(path.name):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_spill_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
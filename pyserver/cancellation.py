@@ -0,0 +1,103 @@
+"""Cooperative cancellation for pooled tasks.
+
+A parse cannot be interrupted safely halfway through, so cancellation is
+cooperative. The caller hands `TaskPool.run` a `CancelToken` and cancels it
+when the result is no longer wanted. The task calls `check_cancelled()`
+between its phases and raises `TaskCancelled` at the first one after that.
+
+A token reaches worker processes by pickling, so the cancel itself has to
+travel some other way. `TaskPool` gives every worker a table of shared-memory
+flags and binds each process task's token to one slot of that table for the
+duration of the task.
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Set in worker processes by `install_shared_flags`; None in the server process
+_SHARED_FLAGS = None
+
+_current_token: ContextVar["CancelToken | None"] = ContextVar(
+    "trilogy_cancel_token", default=None
+)
+
+
+class TaskCancelled(BaseException):
+    """Raised at a phase boundary once the running task's token is cancelled.
+
+    A BaseException, like asyncio.CancelledError, so the broad `except
+    Exception` handlers that turn task failures into 422 payloads let it
+    through.
+    """
+
+    # seconds the task ran before it stopped; set by the pool
+    run_time = 0.0
+
+
+class CancelToken:
+    def __init__(self) -> None:
+        self._cancelled = False
+        # shared-memory flag table and this token's slot in it, while a
+        # worker process runs the task
+        self._flags = None
+        self.slot: int | None = None
+
+    def cancel(self) -> None:
+        self._cancelled = True
+        if self._flags is not None and self.slot is not None:
+            self._flags[self.slot] = 1
+
+    @property
+    def cancelled(self) -> bool:
+        if self._cancelled:
+            return True
+        return (
+            self._flags is not None
+            and self.slot is not None
+            and bool(self._flags[self.slot])
+        )
+
+    def bind(self, flags, slot: int) -> None:
+        """Mirror this token into `flags[slot]` until `unbind`."""
+        self._flags = flags
+        self.slot = slot
+        flags[slot] = 1 if self._cancelled else 0
+
+    def unbind(self) -> None:
+        if self._flags is not None and self.slot is not None:
+            self._cancelled = self.cancelled
+            self._flags[self.slot] = 0
+        self._flags = None
+        self.slot = None
+
+    def __getstate__(self) -> dict:
+        return {"cancelled": self.cancelled, "slot": self.slot}
+
+    def __setstate__(self, state: dict) -> None:
+        self._cancelled = state["cancelled"]
+        self.slot = state["slot"]
+        self._flags = _SHARED_FLAGS if self.slot is not None else None
+
+
+def install_shared_flags(flags) -> None:
+    """Called once in each worker process with the pool's flag table."""
+    global _SHARED_FLAGS
+    _SHARED_FLAGS = flags
+
+
+@contextmanager
+def cancellation_scope(token: CancelToken | None) -> Iterator[None]:
+    """Make `token` the one `check_cancelled` consults inside the block."""
+    reset = _current_token.set(token)
+    try:
+        yield
+    finally:
+        _current_token.reset(reset)
+
+
+def check_cancelled() -> None:
+    """Raise TaskCancelled if the current task's token has been cancelled."""
+    token = _current_token.get()
+    if token is not None and token.cancelled:
+        raise TaskCancelled()
@@ -71,9 +71,8 @@ def flatten_lineage(
             LineageItem(token=input.name, depth=depth),
             LineageItem(token="(", depth=depth),
         ]
-        for arg in input.args:
-            chain += flatten_array(arg, depth + 1)
-        chain += (LineageItem(token=")", depth=depth),)
+        chain += flatten_array(input.args, depth + 1)
+        chain += [LineageItem(token=")", depth=depth)]
     # elif isinstance(input, RowsetItem):
     #     chain = []
     #     chain += [LineageItem(token="(", depth=depth)]
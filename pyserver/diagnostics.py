@@ -1,7 +1,16 @@
+import hashlib
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+from functools import cached_property
 from logging import getLogger
 from typing import Any
 
-from lark import UnexpectedToken
+from lark import Tree, UnexpectedToken
 from trilogy.authoring import (
     ArrayType,
     Concept,
@@ -11,16 +20,22 @@ from trilogy.authoring import (
     StructType,
 )
 from trilogy.constants import DEFAULT_NAMESPACE
+from trilogy.core.models.author import Comment
 from trilogy.core.models.core import NumericType, TraitDataType
 from trilogy.core.statements.author import ImportStatement
 from trilogy.parsing.parse_engine_v2 import TopLevelStatementParser
 from trilogy.parsing.v2.lark_backend import PARSER
 from trilogy.parsing.v2.syntax import syntax_document_from_parser
 
+from cancellation import check_cancelled
 from common import concept_to_derivation, concept_to_description
+from env_cache import SOURCE_ENV_CACHE, model_cache_key
 from env_helpers import (
+    environment_integrity,
+    fork_environment,
     normalize_relative_imports,
     parse_env_from_full_model,
+    source_subtree_hashes,
 )
 from io_models import (
     CompletionItem,
@@ -34,6 +49,20 @@ from io_models import (
 
 logger = getLogger("diagnostics")
 
+DEFAULT_STATEMENT_CACHE_SIZE = 4096
+# each state holds an environment fork, so far fewer of these are kept
+DEFAULT_DOCUMENT_STATE_CACHE_SIZE = 128
+# strings and comments (an unterminated one runs to the end), then `;`
+_STATEMENT_TOKENS = re.compile(
+    r"'''.*?(?:'''|\Z)"
+    r"|'(?:[^'\\]|\\.)*(?:'|\Z)"
+    r'|"(?:[^"\\]|\\.)*(?:"|\Z)'
+    r"|`[^`]*(?:`|\Z)"
+    r"|(?:#|//)[^\n]*"
+    r"|;",
+    re.DOTALL,
+)
+
 
 def address_to_display(address: str) -> str:
     if address.startswith(DEFAULT_NAMESPACE):
@@ -52,16 +81,6 @@ def user_repr(error: UnexpectedToken | Exception) -> str:
         return str(error)
 
 
-def truncate_to_last_semicolon(text: str) -> str:
-    last_semicolon_index = text.rfind(";")
-    if last_semicolon_index + 1 == len(text):
-        return truncate_to_last_semicolon(text[: last_semicolon_index - 1])
-    if last_semicolon_index != -1:
-        return text[: last_semicolon_index + 1]
-    else:
-        return text  # Return original string if no semicolon is found
-
-
 def datatype_to_display(
     datatype: (
         DataType | TraitDataType | NumericType | ArrayType | MapType | StructType | Any
@@ -98,19 +117,373 @@ def concept_to_completion(label: str, concept: Concept, environment: Environment
     )
 
 
-def get_diagnostics(
-    doctext: str,
-    sources: list[ModelSourceInSchema],
-    current_filename: str | None = None,
-    files: list[str] | None = None,
-    working_path: str | None = None,
-) -> ValidateResponse:
-    diagnostics: list[ValidateItem] = []
-    completions: list[CompletionItem] = []
-    imports: list[Import] = []
+@dataclass(frozen=True)
+class StatementText:
+    """One statement of a document and where it starts (1-based, like lark)."""
+
+    text: str
+    line: int
+    column: int
+
+
+def split_statements(text: str) -> list[StatementText]:
+    """Split a document after every `;` outside strings and comments.
+
+    Text after the last `;` is returned as a final, unterminated statement.
+    Whitespace-only pieces are dropped.
+    """
+    statements: list[StatementText] = []
+    start = 0
+    line = 1
+    line_start = 0
+    for match in _STATEMENT_TOKENS.finditer(text):
+        if match.group() != ";":
+            continue
+        end = match.end()
+        statements.append(StatementText(text[start:end], line, start - line_start + 1))
+        line += text.count("\n", start, end)
+        line_start = text.rfind("\n", 0, end) + 1
+        start = end
+    statements.append(StatementText(text[start:], line, start - line_start + 1))
+    return [statement for statement in statements if statement.text.strip()]
+
+
+@dataclass(frozen=True)
+class ParsedStatement:
+    """Syntax of one statement; positions are relative to the statement."""
+
+    tree: Tree | None
+    items: tuple[ValidateItem, ...]
+
+
+class CompletionIndex:
+    """Completion items with a case-insensitive prefix index over labels.
+
+    The index is the sorted list of folded labels; every label with a given
+    prefix sits in one contiguous run of it, found by two bisections.
+    """
+
+    def __init__(self, items: list[CompletionItem]):
+        self.items = items
+        ordered = sorted((item.label.casefold(), idx) for idx, item in enumerate(items))
+        self._labels = [label for label, _ in ordered]
+        self._positions = [idx for _, idx in ordered]
+
+    def matching(self, prefix: str) -> list[CompletionItem]:
+        """Items whose label starts with `prefix`, in their original order."""
+        folded = prefix.casefold()
+        start = bisect_left(self._labels, folded)
+        end = bisect_left(self._labels, folded + "\U0010ffff", lo=start)
+        return [self.items[idx] for idx in sorted(self._positions[start:end])]
+
+
+@dataclass(frozen=True)
+class DocumentState:
+    """Environment, imports and completions after a run of statements.
+
+    `environment` is frozen and shared; it is only ever read or forked.
+    """
+
+    environment: Environment
+    integrity: tuple
+    imports: tuple[Import, ...]
+    # address -> (concept, its completion), in environment order
+    completions: dict[str, tuple[Concept, CompletionItem]]
+
+    @cached_property
+    def completion_index(self) -> CompletionIndex:
+        return CompletionIndex([item for _, item in self.completions.values()])
+
+
+@dataclass
+class StatementCacheStats:
+    statement_hits: int = 0
+    statement_misses: int = 0
+    state_hits: int = 0
+    state_misses: int = 0
+    index_hits: int = 0
+    index_misses: int = 0
+    evictions: int = 0
+    statements: int = 0
+    states: int = 0
+    max_statements: int = 0
+    max_states: int = 0
+
+
+def _shifted(item: ValidateItem, line: int, column: int) -> ValidateItem:
+    """`item` moved from statement-relative to document positions."""
+    return item.model_copy(
+        update={
+            "startLineNumber": item.startLineNumber + line - 1,
+            "startColumn": item.startColumn
+            + (column - 1 if item.startLineNumber == 1 else 0),
+            "endLineNumber": item.endLineNumber + line - 1,
+            "endColumn": item.endColumn
+            + (column - 1 if item.endLineNumber == 1 else 0),
+        }
+    )
+
+
+def _state_key(previous: str, text: str) -> str:
+    return hashlib.sha256(f"{previous}\0{text}".encode()).hexdigest()
+
+
+def _completions(
+    env: Environment,
+    previous: dict[str, tuple[Concept, CompletionItem]],
+    known: dict[str, CompletionItem] | None = None,
+) -> dict[str, tuple[Concept, CompletionItem]]:
+    """Completions for `env`, reusing `previous` items for unchanged concepts
+    and `known` items for the rest where given."""
+    known = known or {}
+    completions: dict[str, tuple[Concept, CompletionItem]] = {}
+    for k, v in env.concepts.items():
+        if v.name.startswith("_") or v.namespace.startswith("_"):
+            continue
+        cached = previous.get(k)
+        if cached is not None and cached[0] is v:
+            completions[k] = cached
+            continue
+        item = known.get(k)
+        if item is None:
+            if v.namespace == DEFAULT_NAMESPACE:
+                label = v.name
+            else:
+                label = k
+            item = concept_to_completion(label, v, env)
+        completions[k] = (v, item)
+    return completions
+
+
+class StatementCache:
+    """Per-statement syntax and per-prefix semantic results for diagnostics.
+
+    Statements are parsed one at a time and cached by their text, so an
+    edit re-parses only the statements it touched. The environment after
+    each statement is cached by a hash chained over the model and every
+    statement before it; analysis resumes from the longest unchanged prefix,
+    so editing the end of a long script re-analyses only its last statements.
+
+    Completions for the concepts an import brings in depend only on the model
+    and the import, so they are kept per model and shared by every document
+    that imports the same file under the same alias.
+    """
+
+    def __init__(
+        self,
+        max_statements: int = DEFAULT_STATEMENT_CACHE_SIZE,
+        max_states: int = DEFAULT_DOCUMENT_STATE_CACHE_SIZE,
+    ):
+        self.max_statements = max_statements
+        self.max_states = max_states
+        self._statements: OrderedDict[str, ParsedStatement] = OrderedDict()
+        self._states: OrderedDict[str, DocumentState] = OrderedDict()
+        # (model key, ((import path, alias), ...)) -> address -> completion
+        self._import_completions: OrderedDict[tuple, dict[str, CompletionItem]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._statement_hits = 0
+        self._statement_misses = 0
+        self._state_hits = 0
+        self._state_misses = 0
+        self._index_hits = 0
+        self._index_misses = 0
+        self._evictions = 0
+
+    def parse_statement(self, text: str) -> ParsedStatement:
+        with self._lock:
+            parsed = self._statements.get(text)
+            if parsed is not None:
+                self._statements.move_to_end(text)
+                self._statement_hits += 1
+                return parsed
+            self._statement_misses += 1
+        parsed = _parse_statement(text)
+        self._store(self._statements, self.max_statements, text, parsed)
+        return parsed
+
+    def analyse(
+        self,
+        statements: list[tuple[str, Tree]],
+        sources: list[ModelSourceInSchema],
+        files: list[str] | None = None,
+        working_path: str | None = None,
+    ) -> DocumentState:
+        """The document state after hydrating `statements` in order.
+
+        A statement that fails to hydrate is skipped: the state after it is
+        the state before it.
+        """
+        keys = [model_cache_key(sources, files=files, working_path=working_path)]
+        for text, _ in statements:
+            keys.append(_state_key(keys[-1], text))
+        resume, state = self._longest_prefix(keys)
+        if state is None:
+            env = parse_env_from_full_model(
+                sources, files=files, working_path=working_path
+            )
+            env.freeze()
+            state = DocumentState(
+                environment=env,
+                integrity=environment_integrity(env),
+                imports=(),
+                completions=_completions(env, {}),
+            )
+            self._store(self._states, self.max_states, keys[0], state)
+        if resume == len(statements):
+            return state
+        hashes = source_subtree_hashes(sources, files)
+        lookup = SOURCE_ENV_CACHE.reusable_environments(hashes)
+        try:
+            for idx in range(resume, len(statements)):
+                # states already stored stay valid, so a cancelled analysis
+                # still saves its successor the statements it got through
+                check_cancelled()
+                text, tree = statements[idx]
+                state = self._hydrate(state, text, tree, lookup, keys[0])
+                self._store(self._states, self.max_states, keys[idx + 1], state)
+        finally:
+            SOURCE_ENV_CACHE.record(lookup, hashes)
+        return state
+
+    def stats(self) -> StatementCacheStats:
+        with self._lock:
+            return StatementCacheStats(
+                statement_hits=self._statement_hits,
+                statement_misses=self._statement_misses,
+                state_hits=self._state_hits,
+                state_misses=self._state_misses,
+                index_hits=self._index_hits,
+                index_misses=self._index_misses,
+                evictions=self._evictions,
+                statements=len(self._statements),
+                states=len(self._states),
+                max_statements=self.max_statements,
+                max_states=self.max_states,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._statements.clear()
+            self._states.clear()
+            self._import_completions.clear()
+            self._statement_hits = 0
+            self._statement_misses = 0
+            self._state_hits = 0
+            self._state_misses = 0
+            self._index_hits = 0
+            self._index_misses = 0
+            self._evictions = 0
+
+    def _hydrate(
+        self,
+        state: DocumentState,
+        text: str,
+        tree: Tree,
+        lookup: dict,
+        model_key: str,
+    ) -> DocumentState:
+        env = fork_environment(state.environment)
+        parser = TopLevelStatementParser(environment=env)
+        parser.hydrator.parsed_environments = lookup
+        try:
+            output = parser.parse(syntax_document_from_parser(text=text, tree=tree))
+        except Exception:
+            logger.exception("text parse error, may have partial results")
+            return state
+        env.freeze()
+        imports = [x for x in output if isinstance(x, ImportStatement)]
+        # every concept an import-only statement adds comes from its imports
+        index_key = None
+        known = None
+        if imports and all(isinstance(x, (ImportStatement, Comment)) for x in output):
+            index_key = (model_key, tuple((str(x.path), x.alias) for x in imports))
+            known = self._known_completions(index_key)
+        completions = _completions(env, state.completions, known)
+        if index_key is not None and known is None:
+            self._store(
+                self._import_completions,
+                self.max_states,
+                index_key,
+                {
+                    k: item
+                    for k, (v, item) in completions.items()
+                    if k not in state.completions or state.completions[k][0] is not v
+                },
+            )
+        return DocumentState(
+            environment=env,
+            integrity=environment_integrity(env),
+            imports=state.imports
+            + tuple(Import(name=str(x.path), alias=x.alias) for x in imports),
+            completions=completions,
+        )
+
+    def _known_completions(self, key: tuple) -> dict[str, CompletionItem] | None:
+        with self._lock:
+            known = self._import_completions.get(key)
+            if known is None:
+                self._index_misses += 1
+                return None
+            self._import_completions.move_to_end(key)
+            self._index_hits += 1
+            return known
+
+    def _longest_prefix(self, keys: list[str]) -> tuple[int, DocumentState | None]:
+        """Statements covered by the longest cached prefix, and its state."""
+        with self._lock:
+            for idx in range(len(keys) - 1, -1, -1):
+                state = self._states.get(keys[idx])
+                if state is None:
+                    continue
+                if environment_integrity(state.environment) != state.integrity:
+                    del self._states[keys[idx]]
+                    continue
+                self._states.move_to_end(keys[idx])
+                self._state_hits += idx
+                self._state_misses += len(keys) - 1 - idx
+                return idx, state
+            self._state_misses += len(keys) - 1
+        return 0, None
+
+    def _store(
+        self, entries: OrderedDict, max_entries: int, key: Hashable, value: Any
+    ) -> None:
+        if max_entries <= 0:
+            return
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+                self._evictions += 1
+
+
+def _statement_span(text: str, message: str) -> ValidateItem:
+    """An error covering `text` without its surrounding whitespace."""
+    leading = text[: len(text) - len(text.lstrip())]
+    body = text.strip()
+    last_line = body[body.rfind("\n") + 1 :]
+    start_line = leading.count("\n") + 1
+    start_column = len(leading) - leading.rfind("\n")
+    end_line = start_line + body.count("\n")
+    end_column = len(last_line) + (start_column if end_line == start_line else 1)
+    return ValidateItem(
+        startLineNumber=start_line,
+        startColumn=start_column,
+        endLineNumber=end_line,
+        endColumn=end_column,
+        severity=Severity.Error,
+        message=message,
+    )
+
+
+def _parse_statement(text: str) -> ParsedStatement:
+    items: list[ValidateItem] = []
 
     def on_error(e: UnexpectedToken) -> Any:
-        diagnostics.append(
+        items.append(
             ValidateItem(
                 startLineNumber=e.line,
                 startColumn=e.column,
@@ -122,67 +495,65 @@ def get_diagnostics(
         )
         return True
 
-    parse_fragment = normalize_relative_imports(doctext, current_filename)
-    document = None
-    loops = 0
-    while parse_fragment.count(";") > 0:
-        loops += 1
-        try:
-            tree = PARSER.parse(parse_fragment, on_error=on_error)  # type: ignore
-            document = syntax_document_from_parser(text=parse_fragment, tree=tree)
-            break
-        except Exception:  # noqa: BLE001 -- retry progressively shorter user input
-            parse_fragment = truncate_to_last_semicolon(parse_fragment)
-            logger.info(parse_fragment)
-            diagnostics.append(
-                ValidateItem(
-                    startLineNumber=0,
-                    startColumn=0,
-                    endLineNumber=0,
-                    endColumn=0,
-                    severity=Severity.Error,
-                    message="Parse error",
-                )
-            )
-        if loops > 20:
-            break
-    if not document:
-        return ValidateResponse(items=diagnostics, completion_items=completions)
     try:
-        env = parse_env_from_full_model(sources, files=files, working_path=working_path)
-        seen: set[str] = set()
-        for k, v in env.concepts.items():
-            if v.name.startswith("_") or v.namespace.startswith("_"):
-                continue
-            if v.namespace == DEFAULT_NAMESPACE:
-                label = v.name
-            else:
-                label = k
-            completions.append(concept_to_completion(label, v, env))
-            seen.add(k)
-        try:
-            # get a partial parse tree
-            parser = TopLevelStatementParser(environment=env)
-            pass_two = parser.parse(document)
-            for x in pass_two:
-                logger.info(x)
-                if isinstance(x, ImportStatement):
-                    imports.append(Import(name=str(x.path), alias=x.alias))
+        tree = PARSER.parse(text, on_error=on_error)  # type: ignore
+    except Exception:  # noqa: BLE001 -- report the statement as unparseable
+        logger.info(text)
+        items.append(_statement_span(text, "Parse error"))
+        return ParsedStatement(tree=None, items=tuple(items))
+    return ParsedStatement(tree=tree, items=tuple(items))
 
-        except Exception:
-            logger.exception("text parse error, may have partial results")
-        for k, v in env.concepts.items():
-            if v.name.startswith("_") or v.namespace.startswith("_"):
-                continue
-            if v.namespace == DEFAULT_NAMESPACE:
-                label = v.name
-            else:
-                label = k
-            if k not in seen:
-                completions.append(concept_to_completion(label, v, env))
 
+STATEMENT_CACHE = StatementCache(
+    int(os.environ.get("TRILOGY_STATEMENT_CACHE_SIZE", DEFAULT_STATEMENT_CACHE_SIZE)),
+    int(
+        os.environ.get(
+            "TRILOGY_DOCUMENT_STATE_CACHE_SIZE", DEFAULT_DOCUMENT_STATE_CACHE_SIZE
+        )
+    ),
+)
+
+
+def get_diagnostics(
+    doctext: str,
+    sources: list[ModelSourceInSchema],
+    current_filename: str | None = None,
+    files: list[str] | None = None,
+    working_path: str | None = None,
+    statement_cache: StatementCache | None = None,
+    completion_prefix: str | None = None,
+) -> ValidateResponse:
+    """Errors, completions and imports for a document being edited.
+
+    With `completion_prefix`, only completions whose label starts with it
+    (ignoring case) are returned.
+    """
+    cache = statement_cache or STATEMENT_CACHE
+    diagnostics: list[ValidateItem] = []
+    text = normalize_relative_imports(doctext, current_filename)
+    if ";" not in text:
+        return ValidateResponse(items=diagnostics, completion_items=[])
+    statements: list[tuple[str, Tree]] = []
+    for statement in split_statements(text):
+        parsed = cache.parse_statement(statement.text)
+        diagnostics.extend(
+            _shifted(item, statement.line, statement.column) for item in parsed.items
+        )
+        if parsed.tree is not None:
+            statements.append((statement.text, parsed.tree))
+    if not statements:
+        return ValidateResponse(items=diagnostics, completion_items=[])
+    try:
+        state = cache.analyse(statements, sources, files, working_path)
     except Exception:
         logger.exception("completion generation raised exception")
+        return ValidateResponse(items=diagnostics, completion_items=[])
     return ValidateResponse(
-        items=diagnostics, completion_items=completions, imports=imports
+        items=diagnostics,
+        completion_items=(
+            state.completion_index.matching(completion_prefix)
+            if completion_prefix
+            else [item for _, item in state.completions.values()]
+        ),
+        imports=list(state.imports),
     )
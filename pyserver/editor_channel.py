@@ -0,0 +1,154 @@
+"""Debounced, cancellable analysis for the editor WebSocket.
+
+The editor opens a WebSocket to `/editor` and sends every version of the
+document as the user types:
+
+    {"action": "validate", "version": 7, "request": {...}}
+
+`request` is the body the matching HTTP endpoint takes (`/validate_query` or
+`/format_query`). Each reply echoes the action and version it answers:
+
+    {"action": "validate", "version": 7, "status_code": 200, "result": {...}}
+
+A failed request gets its HTTP status code and `detail` in place of `result`.
+
+Analysis starts only after a pause in typing, and a newer version of an
+action supersedes every older one. A version still waiting out the pause is
+dropped, and a running analysis is cancelled at its next phase boundary (see
+`cancellation`). Superseded versions get no reply, so the client never has
+to sort stale diagnostics from fresh ones.
+
+Settings come from the environment:
+
+- `TRILOGY_EDITOR_DEBOUNCE_MS`: quiet period before an analysis starts
+  (default 50)
+"""
+
+import asyncio
+import os
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any
+
+from fastapi import HTTPException
+from pydantic_core import to_json
+
+from cancellation import CancelToken, TaskCancelled
+
+logger = getLogger(__name__)
+
+DEFAULT_EDITOR_DEBOUNCE_MS = 50
+
+# (action, request, token) -> the encoded result; raises HTTPException
+Analyse = Callable[[str, dict[str, Any], CancelToken], Awaitable[bytes]]
+
+
+def editor_debounce_seconds() -> float:
+    return (
+        float(os.environ.get("TRILOGY_EDITOR_DEBOUNCE_MS", DEFAULT_EDITOR_DEBOUNCE_MS))
+        / 1000
+    )
+
+
+def editor_reply(
+    action: str | None,
+    version: int | None,
+    status_code: int,
+    result: bytes | None = None,
+    detail: Any = None,
+) -> str:
+    envelope = {"action": action, "version": version, "status_code": status_code}
+    head = to_json(envelope)[:-1]
+    # the result arrives encoded from the task and is spliced in as-is
+    if result is not None:
+        return (head + b',"result":' + result + b"}").decode("utf-8")
+    return (head + b',"detail":' + to_json(detail, fallback=str) + b"}").decode("utf-8")
+
+
+@dataclass
+class EditorSessionStats:
+    received: int = 0
+    replies: int = 0
+    # dropped while waiting out the debounce
+    debounced: int = 0
+    # stopped at a phase boundary while running
+    cancelled: int = 0
+    # finished after a newer version arrived; the result was discarded
+    stale: int = 0
+
+
+class EditorSession:
+    """The analyses for one editor connection, at most one pending or
+    running per action."""
+
+    def __init__(
+        self,
+        analyse: Analyse,
+        send: Callable[[str], Awaitable[None]],
+        debounce_seconds: float,
+    ):
+        self.debounce_seconds = debounce_seconds
+        self._analyse = analyse
+        self._send = send
+        # action -> (token, task) of its newest version
+        self._latest: dict[str, tuple[CancelToken, asyncio.Task]] = {}
+        self._send_lock = asyncio.Lock()
+        self._closed = False
+        self._stats = EditorSessionStats()
+
+    def submit(self, action: str, version: int, request: dict[str, Any]) -> None:
+        """Start analysing `version`, superseding any older one of `action`."""
+        self._stats.received += 1
+        previous = self._latest.get(action)
+        if previous is not None:
+            previous[0].cancel()
+        token = CancelToken()
+        task = asyncio.create_task(self._run(action, version, request, token))
+        self._latest[action] = (token, task)
+
+    async def reply(self, message: str) -> None:
+        if self._closed:
+            return
+        async with self._send_lock:
+            await self._send(message)
+        self._stats.replies += 1
+
+    async def close(self) -> None:
+        """Cancel everything in flight and wait for it to stop."""
+        self._closed = True
+        tasks = []
+        for token, task in self._latest.values():
+            token.cancel()
+            tasks.append(task)
+        self._latest.clear()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> EditorSessionStats:
+        return EditorSessionStats(**vars(self._stats))
+
+    async def _run(
+        self, action: str, version: int, request: dict[str, Any], token: CancelToken
+    ) -> None:
+        await asyncio.sleep(self.debounce_seconds)
+        if token.cancelled:
+            self._stats.debounced += 1
+            return
+        try:
+            message = editor_reply(
+                action, version, 200, result=await self._analyse(action, request, token)
+            )
+        except TaskCancelled:
+            self._stats.cancelled += 1
+            return
+        except HTTPException as exc:
+            message = editor_reply(action, version, exc.status_code, detail=exc.detail)
+        except Exception:
+            # one failed analysis must not end the session
+            logger.exception("Editor %s analysis failed", action)
+            message = editor_reply(action, version, 500, detail="Internal server error")
+        if token.cancelled:
+            # finished without reaching a phase boundary after the cancel
+            self._stats.stale += 1
+            return
+        await self.reply(message)
@@ -0,0 +1,317 @@
+"""Content-addressed cache of parsed, already-imported model environments.
+
+Dashboards send the same `full_model` with every request, and rebuilding the
+environment - above all re-parsing every imported source - dominates query
+setup time. Entries are keyed by a hash of everything that shapes the parsed
+environment and are never handed out directly: callers get a fork, so
+per-request concept additions never leak back into the cache.
+
+Editing one file changes the model key, so below the model cache sits a cache
+of the individual source environments, keyed by `source_subtree_hashes`. A
+rebuild imports every source whose subtree is unchanged from it and re-parses
+only the edited file and the files that import it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+from trilogy import Environment
+from trilogy.constants import Parsing
+from trilogy.parsing.v2.import_service import ImportEnvCacheKey
+
+from env_helpers import (
+    environment_integrity,
+    fork_environment,
+    import_root,
+    parse_env_from_full_model,
+    parse_imports,
+    parse_model_graph,
+    source_subtree_hashes,
+)
+from io_models import ModelSourceInSchema
+from tracing import phase
+
+DEFAULT_ENV_CACHE_SIZE = 64
+DEFAULT_SOURCE_ENV_CACHE_SIZE = 512
+
+
+def model_cache_key(
+    sources: list[ModelSourceInSchema],
+    import_strings: Iterable[str] = (),
+    files: Iterable[str] | None = None,
+    working_path: str | None = None,
+) -> str:
+    """Stable content hash of the inputs to a parsed model environment.
+
+    Source order does not change the parsed result, so sources are sorted by
+    alias; import order does, so imports are kept as given.
+    """
+    payload = {
+        "sources": sorted((source.alias, source.text) for source in sources),
+        "imports": list(import_strings),
+        "files": sorted(f for f in files if f) if files else [],
+        "working_path": working_path,
+    }
+    encoded = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ParsedModel:
+    """A parsed model environment plus the statements its imports produced.
+
+    `environment` is frozen and shared between requests; use `fork` to get a
+    private, mutable copy.
+    """
+
+    key: str
+    environment: Environment
+    import_statements: list = field(default_factory=list)
+    integrity: tuple = ()
+
+    def fork(self) -> Environment:
+        return fork_environment(self.environment)
+
+    def is_intact(self) -> bool:
+        """False once a fork has edited a shared object in place."""
+        return environment_integrity(self.environment) == self.integrity
+
+
+@dataclass
+class EnvironmentCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    size: int = 0
+    max_entries: int = 0
+
+
+class SourceEnvironmentCache:
+    """Bounded LRU of parsed source environments keyed by subtree hash.
+
+    Entries are the environments trilogy builds for an imported file. They
+    are shared, unforked, by every parse that imports them, so each is
+    stamped with `environment_integrity` when stored and dropped once a parse
+    has edited it in place. Hits count sources imported from the cache,
+    misses sources a parse had to read.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_SOURCE_ENV_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[Environment, tuple]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def reusable_environments(
+        self, hashes: dict[str, str]
+    ) -> dict[ImportEnvCacheKey, Environment]:
+        """An import lookup holding every cached source in `hashes`."""
+        lookup: dict[ImportEnvCacheKey, Environment] = {}
+        with self._lock:
+            for target, digest in hashes.items():
+                entry = self._entries.get(digest)
+                if entry is None:
+                    continue
+                env, integrity = entry
+                if environment_integrity(env) != integrity:
+                    del self._entries[digest]
+                    self._invalidations += 1
+                    continue
+                self._entries.move_to_end(digest)
+                lookup[(target, import_root(target))] = env
+                self._hits += 1
+        return lookup
+
+    def record(
+        self,
+        parsed_environments: dict[ImportEnvCacheKey, Environment],
+        hashes: dict[str, str],
+    ) -> None:
+        """Store the source environments a parse added to its import lookup."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for (target, root), env in parsed_environments.items():
+                digest = hashes.get(target)
+                if digest is None or root != import_root(target):
+                    continue
+                cached = self._entries.get(digest)
+                if cached is not None and cached[0] is env:
+                    continue
+                self._entries[digest] = (env, environment_integrity(env))
+                self._entries.move_to_end(digest)
+                self._misses += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def parse_model_graph(
+        self,
+        sources: list[ModelSourceInSchema],
+        parse_config: Parsing | None = None,
+    ) -> dict[str, Environment]:
+        """`parse_model_graph`, re-parsing only sources with a changed subtree."""
+        hashes = source_subtree_hashes(sources)
+        lookup = self.reusable_environments(hashes)
+        environments = parse_model_graph(sources, parse_config, lookup)
+        self.record(lookup, hashes)
+        return environments
+
+    def stats(self) -> EnvironmentCacheStats:
+        with self._lock:
+            return EnvironmentCacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                invalidations=self._invalidations,
+                size=len(self._entries),
+                max_entries=self.max_entries,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._invalidations = 0
+
+
+class EnvironmentCache:
+    """Bounded LRU of `ParsedModel` entries keyed by `model_cache_key`.
+
+    Misses build outside the lock, so two concurrent misses on one key may
+    both parse; the later result simply replaces the earlier one. With a
+    `source_cache`, a miss re-parses only the sources that changed.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_ENV_CACHE_SIZE,
+        source_cache: SourceEnvironmentCache | None = None,
+    ):
+        self.max_entries = max_entries
+        self.source_cache = source_cache
+        self._entries: OrderedDict[str, ParsedModel] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get_parsed_model(
+        self,
+        sources: list[ModelSourceInSchema],
+        import_strings: list[str] | None = None,
+        files: Iterable[str] | None = None,
+        working_path: str | None = None,
+        parse_config: Parsing | None = None,
+    ) -> ParsedModel:
+        import_strings = import_strings or []
+        files = list(files) if files else None
+        key = model_cache_key(sources, import_strings, files, working_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.is_intact():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+                self._invalidations += 1
+            self._misses += 1
+
+        entry = self._build(
+            key, sources, import_strings, files, working_path, parse_config
+        )
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return entry
+
+    def get_environment(
+        self,
+        sources: list[ModelSourceInSchema],
+        import_strings: list[str] | None = None,
+        files: Iterable[str] | None = None,
+        working_path: str | None = None,
+        parse_config: Parsing | None = None,
+    ) -> Environment:
+        """A private, already-imported environment for this model."""
+        return self.get_parsed_model(
+            sources, import_strings, files, working_path, parse_config
+        ).fork()
+
+    def _build(
+        self,
+        key: str,
+        sources: list[ModelSourceInSchema],
+        import_strings: list[str],
+        files: list[str] | None,
+        working_path: str | None,
+        parse_config: Parsing | None,
+    ) -> ParsedModel:
+        env = parse_env_from_full_model(sources, files=files, working_path=working_path)
+        statements: list = []
+        if import_strings:
+            hashes = source_subtree_hashes(sources, files)
+            lookup = (
+                self.source_cache.reusable_environments(hashes)
+                if self.source_cache is not None
+                else {}
+            )
+            with phase("imports", import_count=len(import_strings), reused=len(lookup)):
+                statements = parse_imports(
+                    "\n".join(import_strings), env, parse_config, lookup
+                )
+            if self.source_cache is not None:
+                self.source_cache.record(lookup, hashes)
+        env.freeze()
+        return ParsedModel(
+            key=key,
+            environment=env,
+            import_statements=statements,
+            integrity=environment_integrity(env),
+        )
+
+    def stats(self) -> EnvironmentCacheStats:
+        with self._lock:
+            return EnvironmentCacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                invalidations=self._invalidations,
+                size=len(self._entries),
+                max_entries=self.max_entries,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._invalidations = 0
+
+
+SOURCE_ENV_CACHE = SourceEnvironmentCache(
+    int(os.environ.get("TRILOGY_SOURCE_ENV_CACHE_SIZE", DEFAULT_SOURCE_ENV_CACHE_SIZE))
+)
+ENV_CACHE = EnvironmentCache(
+    int(os.environ.get("TRILOGY_ENV_CACHE_SIZE", DEFAULT_ENV_CACHE_SIZE)),
+    source_cache=SOURCE_ENV_CACHE,
+)
@@ -1,18 +1,30 @@
 import copy
+import hashlib
+from collections import defaultdict
 from collections.abc import Iterable
+from os.path import dirname
 from pathlib import PurePosixPath
 
 from trilogy import Environment
 from trilogy.authoring import (
     Concept,
 )
+from trilogy.constants import CONFIG, Parsing
 from trilogy.core.enums import ConceptSource
-from trilogy.core.models.datasource import Address
-from trilogy.core.models.environment import DictImportResolver, EnvironmentConfig
+from trilogy.core.exceptions import InvalidSyntaxException
+from trilogy.core.models.datasource import Address, EnvironmentDatasourceDict
+from trilogy.core.models.environment import (
+    DictImportResolver,
+    EnvironmentConceptDict,
+    EnvironmentConfig,
+)
 from trilogy.parsing.exceptions import ParseError
+from trilogy.parsing.parse_engine_v2 import TopLevelStatementParser, parse_syntax
+from trilogy.parsing.v2.import_service import ImportEnvCacheKey
 
 from common import concept_to_description, flatten_lineage
 from io_models import (
+    Import,
     Model,
     ModelInSchema,
     ModelSource,
@@ -25,8 +37,78 @@ PARSE_DEPENDENCY_RESOLUTION_ATTEMPTS = 10
 
 
 class StudioEnvironmentConfig(EnvironmentConfig):
+    """Environment config whose import resolver is shared, never copied.
+
+    The `DictImportResolver` holds every source file's text and is only ever
+    read after construction, so every child environment trilogy creates while
+    resolving imports - and every fork of a parsed environment - can point at
+    the same resolver instead of deep-copying it.
+    """
+
     def copy_for_root(self, root: str | None) -> "StudioEnvironmentConfig":
-        return copy.deepcopy(self)
+        return copy.copy(self)
+
+    def __deepcopy__(self, memo: dict) -> "StudioEnvironmentConfig":
+        return copy.copy(self)
+
+
+def environment_integrity(env: Environment) -> tuple:
+    """Stamp that changes when an environment is mutated, including in place.
+
+    Mirrors the check trilogy applies to its own shared import environments:
+    dict writes show up in the mutation counters, and the in-place datasource
+    edits that never touch a dict (status flips on publish/persist, column
+    strips on redeclaration) show up in the per-datasource summary.
+    """
+    return (
+        env.concepts.mutations,
+        env.datasources.mutations,
+        tuple(
+            sorted(
+                (k, d.status.value, len(d.columns)) for k, d in env.datasources.items()
+            )
+        ),
+    )
+
+
+def fork_environment(source: Environment) -> Environment:
+    """Copy-on-write fork of a parsed environment.
+
+    Unlike `Environment.duplicate`, concept and datasource objects are shared
+    with `source`; only the containers are copied. Trilogy replaces rather
+    than edits concepts, so anything the fork adds, removes or re-binds stays
+    local to it. The few in-place datasource edits are caught by comparing
+    `environment_integrity` of the source before and after use.
+    """
+    concepts = EnvironmentConceptDict()
+    concepts.data.update(source.concepts.data)
+    concepts.undefined = dict(source.concepts.undefined)
+    concepts.fail_on_missing = source.concepts.fail_on_missing
+    concepts.hidden = set(source.concepts.hidden)
+    concepts.rowset_namespaces = set(source.concepts.rowset_namespaces)
+    concepts.rowset_alias_outputs = set(source.concepts.rowset_alias_outputs)
+    concepts.rowset_join_key_leaks = set(source.concepts.rowset_join_key_leaks)
+    datasources = EnvironmentDatasourceDict()
+    datasources.update(source.datasources)
+    return Environment(
+        concepts=concepts,
+        datasources=datasources,
+        functions=dict(source.functions),
+        data_types=dict(source.data_types),
+        named_statements=dict(source.named_statements),
+        imports=defaultdict(list, {k: list(v) for k, v in source.imports.items()}),
+        namespace_source=dict(source.namespace_source),
+        imported=source.imported.duplicate(),
+        namespace=source.namespace,
+        working_path=source.working_path,
+        import_paths=list(source.import_paths),
+        config=copy.copy(source.config),
+        version=source.version,
+        cte_name_map=dict(source.cte_name_map),
+        alias_origin_lookup=dict(source.alias_origin_lookup),
+        merges=list(source.merges),
+        env_file_path=source.env_file_path,
+    )
 
 
 def _normalize_source_path(path: str | None) -> str | None:
@@ -91,6 +173,20 @@ def normalize_relative_imports(text: str, current_filename: str | None) -> str:
     return "\n".join(lines)
 
 
+def imports_to_strings(
+    imports: Iterable[Import], current_filename: str | None = None
+) -> list[str]:
+    """Render request-level imports as `import` statements, one per entry."""
+    import_strings = []
+    for imp in imports:
+        resolved = resolve_import_path(imp.name, current_filename)
+        if imp.alias:
+            import_strings.append(f"import {resolved} as {imp.alias};")
+        else:
+            import_strings.append(f"import {resolved};")
+    return import_strings
+
+
 def parse_env_from_full_model(
     sources: list[ModelSourceInSchema],
     files: Iterable[str] | None = None,
@@ -108,7 +204,7 @@ def parse_env_from_full_model(
 
     content = {
         source.alias.replace("/", "."): normalize_relative_imports(
-            source.contents, source.alias
+            source.text, source.alias
         )
         for source in sources
     }
@@ -127,23 +223,191 @@ def concept_to_ui_concept(concept: Concept) -> UIConcept:
         namespace=concept.namespace or "",
         address=concept.address,
         lineage=flatten_lineage(concept, depth=0),
-        keys=list(concept.keys) if concept.keys else [],
+        keys=sorted(concept.keys) if concept.keys else [],
     )
 
 
-def source_to_model_source(
-    source: ModelSourceInSchema, sources: list[ModelSourceInSchema]
+def source_import_targets(text: str, current_filename: str | None = None) -> list[str]:
+    """Resolved dotted paths of every `import` statement in a source file."""
+    targets = []
+    for raw_line in text.splitlines():
+        stripped = raw_line.lstrip()
+        if not stripped.startswith("import ") or ";" not in stripped:
+            continue
+        parts = stripped.split(";", 1)[0].split()
+        if len(parts) >= 2 and parts[0] == "import":
+            targets.append(resolve_import_path(parts[1], current_filename))
+    return targets
+
+
+def _source_key(source: ModelSourceInSchema) -> str:
+    return source.alias.replace("/", ".")
+
+
+def topological_sources(
+    sources: list[ModelSourceInSchema],
+) -> list[ModelSourceInSchema]:
+    """Order sources so every file comes after the model files it imports.
+
+    Ties keep the input order. Sources caught in an import cycle cannot be
+    ordered and are appended in input order; trilogy breaks the cycle itself
+    when they are parsed.
+    """
+    by_key = {_source_key(source): source for source in sources}
+    pending: dict[str, set[str]] = {
+        key: {
+            target
+            for target in source_import_targets(source.text, source.alias)
+            if target in by_key and target != key
+        }
+        for key, source in by_key.items()
+    }
+    ordered: list[ModelSourceInSchema] = []
+    while pending:
+        ready = [key for key, deps in pending.items() if not deps]
+        if not ready:
+            ready = list(pending)
+        for key in ready:
+            ordered.append(by_key[key])
+            del pending[key]
+        for deps in pending.values():
+            deps.difference_update(ready)
+    return ordered
+
+
+def import_root(target: str) -> str | None:
+    """The config root trilogy files an imported source's environment under."""
+    return target.rsplit(".", 1)[0] if "." in target else None
+
+
+def source_subtree_hashes(
+    sources: list[ModelSourceInSchema], files: Iterable[str] | None = None
+) -> dict[str, str]:
+    """Hash of each source's parse inputs, keyed by resolved source path.
+
+    A source's hash covers its own path and text plus the hashes of the model
+    files it imports, so it changes exactly when the source or anything below
+    it in the import graph is edited. Sources in an import cycle get no hash.
+    """
+    by_key = {_source_key(source): source for source in sources}
+    data_files = "\0".join(sorted(f for f in files if f)) if files else ""
+    hashes: dict[str, str] = {}
+    for source in topological_sources(sources):
+        key = _source_key(source)
+        deps = sorted(
+            {
+                target
+                for target in source_import_targets(source.text, source.alias)
+                if target in by_key
+            }
+        )
+        if any(dep not in hashes for dep in deps):
+            continue
+        digest = hashlib.sha256()
+        for part in (key, data_files, source.text, *(hashes[d] for d in deps)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        hashes[key] = digest.hexdigest()
+    return hashes
+
+
+def parse_imports(
+    text: str,
+    environment: Environment,
+    parse_config: Parsing | None = None,
+    parsed_environments: dict[ImportEnvCacheKey, Environment] | None = None,
+) -> list:
+    """`parse_text`, resolving imports against `parsed_environments` first.
+
+    Source environments already in the lookup are imported as they are rather
+    than re-parsed; every source the parse has to read is added to it.
+    """
+    parser = TopLevelStatementParser(
+        environment=environment,
+        import_keys=["root"],
+        parse_config=parse_config or CONFIG.parsing,
+    )
+    if parsed_environments is not None:
+        parser.hydrator.parsed_environments = parsed_environments
+    try:
+        statements = parser.parse(parse_syntax(text))
+    except SyntaxError as e:
+        raise InvalidSyntaxException(str(e)).with_traceback(e.__traceback__)
+    environment.concepts.fail_on_missing = True
+    return statements
+
+
+def parse_model_graph(
+    sources: list[ModelSourceInSchema],
+    parse_config: Parsing | None = None,
+    parsed_environments: dict[ImportEnvCacheKey, Environment] | None = None,
+) -> dict[str, Environment]:
+    """Parse every source of a model exactly once, keyed by source alias.
+
+    Sources are parsed in dependency order into one shared import lookup, so
+    by the time a file is parsed everything it imports is already there and is
+    reused rather than re-parsed. Each environment is built the way trilogy
+    builds an imported file's, which is what lets the two share it. A
+    `parsed_environments` lookup passed in is seeded into, and filled from,
+    that shared lookup.
+    """
+    config = parse_env_from_full_model(sources).config
+    resolver = config.import_resolver
+    assert isinstance(resolver, DictImportResolver)
+    if parsed_environments is None:
+        parsed_environments = {}
+    text_lookup: dict = {}
+    environments: dict[str, Environment] = {}
+    for source in topological_sources(sources):
+        target = _source_key(source)
+        root = import_root(target)
+        env = parsed_environments.get((target, root))
+        if env is None:
+            env = Environment(
+                working_path=dirname(target),
+                env_file_path=target,
+                config=config.copy_for_root(root=root),
+            )
+            parser = TopLevelStatementParser(
+                environment=env,
+                parse_address=target,
+                token_address=target,
+                parse_config=parse_config,
+            )
+            parser.hydrator.parsed_environments = parsed_environments
+            parser.hydrator.text_lookup = text_lookup
+            parser.hydrator.import_keys = [target]
+            try:
+                parser.parse(parse_syntax(resolver.content[target]))
+            except Exception as e:
+                raise ParseError(
+                    f"Unable to process file '{source.alias}', parsing error: {e}"
+                ) from e
+            parsed_environments[(target, root)] = env
+        environments[source.alias] = env
+    return environments
+
+
+def env_to_model_source(
+    alias: str,
+    env: Environment,
+    ui_concepts: dict[int, UIConcept] | None = None,
 ) -> ModelSource:
+    """Project a parsed source environment onto the wire model.
+
+    `ui_concepts` memoizes the projection by concept identity; sources that
+    share imports share concept objects, so one map serves a whole model.
+    """
+    ui_concepts = ui_concepts if ui_concepts is not None else {}
+
+    def to_ui(concept: Concept) -> UIConcept:
+        cached = ui_concepts.get(id(concept))
+        if cached is None:
+            cached = ui_concepts[id(concept)] = concept_to_ui_concept(concept)
+        return cached
+
     final_concepts: list[UIConcept] = []
     final_datasources: list[UIDatasource] = []
-    env = parse_env_from_full_model(sources)
-    try:
-        env.parse(source.contents)
-    except Exception as e:
-        raise ParseError(
-            f"Unable to process file '{source.alias}', parsing error: {e}"
-        ) from e
-
     for sconcept in env.concepts.values():
         # don't show private concepts
         if sconcept.name.startswith("_"):
@@ -155,7 +419,7 @@ def source_to_model_source(
             and sconcept.metadata.concept_source == ConceptSource.AUTO_DERIVED
         ):
             continue
-        final_concepts.append(concept_to_ui_concept(sconcept))
+        final_concepts.append(to_ui(sconcept))
     final_concepts.sort(key=lambda x: x.address)
 
     for dkey, datasource in env.datasources.items():
@@ -166,7 +430,7 @@ def source_to_model_source(
                 continue
 
             sconcept = env.concepts[cref.address]
-            dconcepts.append(concept_to_ui_concept(sconcept))
+            dconcepts.append(to_ui(sconcept))
         dconcepts.sort(key=lambda x: x.address)
         if isinstance(datasource.address, Address):
             final_address = datasource.address.location
@@ -178,21 +442,25 @@ def source_to_model_source(
                 name=dkey,
                 location=final_address,
                 concepts=dconcepts,
-                grain=[
-                    concept_to_ui_concept(env.concepts[x])
-                    for x in datasource.grain.components
-                ],
+                grain=[to_ui(env.concepts[x]) for x in datasource.grain.components],
             )
         )
     return ModelSource(
-        alias=source.alias, concepts=final_concepts, datasources=final_datasources
+        alias=alias, concepts=final_concepts, datasources=final_datasources
     )
 
 
-def model_to_response(model: ModelInSchema) -> Model:
+def model_to_response(
+    model: ModelInSchema, environments: dict[str, Environment] | None = None
+) -> Model:
+    """The wire model for `model`, from already-parsed `environments` if given."""
+    if environments is None:
+        environments = parse_model_graph(model.sources)
+    ui_concepts: dict[int, UIConcept] = {}
     return Model(
         name=model.name,
         sources=[
-            source_to_model_source(source, model.sources) for source in model.sources
+            env_to_model_source(source.alias, environments[source.alias], ui_concepts)
+            for source in model.sources
         ],
     )
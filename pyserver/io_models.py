@@ -1,7 +1,7 @@
 from enum import Enum
-from typing import Any
+from typing import Any, Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from trilogy import Dialects
 from trilogy.authoring import (
     ArrayType,
@@ -83,7 +83,24 @@ class InputRequest(BaseModel):
 
 class ModelSourceInSchema(BaseModel):
     alias: str
-    contents: str
+    contents: str | None = None
+    # Without `contents`, a reference to a source the server already has (see
+    # blob_store); with contents, their hash, so the server stores them. An
+    # empty file sent with its hash carries `contents: ""`.
+    sha256: str | None = None
+
+    @model_validator(mode="after")
+    def _contents_or_hash(self) -> "ModelSourceInSchema":
+        if self.contents is None and self.sha256 is None:
+            raise ValueError(f"Source {self.alias!r} needs contents or a sha256")
+        return self
+
+    @property
+    def text(self) -> str:
+        """The source text, for a source past blob resolution."""
+        if self.contents is None:
+            raise ValueError(f"Source {self.alias!r} was not resolved from its sha256")
+        return self.contents
 
 
 class ModelInSchema(BaseModel):
@@ -91,6 +108,45 @@ class ModelInSchema(BaseModel):
     sources: list[ModelSourceInSchema]
 
 
+def _empty_model() -> ModelInSchema:
+    return ModelInSchema(name="", sources=[])
+
+
+def _check_one_model(model_id: str | None, fields_set: set[str], field: str) -> None:
+    """A request names its model by exactly one of `model_id` and `field`.
+
+    Presence is what counts: an explicitly empty model is a valid request for
+    model-free queries, but a request with neither would run against an empty
+    environment, and one with both would have its inline model ignored.
+    """
+    if model_id is not None and field in fields_set:
+        raise ValueError(f"Send either model_id or {field}, not both")
+    if model_id is None and field not in fields_set:
+        raise ValueError(
+            f"Send the model as {field}, or the model_id of a registered model session"
+        )
+
+
+class ModelDeltaInSchema(BaseModel):
+    # sources to add, or to replace by alias
+    sources: list[ModelSourceInSchema] = Field(default_factory=list)
+    removed: list[str] = Field(default_factory=list)
+
+
+class ModelSessionOutSchema(BaseModel):
+    model_id: str
+    content_hash: str
+
+
+class BlobUploadInSchema(BaseModel):
+    contents: list[str]
+
+
+class BlobUploadOutSchema(BaseModel):
+    # sha256 of each uploaded text, in order
+    hashes: list[str]
+
+
 class Import(BaseModel):
     name: str
     alias: str | None = None
@@ -105,7 +161,9 @@ class MultiQueryComponent(BaseModel):
 
 class MultiQueryInSchema(BaseModel):
     imports: list[Import]
-    full_model: ModelInSchema
+    # May be left out when `model_id` names a registered model session
+    full_model: ModelInSchema = Field(default_factory=_empty_model)
+    model_id: str | None = None
     dialect: Dialects
     queries: list[MultiQueryComponent]
     extra_filters: list[str] | None = None
@@ -122,12 +180,19 @@ class MultiQueryInSchema(BaseModel):
     # filesystem to anchor against.
     working_path: str | None = None
 
+    @model_validator(mode="after")
+    def _one_model(self) -> "MultiQueryInSchema":
+        _check_one_model(self.model_id, self.model_fields_set, "full_model")
+        return self
+
 
 class QueryInSchema(BaseModel):
     imports: list[Import]
     query: str
     dialect: Dialects
-    full_model: ModelInSchema
+    # See MultiQueryInSchema.full_model
+    full_model: ModelInSchema = Field(default_factory=_empty_model)
+    model_id: str | None = None
     current_filename: str | None = None
     extra_filters: list[str] | None = None
     parameters: dict[str, str | int | float] | None = None
@@ -137,6 +202,11 @@ class QueryInSchema(BaseModel):
     working_path: str | None = None
     # chart_type: ChartType | None = None
 
+    @model_validator(mode="after")
+    def _one_model(self) -> "QueryInSchema":
+        _check_one_model(self.model_id, self.model_fields_set, "full_model")
+        return self
+
 
 class DrilldownQueryInSchema(QueryInSchema):
     drilldown_remove: str
@@ -147,7 +217,9 @@ class DrilldownQueryInSchema(QueryInSchema):
 class ValidateQueryInSchema(BaseModel):
     query: str
     imports: list[Import]
-    sources: list[ModelSourceInSchema]
+    # May be left out when `model_id` names a registered model session
+    sources: list[ModelSourceInSchema] = Field(default_factory=list)
+    model_id: str | None = None
     current_filename: str | None = None
     extra_filters: list[str] | None = None
     parameters: dict[str, str | int | float] | None = None
@@ -155,6 +227,21 @@ class ValidateQueryInSchema(BaseModel):
     files: list[str] | None = None
     # See MultiQueryInSchema.working_path
     working_path: str | None = None
+    # Only return completions whose label starts with this (case-insensitive)
+    completion_prefix: str | None = None
+
+    @model_validator(mode="after")
+    def _one_model(self) -> "ValidateQueryInSchema":
+        _check_one_model(self.model_id, self.model_fields_set, "sources")
+        return self
+
+
+class EditorMessageInSchema(BaseModel):
+    # "validate" takes a ValidateQueryInSchema request, "format" a QueryInSchema
+    action: Literal["validate", "format"]
+    # Echoed in the reply; a newer version of an action supersedes older ones
+    version: int
+    request: dict[str, Any]
 
 
 class QueryOutColumn(BaseModel):
@@ -238,6 +325,8 @@ class QueryOut(BaseModel):
 
 class MultiQueryOutSchema(BaseModel):
     queries: list[QueryOut] = Field(default_factory=list)
+    # planning time of each query, in request order
+    timings_ms: list[float] = Field(default_factory=list)
 
 
 class Severity(Enum):
@@ -19,8 +19,15 @@ from starlette.background import BackgroundTask
 from trilogy import Environment, Executor, __version__
 from uvicorn.config import LOGGING_CONFIG
 
+from slow_requests import format_phases, load_capture
+
 # Import the reusable endpoints module
-from studio_endpoints import create_trilogy_router
+from studio_endpoints import (
+    CACHE_STATUS_HEADER,
+    create_trilogy_router,
+    replay_generate_query,
+)
+from tracing import configure_tracing
 
 # Define the path to the .env file
 env_path = Path(__file__).parent / ".env"
@@ -74,6 +81,12 @@ def setup_performance_logging():
 # Call this early to set up logging
 setup_performance_logging()
 
+# Spans go where TRILOGY_TRACE says; with only performance logging on, each
+# trace is logged as a timing breakdown
+configure_tracing(
+    os.environ.get("TRILOGY_TRACE") or ("log" if ENABLE_PERF_LOGGING else "")
+)
+
 PORT = 5678
 
 
@@ -104,6 +117,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["Authorization"],
+    # lets browser clients read whether a generate response was cached
+    expose_headers=[CACHE_STATUS_HEADER],
     allow_origin_regex=allow_origin_regex,
 )
 
@@ -223,6 +238,37 @@ def run():
         sys.exit(1)
 
 
+@cli.command()
+@click.argument("capture", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option("--sort", default="cumulative", show_default=True, help="pstats sort key")
+@click.option("--limit", default=40, show_default=True, help="Functions to print")
+@click.option(
+    "--stats-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Also save the raw profile here, e.g. for snakeviz",
+)
+def replay(capture: Path, sort: str, limit: int, stats_file: Path | None):
+    """Replay a slow-request capture under cProfile."""
+    captured = load_capture(capture)
+    if captured["endpoint"] != "generate_query":
+        raise click.UsageError(
+            f"Only generate_query captures can be replayed, not {captured['endpoint']}"
+        )
+    result = replay_generate_query(captured)
+    error = isinstance(result.result, dict) and result.result.get("__http_error__")
+    outcome = f"{error['status_code']}: {error['detail']}" if error else "200"
+    click.echo(
+        f"Captured: {captured['elapsed']:.4f}s | Replayed: {result.elapsed:.4f}s "
+        f"| Status: {outcome}"
+        + (" | Payload was redacted" if captured["redacted"] else "")
+    )
+    click.echo(format_phases(captured["phases"], result.phases))
+    click.echo()
+    result.stats.sort_stats(sort).print_stats(limit)
+    if stats_file is not None:
+        result.stats.dump_stats(stats_file)
+
+
 @cli.command()
 def test():
 
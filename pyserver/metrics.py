@@ -0,0 +1,441 @@
+"""Prometheus metrics for the studio endpoints.
+
+`GET /metrics` serves, in the Prometheus text format:
+
+- `trilogy_phase_seconds{endpoint,dialect,phase}`: how long each timed phase
+  of a task took. Phases are `env_setup`, `imports`, `fork`, `parse`,
+  `columns`, `filters`, `generation` and `compile`
+- `trilogy_task_queue_seconds{endpoint}` and `trilogy_task_run_seconds{endpoint}`:
+  time pooled tasks waited for a thread or worker, and then ran
+- `trilogy_pool_*`: tasks queued and in flight, and task counters
+- `trilogy_cache_<stat>_total{cache,process}` and
+  `trilogy_cache_<stat>{cache,process}`: the stats of each cache, from the
+  server process and from each worker process. Running counts such as hits
+  and evictions are counters; sizes and limits are gauges
+
+Tasks call `observe_phase` wherever they run. The pool carries what a task
+observed, and the stats of the caches in its process, back with the result
+and adds them to the server's registry, so process-mode work is counted too.
+
+Under gunicorn every server process has its own registry. With
+`TRILOGY_METRICS_DIR` set, each process writes a snapshot of its registry
+there every `TRILOGY_METRICS_FLUSH_SECONDS` (default 5), and `/metrics` adds
+up the snapshots of every live process, so whichever process answers a scrape
+reports for all of them. A snapshot is dropped once the process that wrote it
+has exited, or when it has not been refreshed for three flush intervals, so
+the gauges of a stopped worker stop counting. The directory is meant for the
+processes of one host.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from tracing import Span
+
+logger = getLogger(__name__)
+
+# seconds; editor requests sit in the low buckets, cold model parses in the
+# high ones
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+DEFAULT_FLUSH_SECONDS = 5.0
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PHASE_SECONDS = "trilogy_phase_seconds"
+TASK_QUEUE_SECONDS = "trilogy_task_queue_seconds"
+TASK_RUN_SECONDS = "trilogy_task_run_seconds"
+
+# cache stats that are a level or a limit; every other cache stat only grows
+CACHE_GAUGES = frozenset(
+    {
+        "size",
+        "entries",
+        "size_bytes",
+        "statements",
+        "states",
+        "in_flight",
+        "max_entries",
+        "max_bytes",
+        "max_statements",
+        "max_states",
+        "max_sessions",
+    }
+)
+
+_HELP = {
+    PHASE_SECONDS: "Time spent in each phase of a task",
+    TASK_QUEUE_SECONDS: "Time pooled tasks waited for a thread or worker",
+    TASK_RUN_SECONDS: "Time pooled tasks ran",
+}
+
+
+class Sample(NamedTuple):
+    name: str
+    # "gauge" or "counter"
+    kind: str
+    help: str
+    labels: dict[str, str]
+    value: float
+
+
+@dataclass
+class TaskReport:
+    """What a task measured while it ran, wherever that was."""
+
+    phases: list[tuple[str, float]] = field(default_factory=list)
+    labels: dict[str, str] = field(default_factory=dict)
+    # cache name -> numeric stats, taken when the task finished
+    caches: dict[str, dict[str, float]] = field(default_factory=dict)
+    # finished spans, when tracing is on
+    spans: list["Span"] = field(default_factory=list)
+    # "server", or "worker-<slot>" for a process task; set by the pool
+    process: str = "server"
+
+
+_current_report: ContextVar[TaskReport | None] = ContextVar(
+    "trilogy_task_report", default=None
+)
+# cache name -> its stats() method, in every process that imports the cache
+_CACHE_STATS: dict[str, Callable[[], object]] = {}
+
+
+def current_report() -> TaskReport | None:
+    return _current_report.get()
+
+
+def observe_phase(phase: str, seconds: float) -> None:
+    """Record a phase of the running task; a no-op outside one."""
+    report = _current_report.get()
+    if report is not None:
+        report.phases.append((phase, seconds))
+
+
+def label_task(**labels: str) -> None:
+    """Label the running task's phases, e.g. with its dialect."""
+    report = _current_report.get()
+    if report is not None:
+        report.labels.update(labels)
+
+
+def register_cache_stats(name: str, stats: Callable[[], object]) -> None:
+    """Report `stats()` (a dataclass of numbers) as `trilogy_cache_*`."""
+    _CACHE_STATS[name] = stats
+
+
+def cache_stats() -> dict[str, dict[str, float]]:
+    return {
+        name: {
+            key: value
+            for key, value in vars(stats()).items()
+            if isinstance(value, (int, float))
+        }
+        for name, stats in _CACHE_STATS.items()
+    }
+
+
+@contextmanager
+def task_report() -> Iterator[TaskReport]:
+    """Collect what the task run inside the block observes."""
+    report = TaskReport()
+    reset = _current_report.set(report)
+    try:
+        yield report
+    finally:
+        _current_report.reset(reset)
+        report.caches = cache_stats()
+
+
+# labels as a sorted tuple of pairs, so series can key dicts and survive JSON
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + pairs + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _process_alive(stem: str) -> bool:
+    """Whether the process that wrote snapshot `<stem>.json` still runs."""
+    if not stem.isdigit():
+        return False
+    if os.name != "posix":
+        # os.kill would terminate the process; rely on the snapshot's age
+        return True
+    try:
+        os.kill(int(stem), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsRegistry:
+    def __init__(
+        self,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        directory: Path | None = None,
+        flush_seconds: float = DEFAULT_FLUSH_SECONDS,
+    ):
+        self.buckets = buckets
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        # name -> labels -> [count per bucket..., count above the last, sum]
+        self._histograms: dict[str, dict[Labels, list[float]]] = {}
+        # process -> cache name -> stats, the latest each process reported
+        self._caches: dict[str, dict[str, dict[str, float]]] = {}
+        # name -> callable returning samples read at scrape time
+        self._collectors: dict[str, Callable[[], Iterable[Sample]]] = {}
+        self._flusher: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> "MetricsRegistry":
+        directory = os.environ.get("TRILOGY_METRICS_DIR")
+        return cls(
+            directory=Path(directory) if directory else None,
+            flush_seconds=float(
+                os.environ.get("TRILOGY_METRICS_FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS)
+            ),
+        )
+
+    def observe(self, name: str, labels: dict[str, str], value: float) -> None:
+        """Add `value` to histogram `name`."""
+        index = _bucket_index(self.buckets, value)
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0.0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+        self._ensure_flusher()
+
+    def record_task(
+        self, endpoint: str, queued: float, run_time: float, report: TaskReport
+    ) -> None:
+        labels = {"endpoint": endpoint}
+        self.observe(TASK_QUEUE_SECONDS, labels, queued)
+        self.observe(TASK_RUN_SECONDS, labels, run_time)
+        phase_labels = {"dialect": "", **report.labels, "endpoint": endpoint}
+        for phase, seconds in report.phases:
+            self.observe(PHASE_SECONDS, {**phase_labels, "phase": phase}, seconds)
+        if report.process != "server":
+            with self._lock:
+                self._caches[report.process] = report.caches
+
+    def add_collector(self, name: str, collect: Callable[[], Iterable[Sample]]) -> None:
+        """Read `collect()` at every scrape; replaces a collector of that name."""
+        with self._lock:
+            self._collectors[name] = collect
+
+    def histogram(self, name: str, labels: dict[str, str]) -> tuple[int, float]:
+        """Observation count and sum of one histogram series."""
+        with self._lock:
+            counts = self._histograms.get(name, {}).get(_labels(labels))
+        if counts is None:
+            return 0, 0.0
+        return int(sum(counts[:-1])), counts[-1]
+
+    def snapshot(self) -> dict:
+        """Everything this process would report, as JSON-able families."""
+        families: dict[str, dict] = {}
+        with self._lock:
+            for name, series in self._histograms.items():
+                families[name] = {
+                    "type": "histogram",
+                    "help": _HELP.get(name, name),
+                    "series": [
+                        [list(key), list(counts)] for key, counts in series.items()
+                    ],
+                }
+            caches = {process: dict(stats) for process, stats in self._caches.items()}
+            collectors = list(self._collectors.values())
+        samples: list[Sample] = []
+        for collect in collectors:
+            samples.extend(collect())
+        caches["server"] = cache_stats()
+        for process, by_cache in caches.items():
+            for cache, stats in by_cache.items():
+                for stat, value in stats.items():
+                    samples.append(_cache_sample(cache, process, stat, value))
+        for sample in samples:
+            family = families.setdefault(
+                sample.name,
+                {"type": sample.kind, "help": sample.help, "series": []},
+            )
+            family["series"].append([list(_labels(sample.labels)), sample.value])
+        return {"buckets": list(self.buckets), "families": families}
+
+    def render(self) -> str:
+        """The Prometheus text exposition of this process, plus every live
+        sibling process when a metrics directory is set."""
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            snapshots.extend(self._sibling_snapshots())
+        return _render(self.buckets, _merge(self.buckets, snapshots))
+
+    def flush(self) -> None:
+        """Write this process's snapshot to the metrics directory."""
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{os.getpid()}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.snapshot()))
+        os.replace(tmp, path)
+
+    def _ensure_flusher(self) -> None:
+        # started on first use, so each forked server process gets its own
+        if (
+            self.directory is None
+            or self._flusher is not None
+            or self._stopped.is_set()
+        ):
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_forever, name="metrics-flush", daemon=True
+            )
+        self._flusher.start()
+
+    def shutdown(self) -> None:
+        """Stop flushing and withdraw this process's snapshot."""
+        self._stopped.set()
+        if self.directory is not None:
+            (self.directory / f"{os.getpid()}.json").unlink(missing_ok=True)
+
+    def _flush_forever(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.flush()
+            except OSError:
+                logger.warning("Could not write metrics snapshot", exc_info=True)
+            self._stopped.wait(self.flush_seconds)
+
+    def _sibling_snapshots(self) -> list[dict]:
+        assert self.directory is not None
+        snapshots = []
+        stale_before = time.time() - 3 * self.flush_seconds
+        for path in self.directory.glob("*.json"):
+            if path.stem == str(os.getpid()):
+                continue
+            try:
+                stale = path.stat().st_mtime < stale_before
+                if stale or not _process_alive(path.stem):
+                    # the process is gone, or stuck; either way not reporting
+                    path.unlink(missing_ok=True)
+                    continue
+                snapshot = json.loads(path.read_text())
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if snapshot.get("buckets") == list(self.buckets):
+                snapshots.append(snapshot)
+        return snapshots
+
+
+def _bucket_index(buckets: tuple[float, ...], value: float) -> int:
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            return index
+    return len(buckets)
+
+
+def _merge(buckets: tuple[float, ...], snapshots: list[dict]) -> dict[str, dict]:
+    """Sum the series of several snapshots, label set by label set."""
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, family in snapshot["families"].items():
+            target = merged.setdefault(
+                name, {"type": family["type"], "help": family["help"], "series": {}}
+            )
+            for labels, value in family["series"]:
+                key = tuple(tuple(pair) for pair in labels)
+                current = target["series"].get(key)
+                if current is None:
+                    target["series"][key] = (
+                        list(value) if isinstance(value, list) else value
+                    )
+                elif isinstance(current, list):
+                    for index, count in enumerate(value):
+                        current[index] += count
+                else:
+                    target["series"][key] = current + value
+    return merged
+
+
+def _cache_sample(cache: str, process: str, stat: str, value: float) -> Sample:
+    labels = {"cache": cache, "process": process}
+    if stat in CACHE_GAUGES:
+        return Sample(f"trilogy_cache_{stat}", "gauge", f"Cache {stat}", labels, value)
+    return Sample(
+        f"trilogy_cache_{stat}_total", "counter", f"Cache {stat} so far", labels, value
+    )
+
+
+def _render(buckets: tuple[float, ...], families: dict[str, dict]) -> str:
+    lines: list[str] = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labels, value in sorted(family["series"].items()):
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0.0
+            for bound, count in zip((*buckets, math.inf), value[:-1]):
+                cumulative += count
+                bucket_labels = (*labels, ("le", _format_value(bound)))
+                lines.append(
+                    f"{name}_bucket{_format_labels(bucket_labels)} {int(cumulative)}"
+                )
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]!r}")
+            lines.append(f"{name}_count{_format_labels(labels)} {int(cumulative)}")
+    return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry.from_env()
@@ -0,0 +1,332 @@
+"""Server-side model sessions.
+
+Editor requests used to carry the whole `full_model` on every keystroke. A
+client can instead register the model once (`POST /models`), send only the
+returned `model_id` with each request, and push single-source deltas as files
+change.
+
+Sessions have to be visible to every server process (gunicorn runs several
+and does not route a client to the same one), so each session is a JSON file
+in a shared directory. Each process keeps an LRU of the sessions it has read
+and reloads an entry when the file's mtime changes. A session expires once
+it has been idle for the TTL. Registering a model also removes the oldest
+sessions beyond the size limit.
+
+The directory is private to the server's user (mode 0700). An update holds
+an exclusive lock on the directory's `.lock` file while it reads, merges and
+writes the session, so concurrent deltas from different processes apply one
+after the other instead of the last write dropping the rest. A delta can
+also name the `content_hash` it was made against, and is refused with
+`StaleModelSession` once the session has moved on.
+
+Settings come from the environment:
+
+- `TRILOGY_MODEL_SESSION_DIR`: where sessions are stored (default
+  `<tmp>/trilogy-model-sessions`)
+- `TRILOGY_MODEL_SESSIONS_MAX`: sessions kept, per process in memory and on
+  disk (default 256)
+- `TRILOGY_MODEL_SESSION_TTL`: idle seconds before a session expires
+  (default 3600)
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from env_cache import model_cache_key
+from io_models import ModelInSchema, ModelSourceInSchema
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the server runs as a single process
+    fcntl = None  # type: ignore[assignment]
+
+DEFAULT_MAX_SESSIONS = 256
+DEFAULT_SESSION_TTL = 3600.0
+DIRECTORY_MODE = 0o700
+
+
+def default_session_dir() -> Path:
+    return Path(tempfile.gettempdir()) / "trilogy-model-sessions"
+
+
+def _file_version(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+@dataclass(frozen=True)
+class ModelSession:
+    model_id: str
+    model: ModelInSchema
+    # equals `model_cache_key(model.sources)`, so it keys the warm caches too
+    content_hash: str
+
+
+class StaleModelSession(RuntimeError):
+    """An update made against a `content_hash` the session no longer has."""
+
+    def __init__(self, model_id: str, content_hash: str):
+        super().__init__(
+            f"Model session {model_id!r} has changed since; its content_hash "
+            f"is now {content_hash!r}"
+        )
+        self.content_hash = content_hash
+
+
+@dataclass
+class ModelSessionStats:
+    registered: int = 0
+    updates: int = 0
+    hits: int = 0
+    reloads: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    size: int = 0
+    max_sessions: int = 0
+
+
+class ModelSessionStore:
+    """Sessions on disk, with a per-process LRU of parsed models in front."""
+
+    def __init__(
+        self,
+        directory: Path | None = None,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl_seconds: float = DEFAULT_SESSION_TTL,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.directory = directory or default_session_dir()
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        # model_id -> (file (mtime_ns, size) when read, session)
+        self._entries: OrderedDict[str, tuple[tuple[int, int], ModelSession]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        # serializes updates in this process; `.lock` does across processes
+        self._update_lock = threading.Lock()
+        self._registered = 0
+        self._updates = 0
+        self._hits = 0
+        self._reloads = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @classmethod
+    def from_env(cls) -> "ModelSessionStore":
+        directory = os.environ.get("TRILOGY_MODEL_SESSION_DIR")
+        return cls(
+            directory=Path(directory) if directory else None,
+            max_sessions=int(
+                os.environ.get("TRILOGY_MODEL_SESSIONS_MAX", DEFAULT_MAX_SESSIONS)
+            ),
+            ttl_seconds=float(
+                os.environ.get("TRILOGY_MODEL_SESSION_TTL", DEFAULT_SESSION_TTL)
+            ),
+        )
+
+    def register(self, model: ModelInSchema) -> ModelSession:
+        session = self._write(uuid.uuid4().hex, model)
+        with self._lock:
+            self._registered += 1
+        self._sweep()
+        return session
+
+    def get(self, model_id: str) -> ModelSession | None:
+        path = self._path(model_id)
+        if path is None:
+            return None
+        try:
+            version = _file_version(path)
+        except FileNotFoundError:
+            self._miss(model_id)
+            return None
+        now = self._clock()
+        idle = now - version[0] / 1e9
+        if idle > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            with self._lock:
+                self._expirations += 1
+            self._miss(model_id)
+            return None
+        with self._lock:
+            cached = self._entries.get(model_id)
+            if cached is not None and cached[0] == version:
+                self._entries.move_to_end(model_id)
+                self._hits += 1
+                session = cached[1]
+            else:
+                session = None
+        if session is None:
+            try:
+                model = ModelInSchema.model_validate_json(path.read_bytes())
+            except FileNotFoundError:
+                self._miss(model_id)
+                return None
+            session = ModelSession(model_id, model, model_cache_key(model.sources))
+            with self._lock:
+                self._reloads += 1
+        if idle > self.ttl_seconds / 2:
+            # refresh the idle clock; other processes reload on the new mtime
+            os.utime(path, (now, now))
+            version = _file_version(path)
+        self._remember(model_id, version, session)
+        return session
+
+    def update(
+        self,
+        model_id: str,
+        sources: list[ModelSourceInSchema],
+        removed: list[str] | None = None,
+        expected_hash: str | None = None,
+    ) -> ModelSession | None:
+        """Replace or add `sources` by alias and drop the `removed` aliases.
+
+        Raises StaleModelSession when `expected_hash` is given and is no
+        longer the session's `content_hash`."""
+        with self._exclusive():
+            # merge into what is on disk: two writes within one tick of a
+            # coarse mtime can leave the cached version looking current
+            with self._lock:
+                self._entries.pop(model_id, None)
+            session = self.get(model_id)
+            if session is None:
+                return None
+            if expected_hash is not None and expected_hash != session.content_hash:
+                raise StaleModelSession(model_id, session.content_hash)
+            changed = {source.alias: source for source in sources}
+            dropped = set(removed or [])
+            merged = [
+                changed.pop(source.alias, source)
+                for source in session.model.sources
+                if source.alias not in dropped
+            ]
+            merged.extend(changed.values())
+            updated = self._write(
+                model_id, ModelInSchema(name=session.model.name, sources=merged)
+            )
+        with self._lock:
+            self._updates += 1
+        return updated
+
+    def delete(self, model_id: str) -> bool:
+        path = self._path(model_id)
+        with self._lock:
+            self._entries.pop(model_id, None)
+        if path is None or not path.exists():
+            return False
+        # under the update lock, so an update in flight cannot write it back
+        with self._exclusive():
+            path.unlink(missing_ok=True)
+        return True
+
+    def stats(self) -> ModelSessionStats:
+        with self._lock:
+            return ModelSessionStats(
+                registered=self._registered,
+                updates=self._updates,
+                hits=self._hits,
+                reloads=self._reloads,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                size=len(self._entries),
+                max_sessions=self.max_sessions,
+            )
+
+    def _path(self, model_id: str) -> Path | None:
+        # ids are uuid4 hex; anything else cannot name a session file
+        if len(model_id) != 32 or not model_id.isalnum():
+            return None
+        return self.directory / f"{model_id}.json"
+
+    def _ensure_directory(self) -> None:
+        self.directory.mkdir(mode=DIRECTORY_MODE, parents=True, exist_ok=True)
+        if not hasattr(os, "getuid"):
+            return
+        # the default directory is in the shared temp dir, where another user
+        # could have created it first
+        stat = self.directory.stat()
+        if stat.st_uid != os.getuid():
+            raise PermissionError(
+                f"{self.directory} belongs to another user; set "
+                "TRILOGY_MODEL_SESSION_DIR to a directory of your own"
+            )
+        if stat.st_mode & 0o777 != DIRECTORY_MODE:
+            os.chmod(self.directory, DIRECTORY_MODE)
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """The update lock of this process and, where there is `fcntl`, of
+        every process sharing the directory."""
+        with self._update_lock:
+            if fcntl is None:
+                yield
+                return
+            self._ensure_directory()
+            with open(self.directory / ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, model_id: str, model: ModelInSchema) -> ModelSession:
+        path = self._path(model_id)
+        assert path is not None
+        self._ensure_directory()
+        # write-then-rename, so readers never see a partial file
+        tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(model.model_dump_json().encode("utf-8"))
+        os.replace(tmp, path)
+        session = ModelSession(model_id, model, model_cache_key(model.sources))
+        self._remember(model_id, _file_version(path), session)
+        return session
+
+    def _remember(
+        self, model_id: str, version: tuple[int, int], session: ModelSession
+    ) -> None:
+        with self._lock:
+            self._entries[model_id] = (version, session)
+            self._entries.move_to_end(model_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def _miss(self, model_id: str) -> None:
+        with self._lock:
+            self._entries.pop(model_id, None)
+            self._misses += 1
+
+    def _sweep(self) -> None:
+        """Drop expired sessions, then the least recently used beyond the
+        size limit."""
+        now = self._clock()
+        live: list[tuple[float, Path]] = []
+        for path in self.directory.glob("*.json"):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if now - mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                with self._lock:
+                    self._expirations += 1
+            else:
+                live.append((mtime, path))
+        live.sort()
+        for _, path in live[: max(0, len(live) - self.max_sessions)]:
+            path.unlink(missing_ok=True)
+            with self._lock:
+                self._entries.pop(path.stem, None)
+                self._evictions += 1
@@ -0,0 +1,119 @@
+"""Sampling profiler for a live server.
+
+`sample_stacks` reads every thread's Python stack at a fixed rate, and counts
+each distinct stack. It needs no instrumentation and no restart, and costs
+nothing while it is not running. Stacks are folded, root first, into the
+`frame;frame;frame count` lines that flamegraph.pl, speedscope and inferno
+read.
+
+Worker processes are sampled by a thread of their own. `TaskPool` gives each
+worker one end of a pipe when it starts the worker, and the thread waits on
+it for a `ProfileRequest`. It samples its process for the requested time and
+sends the stacks back.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Mapping
+from dataclasses import dataclass
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# (file name, function) of the innermost frame of a thread with nothing to
+# do: pool threads and worker processes waiting for a task, the event loop
+# waiting on its selector, and threads waiting on a lock or event
+IDLE_FRAMES = frozenset(
+    {
+        ("thread.py", "_worker"),
+        ("connection.py", "_recv"),
+        ("connection.py", "_poll"),
+        ("connection.py", "wait"),
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+    }
+)
+
+
+@dataclass
+class ProfileRequest:
+    seconds: float
+    interval: float
+    include_idle: bool = False
+    line_numbers: bool = False
+    # echoed in the reply, so a worker's answer to an abandoned request is
+    # never mistaken for the current one
+    request_id: int = 0
+
+
+def fold_stack(frame, line_numbers: bool = True) -> str:
+    """`frame` and its callers as `outer;...;inner`."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        location = (
+            f"{code.co_filename}:{frame.f_lineno}" if line_numbers else code.co_filename
+        )
+        names.append(f"{code.co_name} ({location})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+
+def sample_stacks(request: ProfileRequest) -> Counter[str]:
+    """Sample every other thread of this process for `request.seconds`,
+    each stack prefixed with its thread's name."""
+    own = threading.get_ident()
+    stacks: Counter[str] = Counter()
+    next_sample = time.perf_counter()
+    deadline = next_sample + request.seconds
+    while True:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (not request.include_idle and _is_idle(frame)):
+                continue
+            thread = names.get(ident, str(ident))
+            stacks[f"{thread};{fold_stack(frame, request.line_numbers)}"] += 1
+        next_sample += request.interval
+        if next_sample > deadline:
+            return stacks
+        time.sleep(max(0.0, next_sample - time.perf_counter()))
+
+
+def _serve_profile_requests(connection) -> None:
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            # the server closed its end of the pipe
+            return
+        stacks = sample_stacks(request)
+        connection.send((request.request_id, dict(stacks)))
+
+
+def start_profile_listener(connection) -> None:
+    """Called once in each worker process with its end of the profile pipe."""
+    threading.Thread(
+        target=_serve_profile_requests,
+        args=(connection,),
+        name="profile-listener",
+        daemon=True,
+    ).start()
+
+
+def render_folded(stacks_by_process: Mapping[str, Mapping[str, int]]) -> str:
+    """Folded stacks of several processes, each rooted at its process name."""
+    lines = [
+        f"{process};{stack} {count}"
+        for process, stacks in stacks_by_process.items()
+        for stack, count in stacks.items()
+    ]
+    return "".join(line + "\n" for line in sorted(lines))
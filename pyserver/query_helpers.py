@@ -1,5 +1,7 @@
 import re
 import time
+import traceback
+from dataclasses import dataclass
 from logging import getLogger
 
 from trilogy import Environment
@@ -40,10 +42,12 @@ from trilogy.dialect.metadata import (
 )
 from trilogy.parser import parse_text
 
+from cancellation import check_cancelled
+from env_cache import ENV_CACHE
 from env_helpers import (
+    fork_environment,
+    imports_to_strings,
     normalize_relative_imports,
-    parse_env_from_full_model,
-    resolve_import_path,
 )
 from io_models import (
     ChartLayerOut,
@@ -54,7 +58,7 @@ from io_models import (
     QueryOut,
     QueryOutColumn,
 )
-from utility import safe_percentage
+from tracing import phase, span
 
 perf_logger = getLogger("trilogy.performance")
 
@@ -103,7 +107,18 @@ _CONCEPT_PARAM_RE = re.compile(
 )
 
 
-def _trilogy_type_for(value: str | float) -> str:
+def normalize_date_param(value: str | float) -> str | float:
+    """Trim an ISO timestamp to 'YYYY-MM-DD' for a date parameter.
+
+    Luxon DateTime serialises as a full ISO timestamp ('1992-12-20T22:19:57.462Z')
+    but set_parameters only accepts 'YYYY-MM-DD' for date parameters.
+    """
+    if isinstance(value, str) and _DATE_RE.match(value[:10]):
+        return value[:10]
+    return value
+
+
+def trilogy_type_for(value: str | float) -> str:
     """Infer a Trilogy parameter type from a scalar value."""
     if isinstance(value, str):
         if _DATE_RE.match(value):
@@ -173,13 +188,10 @@ def prepare_filter_params(
         # fall back to inference from the value string.
         param_type = (
             _concept_type_for_param(name, stripped_filters, env) if env else None
-        ) or _trilogy_type_for(value)
+        ) or trilogy_type_for(value)
         param_declarations += f"\nparameter {name} {param_type};"
-        # Normalize value to match the declared type — e.g. Luxon DateTime
-        # serialises as a full ISO timestamp ('1992-12-20T22:19:57.462Z') but
-        # set_parameters only accepts 'YYYY-MM-DD' for date parameters.
-        if param_type == "date" and isinstance(value, str):
-            value = _DATE_RE.match(value[:10]) and value[:10] or value
+        if param_type == "date":
+            value = normalize_date_param(value)
         param_kwargs[name] = value
 
     cleaned: list[str] = []
@@ -247,10 +259,8 @@ def generate_single_query(
     dialect: BaseDialect,
     extra_filters: list[str] | None = None,
     parameters: dict[str, str | int | float] | None = None,
-    enable_performance_logging: bool = True,
     extra_conditional: WhereClause | None = None,
     base_filter_idx: int = 0,
-    cleanup_concepts: bool = False,
 ) -> tuple[
     PROCESSED_STATEMENT_TYPES | None,
     list[QueryOutColumn],
@@ -260,19 +270,13 @@ def generate_single_query(
     # is an independent select the client has to resolve fields against.
     list[list[QueryOutColumn]] | None,
 ]:
-    start_time = time.time()
-
     # Parse the query
-    parse_start = time.time()
-
-    # this is pretty hacky
-    # TODO: better job
-    if cleanup_concepts:
-        pre_concepts = {k: v for k, v in env.concepts.items() if v.name in query}
-    else:
-        pre_concepts = {}
-    env, parsed = parse_text(safe_format_query(query), env, parse_config=PARSE_CONFIG)
-    parse_time = time.time() - parse_start
+    with phase("parse", query_chars=len(query)) as parse_span:
+        env, parsed = parse_text(
+            safe_format_query(query), env, parse_config=PARSE_CONFIG
+        )
+        parse_span.set(statement_count=len(parsed))
+    check_cancelled()
     default_return: list[QueryOutColumn] = []
     default_values: list[dict] | None = None
     # A chart statement counts once no matter how many layers it holds: it is
@@ -290,10 +294,6 @@ def generate_single_query(
     # than a blank result for the trailing comment.
     meaningful = [s for s in parsed if not isinstance(s, Comment)]
     if not meaningful:
-        if enable_performance_logging:
-            perf_logger.debug(
-                f"No parsed statements (empty query) - Parse time: {parse_time:.4f}s"
-            )
         return None, default_return, default_values, 0, None
 
     final = meaningful[-1]
@@ -301,12 +301,6 @@ def generate_single_query(
 
     # Handle different statement types
     if isinstance(final, RawSQLStatement):
-        if enable_performance_logging:
-            total_time = time.time() - start_time
-            perf_logger.debug(
-                f"Raw SQL generation - Total: {total_time:.4f}s | "
-                f"Parse: {parse_time:.4f}s | "
-            )
         return (
             ProcessedRawSQLStatement(text=final.text),
             default_return,
@@ -368,12 +362,6 @@ def generate_single_query(
         (SelectStatement, MultiSelectStatement, PersistStatement, ChartStatement),
     ):
         columns: list[QueryOutColumn] = []
-        if enable_performance_logging:
-            total_time = time.time() - start_time
-            perf_logger.debug(
-                f"Non-query generation - Total: {total_time:.4f}s | "
-                f"Parse: {parse_time:.4f}s | "
-            )
         return None, columns, None, select_count, None
 
     # A chart statement is a bundle of selects, one per layer. Everything below
@@ -397,72 +385,45 @@ def generate_single_query(
             else [final_select]
         )
     # Process columns
-    col_start = time.time()
-    columns = _select_to_columns(final_select, env)
-    # Every chart layer is its own select over its own grain, so the client
-    # needs a column map per layer to resolve field types, format hints and
-    # colour scales. Built here, before `cleanup_concepts` sweeps the
-    # locally-derived `<- expr as name` bindings back out of the environment.
-    layer_columns: list[list[QueryOutColumn]] | None = (
-        [_select_to_columns(select, env) for select in candidates]
-        if isinstance(final, ChartStatement)
-        else None
-    )
-    col_time = time.time() - col_start
+    with phase("columns") as columns_span:
+        columns = _select_to_columns(final_select, env)
+        # Every chart layer is its own select over its own grain, so the client
+        # needs a column map per layer to resolve field types, format hints and
+        # colour scales.
+        layer_columns: list[list[QueryOutColumn]] | None = (
+            [_select_to_columns(select, env) for select in candidates]
+            if isinstance(final, ChartStatement)
+            else None
+        )
+        columns_span.set(column_count=len(columns))
 
     # Set limits and process filters
-    limit_filter_start = time.time()
-
-    # `where_clause` is derived (the AND fold of `where_clauses`) and memoized
-    # on the stage list's identity, so extra filters are added by replacing the
-    # list with an extended copy - never by mutating the fold or the list.
-    if extra_filters:
-        conditional = filters_to_conditional(
-            extra_filters, variables, env, base_filter_idx=base_filter_idx
-        )
-        if conditional:
+    with phase("filters", filter_count=len(extra_filters or ())):
+        # `where_clause` is derived (the AND fold of `where_clauses`) and
+        # memoized on the stage list's identity, so extra filters are added by
+        # replacing the list with an extended copy - never by mutating the fold
+        # or the list.
+        if extra_filters:
+            conditional = filters_to_conditional(
+                extra_filters, variables, env, base_filter_idx=base_filter_idx
+            )
+            if conditional:
+                for candidate in candidates:
+                    candidate.where_clauses = [*candidate.where_clauses, conditional]
+        if extra_conditional:
             for candidate in candidates:
-                candidate.where_clauses = [*candidate.where_clauses, conditional]
-    if extra_conditional:
-        for candidate in candidates:
-            candidate.where_clauses = [*candidate.where_clauses, extra_conditional]
-
-    limit_filter_time = time.time() - limit_filter_start
+                candidate.where_clauses = [*candidate.where_clauses, extra_conditional]
+    check_cancelled()
 
     # Generate the final query
-    gen_start = time.time()
-    output_statement = dialect.generate_queries(env, [final])[-1]
-    gen_time = time.time() - gen_start
-
-    if enable_performance_logging:
-        total_time = time.time() - start_time
-        perf_logger.info(
-            f"Query generation details - Total: {total_time:.4f}s | "
-            f"Parse: {parse_time:.4f}s ({safe_percentage(parse_time, total_time):.1f}%) | "
-            f"Columns: {col_time:.4f}s ({safe_percentage(col_time, total_time):.1f}%) | "
-            f"Filters: {limit_filter_time:.4f}s ({safe_percentage(limit_filter_time, total_time):.1f}%) | "
-            f"Generation: {gen_time:.4f}s ({safe_percentage(gen_time, total_time):.1f}%)"
-        )
-    if cleanup_concepts:
-        # A chart derives concepts in every layer select (each `<- expr as name`
-        # binding), so all of them have to be swept, not just the first.
-        cleanup_targets: list[SelectStatement | MultiSelectStatement] = (
-            list(candidates) if isinstance(final, ChartStatement) else [final_select]
-        )
-        for cleanup_target in cleanup_targets:
-            for k in cleanup_target.locally_derived:
-                perf_logger.info(f"Cleaning up concept: {k}")
-                env.remove_concept(k)
-                if k in pre_concepts:
-                    env.add_concept(pre_concepts[k], force=True)
-                    # env.concepts[k] = pre_concepts[k]
+    with phase("generation"):
+        output_statement = dialect.generate_queries(env, [final])[-1]
     return output_statement, columns, default_values, select_count, layer_columns
 
 
 def generate_query_core(
     query: QueryInSchema,
     dialect: BaseDialect,
-    enable_performance_logging: bool = True,
 ) -> tuple[
     PROCESSED_STATEMENT_TYPES | None,
     list[QueryOutColumn],
@@ -472,40 +433,30 @@ def generate_query_core(
     # is an independent select the client has to resolve fields against.
     list[list[QueryOutColumn]] | None,
 ]:
-    if enable_performance_logging:
-        start_time = time.time()
-        env_start = time.time()
-
-    # Environment setup
-    env = parse_env_from_full_model(
-        query.full_model.sources,
-        files=query.files,
-        working_path=query.working_path,
-    )
-
-    if enable_performance_logging:
-        env_time = time.time() - env_start
-        import_start = time.time()
-
     normalized_query = normalize_relative_imports(query.query, query.current_filename)
 
-    # Process imports
-    import_strings = []
-    for imp in query.imports:
-        normalized_import_name = resolve_import_path(imp.name, query.current_filename)
-        if imp.alias:
-            imp_string = f"import {normalized_import_name} as {imp.alias};"
-        else:
-            imp_string = f"import {normalized_import_name};"
-        import_strings.append(imp_string)
+    import_strings = imports_to_strings(query.imports, query.current_filename)
 
-    if import_strings:
-        full_imp_string = "\n".join(import_strings)
-        parse_text(full_imp_string, env, parse_config=PARSE_CONFIG)
+    # Environment setup; the model and its imports are parsed once and reused
+    # across requests, each of which works on its own fork
+    sources = query.full_model.sources
+    with phase("env_setup", source_count=len(sources)) as env_span:
+        parsed_model = ENV_CACHE.get_parsed_model(
+            sources,
+            import_strings,
+            files=query.files,
+            working_path=query.working_path,
+            parse_config=PARSE_CONFIG,
+        )
+        if env_span.recording:
+            env_span.set(
+                model_chars=sum(len(source.text) for source in sources),
+                concept_count=len(parsed_model.environment.concepts),
+            )
+    check_cancelled()
 
-    if enable_performance_logging:
-        import_time = time.time() - import_start
-        gen_start = time.time()
+    with phase("fork"):
+        env = parsed_model.fork()
 
     # Generate query
     target, columns, results, select_count, layer_columns = generate_single_query(
@@ -516,24 +467,88 @@ def generate_query_core(
         query.parameters,
     )
 
-    if enable_performance_logging:
-        gen_time = time.time() - gen_start
-        total_time = time.time() - start_time
-        perf_logger.info(
-            f"Query core timing - Total: {total_time:.4f}s | "
-            f"Env setup: {env_time:.4f}s ({safe_percentage(env_time, total_time):.1f}%) | "
-            f"Imports: {import_time:.4f}s ({safe_percentage(import_time, total_time):.1f}%) | "
-            f"Generation: {gen_time:.4f}s ({safe_percentage(gen_time, total_time):.1f}%)"
+    return target, columns, results, select_count, layer_columns
+
+
+@dataclass
+class MultiQueryItem:
+    """One planned sub-query of a multi-query request, in request order."""
+
+    label: str | None
+    target: PROCESSED_STATEMENT_TYPES | Exception | None
+    columns: list[QueryOutColumn]
+    values: list[dict] | None
+    layer_columns: list[list[QueryOutColumn]] | None
+    elapsed: float = 0.0
+
+
+def multi_query_base_env(
+    query: MultiQueryInSchema,
+) -> tuple[Environment, WhereClause | None]:
+    """The imported model with the request-wide extra filters applied, and
+    the filter clause to add to every sub-query.
+
+    Sub-queries each plan on a fork of this environment, so nothing one of
+    them adds (or leaves behind when it fails) is seen by the others.
+    """
+    with phase("env_setup", source_count=len(query.full_model.sources)):
+        env = ENV_CACHE.get_environment(
+            query.full_model.sources,
+            imports_to_strings(query.imports),
+            files=query.files,
+            working_path=query.working_path,
+            parse_config=PARSE_CONFIG,
         )
+    conditional = None
+    if query.extra_filters:
+        conditional = filters_to_conditional(
+            query.extra_filters, query.parameters or {}, env
+        )
+    return env, conditional
 
-    return target, columns, results, select_count, layer_columns
+
+def plan_multi_query_items(
+    query: MultiQueryInSchema,
+    dialect: BaseDialect,
+    indices: list[int] | None = None,
+    base: tuple[Environment, WhereClause | None] | None = None,
+) -> list[MultiQueryItem]:
+    """Plan the sub-queries at `indices` (default: all), each on its own fork
+    of the `multi_query_base_env` environment, timing each one. Errors are
+    captured per item."""
+    base_env, conditional = base or multi_query_base_env(query)
+    items: list[MultiQueryItem] = []
+    for idx in range(len(query.queries)) if indices is None else indices:
+        check_cancelled()
+        subquery = query.queries[idx]
+        item_start = time.perf_counter()
+        with span("sub_query", index=idx):
+            try:
+                generated, columns, values, _, layer_columns = generate_single_query(
+                    subquery.query,
+                    fork_environment(base_env),
+                    dialect,
+                    extra_filters=subquery.extra_filters,
+                    parameters=subquery.parameters,
+                    extra_conditional=conditional,
+                    base_filter_idx=idx,
+                )
+                items.append(
+                    MultiQueryItem(
+                        subquery.label, generated, columns, values, layer_columns
+                    )
+                )
+            except Exception as e:  # noqa: BLE001 -- isolate failure to this batch item
+                perf_logger.error(f"Error generating query '{subquery.query}': {e}")
+                perf_logger.error(traceback.format_exc())
+                items.append(MultiQueryItem(subquery.label, e, [], None, None))
+        items[-1].elapsed = time.perf_counter() - item_start
+    return items
 
 
 def generate_multi_query_core(
     query: MultiQueryInSchema,
     dialect: BaseDialect,
-    enable_performance_logging: bool = True,
-    cleanup_concepts: bool = True,
 ) -> list[
     tuple[
         str | None,
@@ -543,90 +558,13 @@ def generate_multi_query_core(
         list[list[QueryOutColumn]] | None,
     ],
 ]:
-    if enable_performance_logging:
-        start_time = time.time()
-
-    if enable_performance_logging:
-        env_time = time.time() - start_time
-        import_start = time.time()
-
-    extra_filters = query.extra_filters
-    variables = query.parameters or {}
-
-    def build_env():
-        benv = parse_env_from_full_model(
-            query.full_model.sources,
-            files=query.files,
-            working_path=query.working_path,
-        )
-        imports = []
-        for imp in query.imports:
-            if imp.alias:
-                imports.append(f"import {imp.name} as {imp.alias};")
-            else:
-                imports.append(f"import {imp.name};")
-        imp_string = "\n".join(imports)
-        parse_text(imp_string, benv, parse_config=PARSE_CONFIG)
-        conditional = None
-        if extra_filters:
-            conditional = filters_to_conditional(extra_filters, variables, benv)
-        return benv, conditional
-
-    env, conditional = build_env()
-
-    if enable_performance_logging:
-        import_time = time.time() - import_start
-        queries_start = time.time()
-
-    all: list[
-        tuple[
-            str | None,
-            PROCESSED_STATEMENT_TYPES | Exception | None,
-            list[QueryOutColumn],
-            list[dict] | None,
-            list[list[QueryOutColumn]] | None,
-        ]
-    ] = []
-    default_return: list[QueryOutColumn] = []
-
-    for idx, subquery in enumerate(query.queries):
-        try:
-            generated, columns, values, _, layer_columns = generate_single_query(
-                subquery.query,
-                env,
-                dialect,
-                extra_filters=subquery.extra_filters,
-                parameters=subquery.parameters,
-                enable_performance_logging=enable_performance_logging,
-                extra_conditional=conditional,
-                base_filter_idx=idx,
-                cleanup_concepts=cleanup_concepts,
-            )
-            all.append((subquery.label, generated, columns, values, layer_columns))
-        except Exception as e:  # noqa: BLE001 -- isolate failure to this batch item
-            perf_logger.error(f"Error generating query '{subquery.query}': {e}")
-            # log full traceback
-            import traceback
-
-            traceback_str = traceback.format_exc()
-            perf_logger.error(traceback_str)
-            all.append((subquery.label, e, default_return, None, None))
-            # rebuild env, as we assume that cleanup might not have happened
-
-            env, conditional = build_env()
-
-    if enable_performance_logging:
-        queries_time = time.time() - queries_start
-        total_time = time.time() - start_time
-        perf_logger.info(
-            f"Multi-query generation - Total: {total_time:.4f}s | "
-            f"Env setup: {env_time:.4f}s ({safe_percentage(env_time, total_time):.1f}%) | "
-            f"Imports: {import_time:.4f}s ({safe_percentage(import_time, total_time):.1f}%) | "
-            f"Queries: {queries_time:.4f}s ({safe_percentage(queries_time, total_time):.1f}%) | "
-            f"Query count: {len(query.queries)}"
-        )
-
-    return all
+    """Plan every sub-query of `query`, in order, each on its own fork of
+    the environment."""
+    items = plan_multi_query_items(query, dialect)
+    return [
+        (item.label, item.target, item.columns, item.values, item.layer_columns)
+        for item in items
+    ]
 
 
 def _serialize_bound_params(
@@ -727,18 +665,10 @@ def query_to_output(
     results: list[dict] | None,
     label: str | None,
     dialect: BaseDialect,
-    enable_performance_logging: bool = True,
     select_count: int | None = None,
     layer_columns: list[list[QueryOutColumn]] | None = None,
 ) -> QueryOut:
-    if enable_performance_logging:
-        start_time = time.time()
-
     if not target:
-        if enable_performance_logging:
-            perf_logger.debug(
-                f"Empty output generation: {time.time() - start_time:.4f}s"
-            )
         return QueryOut(
             generated_sql=None, columns=columns, label=label, select_count=select_count
         )
@@ -767,13 +697,13 @@ def query_to_output(
             select_count=select_count,
         )
     else:
-        compile_start = time.time()
-        sql, bound_params = dialect.compile_statement_with_params(target)
-        compile_time = time.time() - compile_start
+        with phase("compile") as compile_span:
+            sql, bound_params = dialect.compile_statement_with_params(target)
+            compile_span.set(sql_chars=len(sql))
         # Serialize params: scalars pass through, ListWrapper exposes .data as a plain list
         serializable_params = _serialize_bound_params(bound_params)
 
-        output = QueryOut(
+        return QueryOut(
             generated_sql=sql,
             generated_output=results,
             columns=columns,
@@ -782,15 +712,5 @@ def query_to_output(
             parameters=serializable_params or None,
         )
 
-        if enable_performance_logging:
-            total_time = time.time() - start_time
-            perf_logger.debug(
-                f"SQL output generation - Total: {total_time:.4f}s | "
-                f"SQL Compilation: {compile_time:.4f}s ({safe_percentage(compile_time, total_time):.1f}%) | "
-                f"SQL length: {len(sql)} chars"
-            )
-
-        return output
-
 
 # def pipeline_commands():
@@ -0,0 +1,170 @@
+"""Parameter-independent compiled query templates.
+
+With `PARAMETER_RENDERING` a filter such as `order.date >= :p1` compiles to
+SQL with a `:p1` placeholder, so moving a date picker changes only the bound
+`parameters` of the `QueryOut`, not its SQL. Templates are keyed on the
+request *shape* - everything but the parameter values, plus each parameter's
+name and inferred type - and reuse the compiled output of the first request
+with that shape, swapping in the new bound values.
+
+A compiled output only becomes a template when every request parameter is
+still a placeholder in the SQL. The dialect inlines some values (integers,
+for example), and such outputs are value-dependent, so they are not reused.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from env_cache import model_cache_key
+from io_models import QueryInSchema
+from query_helpers import normalize_date_param, trilogy_type_for
+from single_flight import canonical_payload_hash
+
+DEFAULT_TEMPLATE_CACHE_SIZE = 256
+
+# How a request value becomes the bound value in QueryOut.parameters
+IDENTITY = "identity"
+DATE = "date"
+# bound in the SQL, but dropped from QueryOut.parameters (e.g. date objects)
+UNSERIALIZED = "unserialized"
+
+
+def template_key(query: QueryInSchema, model_key: str | None = None) -> str | None:
+    """Hash of everything that shapes the compiled SQL, or None when the
+    request has no parameters to vary.
+
+    The model enters as its content hash: `model_key` when the caller already
+    has it, so the key costs the same however large the model is."""
+    if not query.parameters or not query.extra_filters:
+        return None
+    shape = sorted(
+        (key, trilogy_type_for(value)) for key, value in query.parameters.items()
+    )
+    return canonical_payload_hash(
+        "query_template",
+        model_key or model_cache_key(query.full_model.sources),
+        query.query,
+        [(i.name, i.alias) for i in query.imports],
+        query.current_filename,
+        query.extra_filters,
+        query.dialect.value,
+        query.files,
+        query.working_path,
+        shape,
+    )
+
+
+@dataclass
+class QueryTemplate:
+    payload: dict
+    transforms: dict[str, str] = field(default_factory=dict)
+
+    def render(self, parameters: dict[str, str | int | float]) -> dict:
+        bound = dict(self.payload.get("parameters") or {})
+        for key, value in parameters.items():
+            name = key.lstrip(":")
+            transform = self.transforms[name]
+            if transform == IDENTITY:
+                bound[name] = value
+            elif transform == DATE:
+                bound[name] = normalize_date_param(value)
+        return {**self.payload, "parameters": bound or None}
+
+
+def build_template(
+    parameters: dict[str, str | int | float], payload: dict
+) -> QueryTemplate | None:
+    """A template for a compiled QueryOut payload, or None if its SQL
+    depends on the parameter values."""
+    sql = payload.get("generated_sql")
+    if not sql or payload.get("chart") or payload.get("generated_output"):
+        return None
+    bound = payload.get("parameters") or {}
+    transforms: dict[str, str] = {}
+    for key, value in parameters.items():
+        name = key.lstrip(":")
+        if not re.search(rf":{re.escape(name)}\b", sql):
+            return None
+        if name not in bound:
+            transforms[name] = UNSERIALIZED
+        elif bound[name] == value and type(bound[name]) is type(value):
+            transforms[name] = IDENTITY
+        elif bound[name] == normalize_date_param(value):
+            transforms[name] = DATE
+        else:
+            return None
+    return QueryTemplate(payload=payload, transforms=transforms)
+
+
+@dataclass
+class QueryTemplateCacheStats:
+    hits: int = 0
+    misses: int = 0
+    value_dependent: int = 0
+    size: int = 0
+    max_entries: int = 0
+
+
+class QueryTemplateCache:
+    """Bounded LRU of `QueryTemplate` entries keyed by `template_key`."""
+
+    def __init__(self, max_entries: int = DEFAULT_TEMPLATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, QueryTemplate] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._value_dependent = 0
+
+    def render(self, key: str, parameters: dict[str, str | int | float]) -> dict | None:
+        with self._lock:
+            template = self._entries.get(key)
+            if template is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return template.render(parameters)
+
+    def store(
+        self, key: str, parameters: dict[str, str | int | float], payload: dict
+    ) -> bool:
+        if self.max_entries <= 0:
+            return False
+        template = build_template(parameters, payload)
+        with self._lock:
+            if template is None:
+                self._value_dependent += 1
+                return False
+            self._entries[key] = template
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def stats(self) -> QueryTemplateCacheStats:
+        with self._lock:
+            return QueryTemplateCacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                value_dependent=self._value_dependent,
+                size=len(self._entries),
+                max_entries=self.max_entries,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+            self._value_dependent = 0
+
+
+QUERY_TEMPLATES = QueryTemplateCache(
+    int(
+        os.environ.get("TRILOGY_QUERY_TEMPLATE_CACHE_SIZE", DEFAULT_TEMPLATE_CACHE_SIZE)
+    )
+)
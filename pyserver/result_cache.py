@@ -0,0 +1,138 @@
+"""Byte-budgeted LRU+TTL cache of encoded generate responses.
+
+A generated query is a pure function of its request payload (model sources,
+imports, query text, dialect, filters, parameters, files and working path),
+so repeated dashboard refreshes and filter toggles can be answered from the
+JSON bytes of an earlier response without touching the worker pool.
+Entries are keyed by `single_flight.request_key`, so equivalent requests
+written differently share one entry and one share of the byte budget.
+
+Settings come from the environment:
+
+- `TRILOGY_QUERY_CACHE_BYTES`: memory budget for cached bodies (default
+  64 MiB; 0 disables the cache)
+- `TRILOGY_QUERY_CACHE_TTL`: seconds an entry stays valid (default 300)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+
+DEFAULT_QUERY_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_QUERY_CACHE_TTL = 300.0
+
+# Rough per-entry bookkeeping cost (OrderedDict node, entry tuple, key
+# string header) on top of the key and body bytes.
+ENTRY_OVERHEAD_BYTES = 256
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+    max_bytes: int = 0
+
+
+class ResultCache:
+    """LRU of response bodies, bounded by total bytes and by entry age.
+
+    An entry bigger than a quarter of the budget is not stored, so a single
+    huge response cannot flush everything else.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_QUERY_CACHE_BYTES,
+        ttl_seconds: float = DEFAULT_QUERY_CACHE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        # key -> (body, expires_at, accounted bytes)
+        self._entries: OrderedDict[str, tuple[bytes, float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._size_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        return cls(
+            max_bytes=int(
+                os.environ.get("TRILOGY_QUERY_CACHE_BYTES", DEFAULT_QUERY_CACHE_BYTES)
+            ),
+            ttl_seconds=float(
+                os.environ.get("TRILOGY_QUERY_CACHE_TTL", DEFAULT_QUERY_CACHE_TTL)
+            ),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl_seconds > 0
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            body, expires_at, _ = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return body
+
+    def put(self, key: str, body: bytes) -> bool:
+        """Store `body`; False if the cache is disabled or it is too large."""
+        cost = len(key) + len(body) + ENTRY_OVERHEAD_BYTES
+        if not self.enabled or cost > self.max_bytes // 4:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, self._clock() + self.ttl_seconds, cost)
+            self._size_bytes += cost
+            while self._size_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+        return True
+
+    def _remove(self, key: str) -> None:
+        _, _, cost = self._entries.pop(key)
+        self._size_bytes -= cost
+
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            return ResultCacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                entries=len(self._entries),
+                size_bytes=self._size_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._expirations = 0
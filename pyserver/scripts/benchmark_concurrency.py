@@ -14,6 +14,14 @@ DEFAULT_PAYLOAD_FILES = [
     SCRIPT_DIR / "payloads" / "tpch_large_duckdb.json",
 ]
 DEFAULT_ENDPOINTS = ["generate_query"]
+ENDPOINTS = [
+    "generate_query",
+    "validate_query",
+    "format_query",
+    "drilldown_query",
+    "parse_model",
+]
+IDLE_HEALTH_SAMPLES = 10
 
 
 def percentile(values: list[float], p: int) -> float | None:
@@ -64,6 +72,17 @@ async def probe_health(
         await asyncio.sleep(0.1)
 
 
+async def sample_idle_health(client: httpx.AsyncClient, health_url: str) -> list[float]:
+    """Health latency with no other load, as the baseline for the loaded run."""
+    latencies = []
+    for _ in range(IDLE_HEALTH_SAMPLES):
+        started = time.perf_counter()
+        response = await client.get(health_url, timeout=2.0)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
 async def run_level(
     base_url: str,
     endpoint: str,
@@ -87,6 +106,7 @@ async def run_level(
     async with httpx.AsyncClient(limits=limits) as client:
         warmup = await client.post(query_url, json=payload, timeout=60.0)
         warmup.raise_for_status()
+        idle_health = await sample_idle_health(client, health_url)
 
         health_task = asyncio.create_task(
             probe_health(
@@ -113,6 +133,7 @@ async def run_level(
 
     req_p95 = percentile(ok_times, 95)
     health_p95 = percentile(health_ok, 95)
+    idle_health_p95 = percentile(idle_health, 95)
 
     return {
         "payload": payload_name,
@@ -130,6 +151,9 @@ async def run_level(
         "req_p50_s": round(statistics.median(ok_times), 3) if ok_times else None,
         "req_p95_s": round(req_p95, 3) if req_p95 is not None else None,
         "req_max_s": round(max(ok_times), 3) if ok_times else None,
+        "health_idle_p95_s": (
+            round(idle_health_p95, 3) if idle_health_p95 is not None else None
+        ),
         "health_samples": len(health_ok),
         "health_timeouts": len(health_failures),
         "health_p95_s": round(health_p95, 3) if health_p95 is not None else None,
@@ -167,6 +191,13 @@ def adapt_payload_for_endpoint(
             f"{payload_name}-parse-model",
             payload.get("full_model", {}),
         )
+    if endpoint == "drilldown_query":
+        if "drilldown_remove" not in payload:
+            raise ValueError(
+                f"Payload {payload_name} has no drilldown_remove/drilldown_add/"
+                "drilldown_filter fields to benchmark drilldown_query with"
+            )
+        return payload_name, payload
     raise ValueError(f"Unsupported endpoint: {endpoint}")
 
 
@@ -195,7 +226,7 @@ async def main():
         "--endpoint",
         action="append",
         default=[],
-        choices=["generate_query", "validate_query", "format_query", "parse_model"],
+        choices=ENDPOINTS,
         help="Endpoint to benchmark. May be provided multiple times.",
     )
     args = parser.parse_args()
@@ -0,0 +1,167 @@
+"""Per-request allocation benchmark for environment setup.
+
+Compares the deep-copying setup the server used to do on every request with
+the copy-on-write path: a shared import resolver across import roots, and
+forks of a cached, already-imported environment.
+
+Usage:
+    python scripts/benchmark_memory.py
+    python scripts/benchmark_memory.py --payload-file scripts/payloads/small_names.json
+"""
+
+import argparse
+import copy
+import json
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+sys.path.append(str(SCRIPT_DIR.parent))
+
+from trilogy.core.models.environment import DictImportResolver
+from trilogy.parser import parse_text
+
+from env_cache import EnvironmentCache
+from env_helpers import (
+    StudioEnvironmentConfig,
+    fork_environment,
+    imports_to_strings,
+    normalize_relative_imports,
+    parse_env_from_full_model,
+)
+from io_models import QueryInSchema
+from query_helpers import PARSE_CONFIG
+
+DEFAULT_PAYLOAD_FILES = [
+    SCRIPT_DIR / "payloads" / "small_names.json",
+    SCRIPT_DIR / "payloads" / "tpch_large_duckdb.json",
+]
+
+
+class DeepCopyEnvironmentConfig(StudioEnvironmentConfig):
+    """The pre-copy-on-write config: every import root deep-copies sources."""
+
+    def copy_for_root(self, root: str | None) -> "DeepCopyEnvironmentConfig":
+        return copy.deepcopy(self)
+
+    def __deepcopy__(self, memo: dict) -> "DeepCopyEnvironmentConfig":
+        resolver = self.import_resolver
+        assert isinstance(resolver, DictImportResolver)
+        return DeepCopyEnvironmentConfig(
+            allow_duplicate_declaration=self.allow_duplicate_declaration,
+            import_resolver=DictImportResolver(
+                content=copy.deepcopy(resolver.content, memo),
+                data_files=copy.deepcopy(resolver.data_files, memo),
+            ),
+        )
+
+
+def measure(fn: Callable[[], Any], iterations: int) -> dict[str, float]:
+    """Mean peak allocation, held size of the result, and latency per call."""
+    fn()  # warm caches and lazy imports outside the measurement
+    peak_total = 0
+    held_total = 0
+    elapsed = 0.0
+    tracemalloc.start()
+    for _ in range(iterations):
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = fn()
+        elapsed += time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - baseline
+        held_total += current - baseline
+        del result
+    tracemalloc.stop()
+    return {
+        "peak_kb_per_request": round(peak_total / iterations / 1024, 1),
+        "held_kb_per_request": round(held_total / iterations / 1024, 1),
+        "mean_ms": round(elapsed / iterations * 1000, 3),
+    }
+
+
+def run_payload(name: str, payload: dict[str, Any], iterations: int) -> list[dict]:
+    query = QueryInSchema.model_validate(payload)
+    sources = query.full_model.sources
+    import_strings = imports_to_strings(query.imports, query.current_filename)
+    import_text = "\n".join(import_strings)
+
+    def deepcopy_setup():
+        env = parse_env_from_full_model(sources)
+        resolver = env.config.import_resolver
+        env.config = DeepCopyEnvironmentConfig(import_resolver=resolver)
+        if import_text:
+            parse_text(import_text, env, parse_config=PARSE_CONFIG)
+        return env
+
+    def shared_setup():
+        env = parse_env_from_full_model(sources)
+        if import_text:
+            parse_text(import_text, env, parse_config=PARSE_CONFIG)
+        return env
+
+    base = shared_setup()
+    cache = EnvironmentCache()
+
+    def cached_fork():
+        return cache.get_environment(sources, import_strings, parse_config=PARSE_CONFIG)
+
+    scenarios: list[tuple[str, Callable[[], Any]]] = [
+        ("parse_deepcopy_config", deepcopy_setup),
+        ("parse_shared_config", shared_setup),
+        ("duplicate", base.duplicate),
+        ("fork_environment", lambda: fork_environment(base)),
+        ("cached_fork", cached_fork),
+    ]
+    model_chars = sum(len(source.text) for source in sources)
+    results = []
+    for scenario, fn in scenarios:
+        result = {
+            "payload": name,
+            "scenario": scenario,
+            "source_count": len(sources),
+            "model_chars": model_chars,
+            **measure(fn, iterations),
+        }
+        results.append(result)
+        print(json.dumps(result))
+    # make sure the query still parses against a fork, so a broken fork
+    # can't post a flattering number
+    parse_text(
+        normalize_relative_imports(query.query, query.current_filename),
+        cached_fork(),
+        parse_config=PARSE_CONFIG,
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--payload-file",
+        action="append",
+        default=[],
+        help="Path to a request payload JSON file. May be provided multiple times.",
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    payload_files = args.payload_file or [str(path) for path in DEFAULT_PAYLOAD_FILES]
+
+    all_results = []
+    for payload_file in payload_files:
+        path = Path(payload_file)
+        with path.open("r", encoding="utf-8") as handle:
+            payload = json.load(handle)
+        all_results.extend(run_payload(path.stem, payload, args.iterations))
+
+    print("FINAL")
+    print(json.dumps(all_results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
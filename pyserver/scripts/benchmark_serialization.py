@@ -0,0 +1,153 @@
+"""Per-request serialization benchmark for the generate endpoints.
+
+Compares the dict round trip the server used to do on every request
+(validate, `model_dump`, re-validate in the task, `model_dump` the result and
+re-encode it with `json.dumps`) with the raw-body path: one validation, the raw
+body handed to worker processes, and the result encoded once by pydantic-core.
+Planning time is excluded; the model sources are repeated to reach each
+payload size.
+
+Usage:
+    python scripts/benchmark_serialization.py
+    python scripts/benchmark_serialization.py --sizes 10000 200000 --repeat 50
+"""
+
+import argparse
+import json
+import pickle
+import sys
+import time
+from collections.abc import Callable
+from functools import partial
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+sys.path.append(str(SCRIPT_DIR.parent))
+
+from pydantic_core import to_json
+
+from io_models import QueryInSchema, QueryOut
+from studio_endpoints import _generate_query_task, _json_body
+
+DEFAULT_PAYLOAD_FILE = SCRIPT_DIR / "payloads" / "tpch_large_duckdb.json"
+DEFAULT_SIZES = [10_000, 50_000, 200_000, 1_000_000]
+
+
+def scale_payload(payload: dict, target_bytes: int) -> bytes:
+    """The request body with its model sources repeated up to `target_bytes`."""
+    sources = payload["full_model"]["sources"]
+    scaled = dict(payload, full_model=dict(payload["full_model"], sources=[]))
+    copy_idx = 0
+    while len(json.dumps(scaled)) < target_bytes:
+        for source in sources:
+            alias = (
+                source["alias"] if copy_idx == 0 else f"{source['alias']}_{copy_idx}"
+            )
+            scaled["full_model"]["sources"].append(dict(source, alias=alias))
+        copy_idx += 1
+    return json.dumps(scaled).encode("utf-8")
+
+
+# Each path is split into request handling and response encoding on the event
+# loop, and the task in between (a worker process in process mode). Only the
+# loop stages delay other requests.
+
+
+def dict_round_trip_request(body: bytes, process: bool) -> object:
+    query = QueryInSchema.model_validate(json.loads(body))  # FastAPI
+    query_data = query.model_dump(mode="json")
+    return pickle.dumps(query_data) if process else query_data
+
+
+def dict_round_trip_task(task_input, result: QueryOut, process: bool) -> object:
+    QueryInSchema.model_validate(pickle.loads(task_input) if process else task_input)
+    payload = result.model_dump(mode="json")
+    return pickle.dumps(payload) if process else payload
+
+
+def dict_round_trip_response(task_output, process: bool) -> bytes:
+    return _json_body(pickle.loads(task_output) if process else task_output)
+
+
+def raw_body_request(body: bytes, process: bool) -> object:
+    query = QueryInSchema.model_validate(json.loads(body))  # FastAPI
+    return pickle.dumps(body) if process else query
+
+
+def raw_body_task(task_input, result: QueryOut, process: bool) -> object:
+    if process:
+        QueryInSchema.model_validate_json(pickle.loads(task_input))
+    encoded = to_json(result)
+    return pickle.dumps(encoded) if process else encoded
+
+
+def raw_body_response(task_output, process: bool) -> bytes:
+    return pickle.loads(task_output) if process else task_output
+
+
+PATHS = {
+    "round trip": (
+        dict_round_trip_request,
+        dict_round_trip_task,
+        dict_round_trip_response,
+    ),
+    "raw body": (raw_body_request, raw_body_task, raw_body_response),
+}
+
+
+def time_per_call(fn: Callable[[], object], repeat: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def run_path(
+    path: str, body: bytes, result: QueryOut, process: bool, repeat: int
+) -> tuple[bytes, float, float]:
+    """The encoded response, event-loop seconds and total seconds."""
+    request_fn, task_fn, response_fn = PATHS[path]
+    task_input = request_fn(body, process)
+    task_output = task_fn(task_input, result, process)
+    loop_s = time_per_call(partial(request_fn, body, process), repeat)
+    loop_s += time_per_call(partial(response_fn, task_output, process), repeat)
+    task_s = time_per_call(partial(task_fn, task_input, result, process), repeat)
+    return response_fn(task_output, process), loop_s, loop_s + task_s
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--payload-file", type=Path, default=DEFAULT_PAYLOAD_FILE)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = json.loads(args.payload_file.read_text())
+    generated = _generate_query_task(payload, False)
+    assert isinstance(generated, bytes), generated
+    result = QueryOut.model_validate_json(generated)
+
+    print(
+        f"{'body bytes':>12} {'mode':>8} {'loop ms before':>15} {'after':>8} "
+        f"{'total ms before':>16} {'after':>8}"
+    )
+    for size in args.sizes:
+        body = scale_payload(payload, size)
+        for process in (False, True):
+            old, old_loop, old_total = run_path(
+                "round trip", body, result, process, args.repeat
+            )
+            new, new_loop, new_total = run_path(
+                "raw body", body, result, process, args.repeat
+            )
+            assert old == new, "encoders disagree"
+            print(
+                f"{len(body):>12} {'process' if process else 'thread':>8} "
+                f"{old_loop * 1000:>15.3f} {new_loop * 1000:>8.3f} "
+                f"{old_total * 1000:>16.3f} {new_total * 1000:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Coalescing of identical in-flight requests.
+
+Dashboards fan the same `/generate_query` payload out from many tabs at once.
+`SingleFlight` runs the first request for a key and hands its result (or
+error) to every identical request that arrives while it is still running.
+Nothing is cached: once the computation finishes, the next request for the
+key starts a new one.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any
+
+from pydantic import BaseModel
+
+perf_logger = getLogger("trilogy.performance")
+
+
+def canonical_payload_hash(*parts: Any) -> str:
+    """sha256 of JSON-serializable parts, independent of dict key order."""
+    encoded = json.dumps(
+        parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def request_key(endpoint: str, request: BaseModel, model_key: str) -> str:
+    """Canonical hash of a validated request, namespaced by endpoint.
+
+    The model enters as its content hash `model_key`, so the hash does not
+    grow with the model. Requests that differ only in key order or
+    whitespace, or that name the same model inline or by `model_id`, share
+    a key.
+    """
+    return canonical_payload_hash(
+        endpoint,
+        request.model_dump(mode="json", exclude={"full_model", "model_id"}),
+        model_key,
+    )
+
+
+@dataclass
+class SingleFlightStats:
+    leaders: int = 0
+    coalesced: int = 0
+    in_flight: int = 0
+
+
+class SingleFlight:
+    """Shares one computation between concurrent callers with the same key.
+
+    The computation runs as its own task, so a cancelled caller (for example
+    a disconnected leader) does not cancel it for everyone else. It is
+    cancelled once every caller waiting for it has been.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: dict[str, asyncio.Task] = {}
+        # computation -> callers still waiting for it
+        self._waiting: dict[asyncio.Task, int] = {}
+        self._leaders = 0
+        self._coalesced = 0
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is not None and task.get_loop() is asyncio.get_running_loop():
+                self._coalesced += 1
+                perf_logger.info("Request coalesced - Key: %s", key[:16])
+            else:
+                task = asyncio.ensure_future(compute())
+                self._tasks[key] = task
+                self._leaders += 1
+                task.add_done_callback(lambda done: self._forget(key, done))
+            self._waiting[task] = self._waiting.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            with self._lock:
+                abandoned = self._waiting.get(task) == 1
+            if abandoned and not task.done():
+                task.cancel()
+                # return once the computation has actually stopped
+                await asyncio.wait({task})
+            raise
+        finally:
+            with self._lock:
+                if task in self._waiting:
+                    self._waiting[task] -= 1
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+            self._waiting.pop(task, None)
+        if not task.cancelled():
+            # mark the exception retrieved when every caller has gone away
+            task.exception()
+
+    def stats(self) -> SingleFlightStats:
+        with self._lock:
+            return SingleFlightStats(
+                leaders=self._leaders,
+                coalesced=self._coalesced,
+                in_flight=len(self._tasks),
+            )
@@ -0,0 +1,342 @@
+"""Capture slow requests so they can be replayed and profiled locally.
+
+A watched task that runs past the threshold is written to a capture file
+holding:
+
+- the request payload, with any model session already resolved into it, so
+  the capture replays on its own
+- the phase timings (and spans, with tracing on) the task recorded
+- a sampled profile of the task's thread from the moment it crossed the
+  threshold, as folded stacks (`frame;frame;frame` -> samples) that flame
+  graph tools read directly
+
+The capture directory is a ring buffer: once it holds `keep` captures, each
+new one deletes the oldest. Stacks are only sampled while some task is late:
+one daemon thread per process sleeps until the earliest watched deadline, so
+watching a task that finishes in time costs two trips through a lock.
+
+`python main.py replay <capture>` runs a capture again under cProfile.
+
+Settings come from the environment:
+
+- `TRILOGY_SLOW_REQUEST_SECONDS`: capture tasks that run at least this long;
+  unset or 0 disables capture
+- `TRILOGY_SLOW_REQUEST_DIR`: where captures go (default
+  `<tempdir>/trilogy-slow-requests`)
+- `TRILOGY_SLOW_REQUEST_KEEP`: captures kept (default 20)
+- `TRILOGY_SLOW_REQUEST_REDACT`: `true` to blank string literals, comments and
+  parameter values in the saved payload. Identifiers and query structure are
+  kept, since they are what the planner's cost depends on
+- `TRILOGY_SLOW_REQUEST_SAMPLE_MS`: stack sampling interval (default 5)
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import Callable, Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Any
+
+from metrics import TaskReport, current_report, task_report
+from profiling import fold_stack
+from tracing import span_record
+
+logger = getLogger(__name__)
+
+CAPTURE_VERSION = 1
+DEFAULT_KEEP = 20
+DEFAULT_SAMPLE_MS = 5.0
+# folded stacks kept per capture, most sampled first
+MAX_PROFILE_STACKS = 200
+
+# comments first, so an apostrophe in a comment does not open a string
+_REDACTABLE = re.compile(
+    r"""(?P<comment>(?:\#|//)[^\n]*)"""
+    r"""|(?P<triple>'''.*?''')"""
+    r"""|(?P<double>"(?:[^"\\\n]|\\.)*")"""
+    r"""|(?P<single>'(?:[^'\\\n]|\\.)*')""",
+    re.DOTALL,
+)
+
+
+def _default_directory() -> Path:
+    return Path(tempfile.gettempdir()) / "trilogy-slow-requests"
+
+
+@dataclass
+class SlowRequestSettings:
+    # 0 disables capture
+    threshold_seconds: float = 0.0
+    directory: Path = field(default_factory=_default_directory)
+    keep: int = DEFAULT_KEEP
+    redact: bool = False
+    sample_seconds: float = DEFAULT_SAMPLE_MS / 1000
+
+    @classmethod
+    def from_env(
+        cls, environ: Mapping[str, str] | None = None
+    ) -> "SlowRequestSettings":
+        environ = os.environ if environ is None else environ
+        directory = environ.get("TRILOGY_SLOW_REQUEST_DIR")
+        return cls(
+            threshold_seconds=float(environ.get("TRILOGY_SLOW_REQUEST_SECONDS") or 0),
+            directory=Path(directory) if directory else _default_directory(),
+            keep=max(1, int(environ.get("TRILOGY_SLOW_REQUEST_KEEP", DEFAULT_KEEP))),
+            redact=environ.get("TRILOGY_SLOW_REQUEST_REDACT", "false").lower()
+            == "true",
+            sample_seconds=float(
+                environ.get("TRILOGY_SLOW_REQUEST_SAMPLE_MS", DEFAULT_SAMPLE_MS)
+            )
+            / 1000,
+        )
+
+
+def redact_text(text: str) -> str:
+    """Blank the contents of string literals and comments, keeping lengths
+    and line breaks so statement spans still line up."""
+
+    def blank(match: re.Match) -> str:
+        value = match.group(0)
+        if match.lastgroup == "comment":
+            return value[:1] if value[0] == "#" else value[:2]
+        quote = 3 if match.lastgroup == "triple" else 1
+        inner = re.sub(r"[^\n]", "x", value[quote:-quote])
+        return value[:quote] + inner + value[-quote:]
+
+    return _REDACTABLE.sub(blank, text)
+
+
+def _redact_value(value: Any) -> Any:
+    if isinstance(value, str):
+        return "x" * len(value)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, list):
+        return [_redact_value(item) for item in value]
+    return value
+
+
+def redact_request(request: dict[str, Any]) -> dict[str, Any]:
+    """A copy of a /generate_query payload with its literals blanked."""
+    redacted = dict(request)
+    if isinstance(redacted.get("query"), str):
+        redacted["query"] = redact_text(redacted["query"])
+    if redacted.get("extra_filters"):
+        redacted["extra_filters"] = [
+            redact_text(condition) for condition in redacted["extra_filters"]
+        ]
+    if redacted.get("parameters"):
+        redacted["parameters"] = {
+            key: _redact_value(value) for key, value in redacted["parameters"].items()
+        }
+    model = redacted.get("full_model")
+    if isinstance(model, dict) and model.get("sources"):
+        redacted["full_model"] = {
+            **model,
+            "sources": [
+                {**source, "contents": redact_text(source.get("contents") or "")}
+                for source in model["sources"]
+            ],
+        }
+    return redacted
+
+
+class _Watch:
+    def __init__(self, thread_id: int, deadline: float):
+        self.thread_id = thread_id
+        self.deadline = deadline
+        self.stacks: Counter[str] = Counter()
+
+
+class _StackSampler:
+    """Samples the stacks of watched threads that are past their deadline."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._condition = threading.Condition()
+        self._watches: dict[int, _Watch] = {}
+        self._thread: threading.Thread | None = None
+
+    def add(self, watch: _Watch) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="slow-request-sampler", daemon=True
+                )
+                self._thread.start()
+            self._watches[id(watch)] = watch
+            self._condition.notify()
+
+    def remove(self, watch: _Watch) -> None:
+        with self._condition:
+            self._watches.pop(id(watch), None)
+
+    def _run(self) -> None:
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                late = [w for w in self._watches.values() if w.deadline <= now]
+                timeout: float | None = None
+                if late:
+                    frames = sys._current_frames()
+                    for watch in late:
+                        frame = frames.get(watch.thread_id)
+                        if frame is not None:
+                            watch.stacks[fold_stack(frame)] += 1
+                    timeout = self.interval
+                elif self._watches:
+                    timeout = min(w.deadline for w in self._watches.values()) - now
+                self._condition.wait(timeout)
+
+
+class SlowRequestCapture:
+    def __init__(self, settings: SlowRequestSettings | None = None):
+        self.settings = settings or SlowRequestSettings()
+        self._sampler = _StackSampler(self.settings.sample_seconds)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.threshold_seconds > 0
+
+    @contextmanager
+    def watch(
+        self, endpoint: str, request: Callable[[], dict[str, Any]]
+    ) -> Iterator[None]:
+        """Capture the block if it runs past the threshold. `request` is only
+        called then, to build the payload to save."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        watch = _Watch(threading.get_ident(), start + self.settings.threshold_seconds)
+        self._sampler.add(watch)
+        try:
+            yield
+        finally:
+            self._sampler.remove(watch)
+        elapsed = time.perf_counter() - start
+        if elapsed >= self.settings.threshold_seconds:
+            try:
+                self.save(endpoint, request(), elapsed, current_report(), watch.stacks)
+            except Exception:
+                # losing a capture must not fail the request it describes
+                logger.exception("Could not save a slow %s capture", endpoint)
+
+    def save(
+        self,
+        endpoint: str,
+        request: dict[str, Any],
+        elapsed: float,
+        report: TaskReport | None,
+        stacks: Counter[str],
+    ) -> Path:
+        settings = self.settings
+        capture = {
+            "version": CAPTURE_VERSION,
+            "endpoint": endpoint,
+            "captured_at": time.time(),
+            "elapsed": elapsed,
+            "threshold": settings.threshold_seconds,
+            "pid": os.getpid(),
+            "redacted": settings.redact,
+            "phases": report.phases if report else [],
+            "labels": report.labels if report else {},
+            "spans": [span_record(span) for span in report.spans] if report else [],
+            "profile": {
+                "interval": settings.sample_seconds,
+                "samples": sum(stacks.values()),
+                "stacks": dict(stacks.most_common(MAX_PROFILE_STACKS)),
+            },
+            "request": redact_request(request) if settings.redact else request,
+        }
+        settings.directory.mkdir(parents=True, exist_ok=True)
+        # names sort oldest first; the suffix keeps processes from colliding
+        path = settings.directory / (
+            f"{time.time_ns()}-{endpoint}-{uuid.uuid4().hex[:8]}.json"
+        )
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(capture), encoding="utf-8")
+        temporary.replace(path)
+        self._trim()
+        logger.warning(
+            "Captured slow %s request (%.3fs) to %s", endpoint, elapsed, path
+        )
+        return path
+
+    def captures(self) -> list[Path]:
+        """Saved captures, oldest first."""
+        if not self.settings.directory.is_dir():
+            return []
+        return sorted(self.settings.directory.glob("*.json"))
+
+    def _trim(self) -> None:
+        with self._lock:
+            captures = self.captures()
+            for path in captures[: max(0, len(captures) - self.settings.keep)]:
+                # another server process may have trimmed it already
+                path.unlink(missing_ok=True)
+
+
+SLOW_REQUESTS = SlowRequestCapture(SlowRequestSettings.from_env())
+
+
+def load_capture(path: Path) -> dict[str, Any]:
+    capture = json.loads(Path(path).read_text(encoding="utf-8"))
+    if capture.get("version") != CAPTURE_VERSION:
+        raise ValueError(
+            f"{path} is a version {capture.get('version')} capture; "
+            f"expected version {CAPTURE_VERSION}"
+        )
+    return capture
+
+
+@dataclass
+class Replay:
+    elapsed: float
+    phases: list[tuple[str, float]]
+    # the task's payload: encoded bytes, or an error dict
+    result: object
+    stats: pstats.Stats
+
+
+def replay_capture(capture: dict[str, Any], task: Callable[..., object]) -> Replay:
+    """Run `task` on the captured request under cProfile."""
+    profiler = cProfile.Profile()
+    with task_report() as report:
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            result = task(capture["request"], False)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+    return Replay(elapsed, report.phases, result, pstats.Stats(profiler))
+
+
+def format_phases(
+    captured: list[list] | list[tuple[str, float]],
+    replayed: list[tuple[str, float]],
+) -> str:
+    """Captured and replayed phase timings side by side, in phase order."""
+    lines = [f"{'phase':<12} {'captured':>10} {'replayed':>10}"]
+    width = max(len(captured), len(replayed))
+    for index in range(width):
+        name = (captured[index] if index < len(captured) else replayed[index])[0]
+        before = f"{captured[index][1]:.4f}s" if index < len(captured) else "-"
+        after = f"{replayed[index][1]:.4f}s" if index < len(replayed) else "-"
+        lines.append(f"{name:<12} {before:>10} {after:>10}")
+    return "\n".join(lines)
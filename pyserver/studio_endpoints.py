@@ -4,11 +4,28 @@ Can be imported and attached to any FastAPI application.
 """
 
 import asyncio
+import hmac
+import json
+import os
 import time
 import traceback
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable
+from contextlib import suppress
 from logging import getLogger
+from typing import Any, TypeVar
 
-from fastapi import APIRouter, HTTPException
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from pydantic_core import to_json
 from trilogy.authoring import SelectItem, SelectStatement
 from trilogy.constants import Rendering
 from trilogy.core.exceptions import InvalidSyntaxException
@@ -16,32 +33,62 @@ from trilogy.parser import parse_text
 from trilogy.parsing.render import Renderer
 from trilogy.render import get_dialect_generator
 
-from diagnostics import get_diagnostics
+from blob_store import BlobMismatch, BlobStore, MissingBlobs
+from cancellation import CancelToken, check_cancelled
+from diagnostics import STATEMENT_CACHE, get_diagnostics
+from editor_channel import EditorSession, editor_debounce_seconds, editor_reply
+from env_cache import ENV_CACHE, SOURCE_ENV_CACHE, model_cache_key
 from env_helpers import (
+    imports_to_strings,
     model_to_response,
     normalize_relative_imports,
-    parse_env_from_full_model,
     resolve_import_path,
 )
 from io_models import (
+    BlobUploadInSchema,
+    BlobUploadOutSchema,
     DrilldownQueryInSchema,
+    EditorMessageInSchema,
     FormatQueryOutSchema,
+    ModelDeltaInSchema,
     ModelInSchema,
+    ModelSessionOutSchema,
+    ModelSourceInSchema,
     MultiQueryInSchema,
     MultiQueryOutSchema,
     QueryInSchema,
     ValidateItem,
     ValidateQueryInSchema,
 )
+from metrics import (
+    CONTENT_TYPE,
+    MetricsRegistry,
+    Sample,
+    label_task,
+    register_cache_stats,
+)
+from model_sessions import ModelSession, ModelSessionStore, StaleModelSession
+from profiling import ProfileRequest, render_folded
 from query_helpers import (
     PARSE_CONFIG,
-    generate_multi_query_core,
     generate_query_core,
+    plan_multi_query_items,
     prepare_filter_params,
     query_to_output,
     safe_format_query,
 )
-from utility import safe_percentage
+from query_templates import QUERY_TEMPLATES, template_key
+from result_cache import ResultCache
+from single_flight import SingleFlight, request_key
+from slow_requests import SLOW_REQUESTS, Replay, replay_capture
+from task_pool import (
+    PROCESS,
+    ProfilerBusy,
+    TaskPool,
+    TaskPoolSettings,
+    TaskQueueFull,
+)
+from tracing import span
 
 logger = getLogger(__name__)
 perf_logger = getLogger("trilogy.performance")
@@ -49,6 +96,83 @@ perf_logger = getLogger("trilogy.performance")
 
 PARAMETER_RENDERING = Rendering(parameters=True)
 
+# format and drilldown are fired on editor keystrokes; capping them keeps a
+# burst from occupying every worker ahead of query generation
+EDITOR_ENDPOINT_LIMIT = 4
+TASK_POOL = TaskPool(
+    TaskPoolSettings.from_env(
+        endpoint_limits={
+            "format_query": EDITOR_ENDPOINT_LIMIT,
+            "drilldown_query": EDITOR_ENDPOINT_LIMIT,
+        }
+    )
+)
+
+
+# reported as trilogy_cache_* by whichever process runs the tasks
+register_cache_stats("environment", ENV_CACHE.stats)
+register_cache_stats("source_environment", SOURCE_ENV_CACHE.stats)
+register_cache_stats("statement", STATEMENT_CACHE.stats)
+register_cache_stats("query_template", QUERY_TEMPLATES.stats)
+
+
+# TaskPoolStats field -> (metric, type, help)
+_POOL_METRICS = {
+    "in_flight": ("trilogy_pool_in_flight", "gauge", "Tasks queued or running"),
+    "queue_depth": (
+        "trilogy_pool_queue_depth",
+        "gauge",
+        "Tasks waiting for a thread or worker, not yet running",
+    ),
+    "max_queue_depth": (
+        "trilogy_pool_max_queue_depth",
+        "gauge",
+        "Tasks allowed in flight before new ones are rejected",
+    ),
+    "completed": ("trilogy_pool_completed_total", "counter", "Tasks completed"),
+    "rejected": ("trilogy_pool_rejected_total", "counter", "Tasks rejected as busy"),
+    "cancelled": ("trilogy_pool_cancelled_total", "counter", "Tasks cancelled"),
+    "cancelled_seconds_saved": (
+        "trilogy_pool_cancelled_seconds_saved_total",
+        "counter",
+        "Estimated run time that cancelled tasks did not use",
+    ),
+    "pool_restarts": (
+        "trilogy_pool_restarts_total",
+        "counter",
+        "Worker processes restarted after breaking",
+    ),
+    "affinity_routed": (
+        "trilogy_pool_affinity_routed_total",
+        "counter",
+        "Tasks routed to their model's home worker",
+    ),
+    "spilled": (
+        "trilogy_pool_spilled_total",
+        "counter",
+        "Tasks spilled past a busy home worker",
+    ),
+}
+
+
+def _pool_samples(task_pool: TaskPool) -> list[Sample]:
+    stats = task_pool.stats()
+    samples = [
+        Sample(name, kind, description, {}, getattr(stats, field))
+        for field, (name, kind, description) in _POOL_METRICS.items()
+    ]
+    samples.extend(
+        Sample(
+            "trilogy_pool_worker_in_flight",
+            "gauge",
+            "Tasks queued or running on each worker process",
+            {"worker": str(slot)},
+            in_flight,
+        )
+        for slot, in_flight in enumerate(stats.worker_in_flight)
+    )
+    return samples
+
 
 def _build_http_error_payload(status_code: int, detail: str) -> dict:
     return {
@@ -67,8 +191,8 @@ def _worker_http_error(status_code: int, detail: str) -> dict:
     return _build_http_error_payload(status_code, detail)
 
 
-def _raise_if_worker_error(payload: dict) -> dict:
-    error = payload.get("__http_error__")
+def _raise_if_worker_error(payload: dict | bytes) -> dict | bytes:
+    error = isinstance(payload, dict) and payload.get("__http_error__")
     if error:
         raise HTTPException(
             status_code=error["status_code"],
@@ -77,79 +201,284 @@ def _raise_if_worker_error(payload: dict) -> dict:
     return payload
 
 
-def _run_inline_task(task_name: str, task, *args):
-    start_time = time.perf_counter()
-    payload = task(*args)
-    elapsed = time.perf_counter() - start_time
-    perf_logger.info(
-        "Inline task completed - Task: %s | Total: %.6fs",
-        task_name,
-        elapsed,
+CACHE_STATUS_HEADER = "X-Trilogy-Cache"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+SSE_MEDIA_TYPE = "text/event-stream"
+# nginx's status for a request the client gave up on
+CLIENT_CLOSED_REQUEST = 499
+MAX_PROFILE_SECONDS = 120
+
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+T = TypeVar("T")
+
+
+def _require_admin(request: Request, admin_token: str | None) -> None:
+    """Admin endpoints need `Authorization: Bearer <admin token>`, and do not
+    exist at all when no token is configured."""
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    supplied = request.headers.get("authorization", "")
+    if not hmac.compare_digest(
+        supplied.encode("utf-8"), f"Bearer {admin_token}".encode()
+    ):
+        raise HTTPException(
+            status_code=401,
+            detail="Admin token required",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+def _load(schema: type[ModelT], payload: ModelT | bytes | dict) -> ModelT:
+    """The request model for a task: the router's validated model when the
+    task runs in-process, or the raw request body in a worker process."""
+    if isinstance(payload, bytes):
+        return schema.model_validate_json(payload)
+    if isinstance(payload, dict):
+        return schema.model_validate(payload)
+    return payload
+
+
+def _encode(payload: BaseModel | dict | list) -> bytes:
+    # pydantic-core writes JSON straight from the model, without building the
+    # intermediate dict that model_dump + json.dumps would
+    return to_json(payload)
+
+
+def _request_sources(query: BaseModel) -> list[ModelSourceInSchema]:
+    if isinstance(query, ValidateQueryInSchema):
+        return query.sources
+    if isinstance(query, (ModelInSchema, ModelDeltaInSchema)):
+        return query.sources
+    assert isinstance(query, (QueryInSchema, MultiQueryInSchema))
+    return query.full_model.sources
+
+
+def _with_sources(query: ModelT, sources: list[ModelSourceInSchema]) -> ModelT:
+    update: dict = {"sources": sources}
+    if isinstance(query, (QueryInSchema, MultiQueryInSchema)):
+        update = {"full_model": query.full_model.model_copy(update=update)}
+    return query.model_copy(update=update)
+
+
+def _resolve_blobs(blob_store: BlobStore, query: ModelT) -> ModelT | None:
+    """`query` with hash-only sources filled in from the blob store, or None
+    if it has none. Missing hashes surface as a 409 listing what to upload."""
+    sources = _request_sources(query)
+    if not any(source.sha256 for source in sources):
+        return None
+    try:
+        return _with_sources(query, blob_store.resolve(sources))
+    except MissingBlobs as exc:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Upload the missing sources", "need": exc.hashes},
+        )
+    except BlobMismatch as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+
+def _resolve_model(
+    model_sessions: ModelSessionStore, blob_store: BlobStore, query: ModelT
+) -> tuple[ModelT, str, bool]:
+    """The request with any session model or source blobs filled in, the
+    model's content hash, and whether anything was filled in."""
+    model_id = getattr(query, "model_id", None)
+    if model_id is None:
+        resolved = _resolve_blobs(blob_store, query)
+        if resolved is not None:
+            return resolved, model_cache_key(_request_sources(resolved)), True
+        return query, model_cache_key(_request_sources(query)), False
+    session = model_sessions.get(model_id)
+    if session is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Unknown model session {model_id!r}; register the model again",
+        )
+    # the filled-in request carries its model inline, so it validates again
+    # wherever it is re-read: a worker process, or a slow-request replay
+    if isinstance(query, ValidateQueryInSchema):
+        update: dict = {"sources": session.model.sources, "model_id": None}
+    else:
+        update = {"full_model": session.model, "model_id": None}
+    return query.model_copy(update=update), session.content_hash, True
+
+
+async def _prepare_request(
+    task_pool: TaskPool,
+    model_sessions: ModelSessionStore,
+    blob_store: BlobStore,
+    endpoint: str,
+    query: ModelT,
+    request: Request,
+) -> tuple[ModelT, ModelT | bytes, str]:
+    """The request with any session model or source blobs filled in, the
+    input to hand its task, and the model's content hash.
+
+    The task gets the validated request itself, or for a worker process the
+    raw body, which pickles as one flat bytes object and is validated once
+    there; pickling the validated model instead costs more than that for
+    large bodies (see benchmark_baseline.md). When the body does not carry
+    the full model, the task always gets the filled-in request.
+    """
+    query, model_key, filled = _resolve_model(model_sessions, blob_store, query)
+    task_input: ModelT | bytes = query
+    if not filled and task_pool.mode_for(endpoint) == PROCESS:
+        task_input = await request.body()
+    return query, task_input, model_key
+
+
+def _json_body(payload: dict) -> bytes:
+    # byte-for-byte what FastAPI's default JSONResponse renders for a dict
+    return json.dumps(
+        payload,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _json_response(body: dict | bytes) -> Response:
+    assert isinstance(body, bytes)
+    return Response(body, media_type="application/json")
+
+
+async def _cached_response(
+    result_cache: ResultCache, single_flight: SingleFlight, key: str, compute
+) -> Response:
+    """Serve `key` from the result cache, else compute it once for every
+    identical in-flight request and cache the encoded body."""
+    if result_cache.enabled:
+        body = result_cache.get(key)
+        if body is not None:
+            return Response(
+                body,
+                media_type="application/json",
+                headers={CACHE_STATUS_HEADER: "hit"},
+            )
+
+    async def compute_body() -> bytes:
+        body = await compute()
+        result_cache.put(key, body)
+        return body
+
+    body = await single_flight.run(key, compute_body)
+    return Response(
+        body,
+        media_type="application/json",
+        headers={CACHE_STATUS_HEADER: "miss" if result_cache.enabled else "bypass"},
     )
+
+
+async def _wait_for_disconnect(request: Request) -> None:
+    # the body has been read by now, so the next message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _unless_disconnected(request: Request, work: Awaitable[T]) -> T:
+    """Await `work`, cancelling it if the client disconnects first.
+
+    The cancel reaches pooled tasks through their cancel token, so work for
+    a browser that navigated away stops at its next phase boundary instead of
+    holding a worker until it finishes. So does cancelling the handler itself,
+    as server shutdown or Starlette tearing down the request scope do.
+    """
+    work_task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({work_task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # `work_task` runs on its own, so it has to be told; cancelling it
+        # cancels the pooled task's token
+        work_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await work_task
+        raise
+    finally:
+        watcher.cancel()
+    if not work_task.done():
+        work_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await work_task
+        # nobody reads this; it keeps the access log honest
+        raise HTTPException(
+            status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request"
+        )
+    return work_task.result()
+
+
+async def _run_task(
+    task_pool: TaskPool,
+    endpoint: str,
+    task,
+    *args,
+    affinity_key: str | None = None,
+    cancel: CancelToken | None = None,
+) -> dict | bytes:
+    try:
+        payload = await task_pool.run(
+            endpoint, task, *args, affinity_key=affinity_key, cancel=cancel
+        )
+    except TaskQueueFull as exc:
+        # not 503: the app treats 503 as a shutdown request
+        raise HTTPException(status_code=429, detail=str(exc))
     return _raise_if_worker_error(payload)
 
 
-def _format_query_task(query_data: dict) -> dict:
-    query = QueryInSchema.model_validate(query_data)
-    env = parse_env_from_full_model(
-        query.full_model.sources,
-        files=query.files,
-        working_path=query.working_path,
-    )
+def _format_query_task(query_input: QueryInSchema | bytes | dict) -> dict | bytes:
+    query = _load(QueryInSchema, query_input)
     try:
-        base_imp_string = ""
-        for imp in query.imports:
-            resolved = resolve_import_path(imp.name, query.current_filename)
-            if imp.alias:
-                base_imp_string += f"import {resolved} as {imp.alias};\n"
-            else:
-                base_imp_string += f"import {resolved};\n"
+        parsed_model = ENV_CACHE.get_parsed_model(
+            query.full_model.sources,
+            imports_to_strings(query.imports, query.current_filename),
+            files=query.files,
+            working_path=query.working_path,
+            parse_config=PARSE_CONFIG,
+        )
+        check_cancelled()
+        env = parsed_model.fork()
         _, parsed = parse_text(
             safe_format_query(
-                base_imp_string
-                + normalize_relative_imports(query.query, query.current_filename)
+                normalize_relative_imports(query.query, query.current_filename)
             ),
             env,
             parse_config=PARSE_CONFIG,
         )
+        parsed = [*parsed_model.import_statements, *parsed]
     except HTTPException as exc:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts parser errors
         return _worker_http_error(422, "Parsing error: " + str(exc))
+    check_cancelled()
     renderer = Renderer()
-    return FormatQueryOutSchema(
-        text=renderer.render_statement_string(parsed)
-    ).model_dump(mode="json")
+    return _encode(FormatQueryOutSchema(text=renderer.render_statement_string(parsed)))
 
 
-def _drilldown_query_task(query_data: dict) -> dict:
-    query = DrilldownQueryInSchema.model_validate(query_data)
-    env = parse_env_from_full_model(
-        query.full_model.sources,
-        files=query.files,
-        working_path=query.working_path,
-    )
+def _drilldown_query_task(
+    query_input: DrilldownQueryInSchema | bytes | dict,
+) -> dict | bytes:
+    query = _load(DrilldownQueryInSchema, query_input)
     try:
-        base_imp_string = ""
-        for imp in query.imports:
-            if imp.alias:
-                imp_string = (
-                    f"import {resolve_import_path(imp.name, query.current_filename)}"
-                    f" as {imp.alias};\n"
-                )
-            else:
-                imp_string = (
-                    f"import {resolve_import_path(imp.name, query.current_filename)};\n"
-                )
-            base_imp_string += imp_string
+        parsed_model = ENV_CACHE.get_parsed_model(
+            query.full_model.sources,
+            imports_to_strings(query.imports, query.current_filename),
+            files=query.files,
+            working_path=query.working_path,
+            parse_config=PARSE_CONFIG,
+        )
+        check_cancelled()
+        env = parsed_model.fork()
         _, parsed = parse_text(
             safe_format_query(
-                base_imp_string
-                + normalize_relative_imports(query.query, query.current_filename)
+                normalize_relative_imports(query.query, query.current_filename)
             ),
             env,
             parse_config=PARSE_CONFIG,
         )
+        parsed = [*parsed_model.import_statements, *parsed]
+        check_cancelled()
         _, where_parsed = parse_text(
             f"WHERE {query.drilldown_filter} SELECT 1 as __ftest;",
             env,
@@ -187,14 +516,15 @@ def _drilldown_query_task(query_data: dict) -> dict:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts parser errors
         return _worker_http_error(422, "Parsing error: " + str(exc))
+    check_cancelled()
     renderer = Renderer()
-    return FormatQueryOutSchema(
-        text=renderer.render_statement_string(parsed)
-    ).model_dump(mode="json")
+    return _encode(FormatQueryOutSchema(text=renderer.render_statement_string(parsed)))
 
 
-def _validate_query_task(query_data: dict) -> dict:
-    query = ValidateQueryInSchema.model_validate(query_data)
+def _validate_query_task(
+    query_input: ValidateQueryInSchema | bytes | dict,
+) -> dict | bytes:
+    query = _load(ValidateQueryInSchema, query_input)
     filter_validation: list[ValidateItem] = []
     parameters = query.parameters or {}
     param_declarations, cleaned_filters, _ = prepare_filter_params(
@@ -248,134 +578,132 @@ def _validate_query_task(query_data: dict) -> dict:
             current_filename=query.current_filename,
             files=query.files,
             working_path=query.working_path,
+            completion_prefix=query.completion_prefix,
         )
         base.items += filter_validation
-        return base.model_dump(mode="json")
+        return _encode(base)
     except HTTPException as exc:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts parser errors
         return _worker_http_error(422, "Parsing error: " + str(exc))
 
 
-def _generate_queries_task(queries_data: dict, enable_perf_logging: bool) -> dict:
-    queries = MultiQueryInSchema.model_validate(queries_data)
+def _generate_queries_task(
+    queries_input: MultiQueryInSchema | bytes | dict,
+    enable_perf_logging: bool,
+    indices: list[int] | None = None,
+) -> dict:
+    """Generate the sub-queries at `indices` (default: all) of a multi-query
+    request, in that order, each encoded as QueryOut JSON."""
+    queries = _load(MultiQueryInSchema, queries_input)
+    label_task(dialect=queries.dialect.value)
     perf_logger = getLogger("trilogy.performance")
-    if enable_perf_logging:
-        start_time = time.time()
-
     try:
-        dialect = get_dialect_generator(
-            queries.dialect,
-            rendering=PARAMETER_RENDERING,
-        )
-
-        if enable_perf_logging:
-            dialect_time = time.time() - start_time
-            statements_start = time.time()
-
-        statements = generate_multi_query_core(queries, dialect, enable_perf_logging)
+        with span("dialect", dialect=queries.dialect.value):
+            dialect = get_dialect_generator(
+                queries.dialect,
+                rendering=PARAMETER_RENDERING,
+            )
 
-        if enable_perf_logging:
-            statements_time = time.time() - statements_start
-            output_start = time.time()
-
-        result = MultiQueryOutSchema(
-            queries=[
-                query_to_output(
-                    target,
-                    columns,
-                    values,
-                    label,
-                    dialect,
-                    enable_perf_logging,
-                    layer_columns=layer_columns,
-                )
-                for label, target, columns, values, layer_columns in statements
-            ]
+        items = plan_multi_query_items(
+            queries,
+            dialect,
+            indices=indices,
         )
 
-        if enable_perf_logging:
-            output_time = time.time() - output_start
-            total_time = time.time() - start_time
-            perf_logger.info(
-                f"Multi-query endpoint - Total: {total_time:.4f}s | "
-                f"Dialect: {dialect_time:.4f}s ({safe_percentage(dialect_time, total_time):.1f}%) | "
-                f"Statements: {statements_time:.4f}s ({safe_percentage(statements_time, total_time):.1f}%) | "
-                f"Output: {output_time:.4f}s ({safe_percentage(output_time, total_time):.1f}%) | "
-                f"Dialect: {queries.dialect} | "
-                f"Query count: {len(queries.queries)}"
+        with span("output", query_count=len(items)):
+            result = MultiQueryOutSchema(
+                queries=[
+                    query_to_output(
+                        item.target,
+                        item.columns,
+                        item.values,
+                        item.label,
+                        dialect,
+                        layer_columns=item.layer_columns,
+                    )
+                    for item in items
+                ],
+                timings_ms=[round(item.elapsed * 1000, 3) for item in items],
             )
 
-        return result.model_dump(mode="json")
+        return {
+            "queries": [_encode(query) for query in result.queries],
+            "timings_ms": result.timings_ms,
+        }
     except HTTPException as exc:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts generation errors
         if enable_perf_logging:
-            error_time = time.time() - start_time
-            perf_logger.error(
-                f"Multi-query generation failed after {error_time:.4f}s: {exc!s}"
-            )
+            perf_logger.error(f"Multi-query generation failed: {exc!s}")
 
         return _worker_http_error(422, "Parsing error: " + str(exc))
 
 
-def _generate_query_task(query_data: dict, enable_perf_logging: bool) -> dict:
-    query = QueryInSchema.model_validate(query_data)
+def _generate_query_task(
+    query_input: QueryInSchema | bytes | dict,
+    enable_perf_logging: bool,
+    model_key: str | None = None,
+) -> dict | bytes:
+    """`model_key` is the request's model content hash when the router has
+    already computed it."""
+    query = _load(QueryInSchema, query_input)
+    label_task(dialect=query.dialect.value)
+    with SLOW_REQUESTS.watch("generate_query", lambda: query.model_dump(mode="json")):
+        return _generate_query(query, enable_perf_logging, model_key)
+
+
+def replay_generate_query(capture: dict[str, Any]) -> Replay:
+    """Run a captured `generate_query` request again under cProfile."""
+    return replay_capture(capture, _generate_query_task)
+
+
+def _generate_query(
+    query: QueryInSchema, enable_perf_logging: bool, model_key: str | None = None
+) -> dict | bytes:
     perf_logger = getLogger("trilogy.performance")
-    if enable_perf_logging:
-        start_time = time.perf_counter()
-        query_size = len(query.query)
-        perf_logger.info(
-            f"Starting query generation - Size: {query_size} chars | Dialect: {query.dialect}"
-        )
+    # a request that differs from an earlier one only in parameter values
+    # reuses its compiled SQL
+    shape_key = template_key(query, model_key)
+    if shape_key is not None and query.parameters:
+        rendered = QUERY_TEMPLATES.render(shape_key, query.parameters)
+        if rendered is not None:
+            if enable_perf_logging:
+                perf_logger.info(
+                    "Query generation served from template - Dialect: %s",
+                    query.dialect,
+                )
+            return _encode(rendered)
     try:
-        dialect_start = time.perf_counter()
-        dialect = get_dialect_generator(
-            query.dialect,
-            rendering=PARAMETER_RENDERING,
-        )
-        dialect_time = time.perf_counter() - dialect_start
+        with span("dialect", dialect=query.dialect.value):
+            dialect = get_dialect_generator(
+                query.dialect,
+                rendering=PARAMETER_RENDERING,
+            )
 
-        core_start = time.perf_counter()
         target, columns, results, select_count, layer_columns = generate_query_core(
-            query, dialect, enable_perf_logging
-        )
-        core_time = time.perf_counter() - core_start
-
-        output_start = time.perf_counter()
-        result = query_to_output(
-            target,
-            columns,
-            results,
-            "default",
-            dialect,
-            enable_perf_logging,
-            select_count,
-            layer_columns,
+            query, dialect
         )
-        output_time = time.perf_counter() - output_start
+        check_cancelled()
 
-        if enable_perf_logging:
-            total_time = time.perf_counter() - start_time
-            sql_size = len(result.generated_sql) if result.generated_sql else 0
-            accounted_time = dialect_time + core_time + output_time
-            unaccounted_time = total_time - accounted_time
-
-            perf_logger.info(
-                f"Query generation completed - Total: {total_time:.6f}s | "
-                f"Dialect setup: {dialect_time:.6f}s ({safe_percentage(dialect_time, total_time):.1f}%) | "
-                f"Core processing: {core_time:.6f}s ({safe_percentage(core_time, total_time):.1f}%) | "
-                f"Output formatting: {output_time:.6f}s ({safe_percentage(output_time, total_time):.1f}%) | "
-                f"Unaccounted: {unaccounted_time:.6f}s ({safe_percentage(unaccounted_time, total_time):.1f}%) | "
-                f"Input size: {query_size} chars | "
-                f"Output size: {sql_size} chars | "
-                f"Dialect: {query.dialect}"
+        with span("output"):
+            result = query_to_output(
+                target,
+                columns,
+                results,
+                "default",
+                dialect,
+                select_count,
+                layer_columns,
             )
-        return result.model_dump(mode="json")
+        if shape_key is not None and query.parameters:
+            QUERY_TEMPLATES.store(
+                shape_key, query.parameters, result.model_dump(mode="json")
+            )
+        return _encode(result)
     except InvalidSyntaxException as exc:
         if enable_perf_logging:
-            error_time = time.perf_counter() - start_time
-            perf_logger.error(f"Syntax error in query: {error_time:.6f}s: {exc!s}")
+            perf_logger.error(f"Syntax error in query: {exc!s}")
         return _http_error_payload(
             HTTPException(status_code=422, detail=f"Syntax error: {exc.args[0]}")
         )
@@ -383,102 +711,491 @@ def _generate_query_task(query_data: dict, enable_perf_logging: bool) -> dict:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts generation errors
         if enable_perf_logging:
-            error_time = time.perf_counter() - start_time
             tb = traceback.format_exc()
-            perf_logger.error(
-                f"Query generation failed after {error_time:.6f}s: {exc!s} {tb}"
-            )
+            perf_logger.error(f"Query generation failed: {exc!s} {tb}")
         return _worker_http_error(422, str(exc))
 
 
-def _parse_model_task(model_data: dict, enable_perf_logging: bool) -> dict:
-    model = ModelInSchema.model_validate(model_data)
+def _parse_model_task(
+    model_input: ModelInSchema | bytes | dict, enable_perf_logging: bool
+) -> dict | bytes:
+    model = _load(ModelInSchema, model_input)
     perf_logger = getLogger("trilogy.performance")
-    if enable_perf_logging:
-        start_time = time.time()
-
     try:
-        result = model_to_response(model)
-
-        if enable_perf_logging:
-            total_time = time.time() - start_time
-            perf_logger.info(
-                f"Model parsing - Total: {total_time:.4f}s | Model size: {len(str(model))} chars"
+        with span("parse_model", source_count=len(model.sources)):
+            result = model_to_response(
+                model, SOURCE_ENV_CACHE.parse_model_graph(model.sources)
             )
-
-        return result.model_dump(mode="json")
+        return _encode(result)
     except HTTPException as exc:
         return _http_error_payload(exc)
     except Exception as exc:  # noqa: BLE001 -- HTTP boundary converts generation errors
         if enable_perf_logging:
-            error_time = time.time() - start_time
-            perf_logger.error(f"Model parsing failed after {error_time:.4f}s: {exc!s}")
+            perf_logger.error(f"Model parsing failed: {exc!s}")
 
         return _worker_http_error(422, "Parsing error: " + str(exc))
 
 
-def create_trilogy_router(enable_perf_logging: bool = False) -> APIRouter:
+def multi_query_chunks(count: int, workers: int) -> list[list[int]]:
+    """Split sub-query indices round-robin into at most `workers` chunks."""
+    return [list(range(start, count, workers)) for start in range(min(count, workers))]
+
+
+def _multi_query_body(queries: list[bytes], timings_ms: list[float]) -> bytes:
+    # the queries arrive encoded from the task and are spliced in as-is
+    return (
+        b'{"queries":['
+        + b",".join(queries)
+        + b'],"timings_ms":'
+        + _encode(timings_ms)
+        + b"}"
+    )
+
+
+async def _gather_or_cancel(awaitables: Iterable[Awaitable[T]]) -> list[T]:
+    """`asyncio.gather`, except that the first failure cancels the rest and
+    waits for them to stop, so a failed request does not keep workers busy."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _run_generate_queries(
+    task_pool: TaskPool,
+    queries_input: MultiQueryInSchema | bytes,
+    count: int,
+    enable_perf_logging: bool,
+    affinity_key: str | None = None,
+) -> bytes:
+    """Run /generate_queries, spreading the sub-queries over the worker
+    processes that already have the model cached, in process mode.
+
+    A split only pays off where the model is warm: every worker that gets a
+    chunk of a model it has not seen parses the whole model first. So a
+    request runs as one task until its model is cached on several workers.
+    """
+    workers = 0
+    if task_pool.mode_for("generate_queries") == PROCESS and affinity_key:
+        workers = task_pool.warm_workers(affinity_key)
+    if count < 2 or workers < 2:
+        result = await _run_task(
+            task_pool,
+            "generate_queries",
+            _generate_queries_task,
+            queries_input,
+            enable_perf_logging,
+            affinity_key=affinity_key,
+        )
+        assert isinstance(result, dict)
+        return _multi_query_body(result["queries"], result["timings_ms"])
+    chunks = multi_query_chunks(count, workers)
+    # the affinity key sends each chunk to the least-loaded warm worker
+    results = await _gather_or_cancel(
+        _run_task(
+            task_pool,
+            "generate_queries",
+            _generate_queries_task,
+            queries_input,
+            enable_perf_logging,
+            chunk,
+            affinity_key=affinity_key,
+        )
+        for chunk in chunks
+    )
+    queries: list = [None] * count
+    timings_ms: list = [None] * count
+    for chunk, result in zip(chunks, results):
+        assert isinstance(result, dict)
+        for position, idx in enumerate(chunk):
+            queries[idx] = result["queries"][position]
+            timings_ms[idx] = result["timings_ms"][position]
+    return _multi_query_body(queries, timings_ms)
+
+
+def stream_media_type(accept: str | None) -> str | None:
+    """The streaming format named in an Accept header, if any."""
+    for media_type in (NDJSON_MEDIA_TYPE, SSE_MEDIA_TYPE):
+        if accept and media_type in accept:
+            return media_type
+    return None
+
+
+def _stream_line(body: bytes, media_type: str) -> bytes:
+    if media_type == SSE_MEDIA_TYPE:
+        return b"event: query\ndata: " + body + b"\n\n"
+    return body + b"\n"
+
+
+async def _stream_generate_queries(
+    task_pool: TaskPool,
+    queries_input: MultiQueryInSchema | bytes,
+    labels: list[str | None],
+    enable_perf_logging: bool,
+    media_type: str,
+    affinity_key: str | None = None,
+) -> AsyncIterator[bytes]:
+    """Plan each sub-query as its own task and emit it as soon as it is done,
+    in completion order, tagged with its request index and label. Tasks are
+    routed by `affinity_key`, so they only reach a worker without the model
+    cached when the warm ones are full."""
+    limit = asyncio.Semaphore(max(1, task_pool.settings.process_pool_size))
+
+    async def generate(index: int) -> bytes:
+        async with limit:
+            try:
+                result = await _run_task(
+                    task_pool,
+                    "generate_queries",
+                    _generate_queries_task,
+                    queries_input,
+                    enable_perf_logging,
+                    [index],
+                    affinity_key=affinity_key,
+                )
+            except HTTPException as exc:
+                return _json_body(
+                    {
+                        "index": index,
+                        "label": labels[index],
+                        "status_code": exc.status_code,
+                        "error": exc.detail,
+                    }
+                )
+        assert isinstance(result, dict)
+        head = _encode(
+            {
+                "index": index,
+                "label": labels[index],
+                "timing_ms": result["timings_ms"][0],
+            }
+        )
+        return head[:-1] + b',"query":' + result["queries"][0] + b"}"
+
+    pending = [asyncio.ensure_future(generate(i)) for i in range(len(labels))]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            yield _stream_line(await next_done, media_type)
+        if media_type == SSE_MEDIA_TYPE:
+            yield b"event: done\ndata: {}\n\n"
+    finally:
+        # the client went away mid-stream: stop what is queued or running
+        for task in pending:
+            task.cancel()
+
+
+def create_trilogy_router(
+    enable_perf_logging: bool = False,
+    task_pool: TaskPool | None = None,
+    single_flight: SingleFlight | None = None,
+    result_cache: ResultCache | None = None,
+    model_sessions: ModelSessionStore | None = None,
+    blob_store: BlobStore | None = None,
+    metrics: MetricsRegistry | None = None,
+    admin_token: str | None = None,
+) -> APIRouter:
     """
     Create and configure the Trilogy API router with all endpoints.
 
     Args:
         enable_perf_logging: Whether to enable performance logging for requests
+        task_pool: Backend that runs the endpoint tasks; defaults to the
+            module-level TASK_POOL configured from the environment
+        single_flight: Coalesces identical in-flight generate requests;
+            defaults to a new one per router
+        result_cache: Cache of encoded generate responses; defaults to a new
+            one per router configured from the environment
+        model_sessions: Store of registered models that requests can name by
+            `model_id`; defaults to one configured from the environment
+        blob_store: Source texts that requests can reference by sha256;
+            defaults to one per router configured from the environment
+        metrics: Registry served at /metrics; defaults to the task pool's
+        admin_token: Bearer token for the /admin endpoints; defaults to
+            TRILOGY_ADMIN_TOKEN, and without one they are disabled
 
     Returns:
         Configured APIRouter instance with all Trilogy endpoints
     """
-    router = APIRouter()
+    task_pool = task_pool or TASK_POOL
+    single_flight = single_flight or SingleFlight()
+    result_cache = result_cache or ResultCache.from_env()
+    model_sessions = model_sessions or ModelSessionStore.from_env()
+    blob_store = blob_store or BlobStore.from_env()
+    metrics = metrics or task_pool.metrics
+    admin_token = admin_token or os.environ.get("TRILOGY_ADMIN_TOKEN")
+    metrics.add_collector("task_pool", lambda: _pool_samples(task_pool))
+    register_cache_stats("result", result_cache.stats)
+    register_cache_stats("single_flight", single_flight.stats)
+    register_cache_stats("blob", blob_store.stats)
+    register_cache_stats("model_session", model_sessions.stats)
+    router = APIRouter(
+        on_startup=[task_pool.start], on_shutdown=[task_pool.shutdown, metrics.shutdown]
+    )
 
     @router.post("/format_query")
-    async def format_query(query: QueryInSchema):
-        return _run_inline_task(
-            "format_query",
-            _format_query_task,
-            query.model_dump(mode="json"),
+    async def format_query(query: QueryInSchema, request: Request):
+        query, task_input, model_key = await _prepare_request(
+            task_pool, model_sessions, blob_store, "format_query", query, request
+        )
+        return _json_response(
+            await _unless_disconnected(
+                request,
+                _run_task(
+                    task_pool,
+                    "format_query",
+                    _format_query_task,
+                    task_input,
+                    affinity_key=model_key,
+                ),
+            )
         )
 
     @router.post("/drilldown_query")
-    async def drilldown_query(query: DrilldownQueryInSchema):
-        return _run_inline_task(
-            "drilldown_query",
-            _drilldown_query_task,
-            query.model_dump(mode="json"),
+    async def drilldown_query(query: DrilldownQueryInSchema, request: Request):
+        query, task_input, model_key = await _prepare_request(
+            task_pool, model_sessions, blob_store, "drilldown_query", query, request
+        )
+        return _json_response(
+            await _unless_disconnected(
+                request,
+                _run_task(
+                    task_pool,
+                    "drilldown_query",
+                    _drilldown_query_task,
+                    task_input,
+                    affinity_key=model_key,
+                ),
+            )
         )
 
     @router.post("/validate_query")
-    async def validate_query(query: ValidateQueryInSchema):
-        return _raise_if_worker_error(
-            await asyncio.to_thread(_validate_query_task, query.model_dump(mode="json"))
+    async def validate_query(query: ValidateQueryInSchema, request: Request):
+        query, task_input, model_key = await _prepare_request(
+            task_pool, model_sessions, blob_store, "validate_query", query, request
+        )
+        return _json_response(
+            await _unless_disconnected(
+                request,
+                _run_task(
+                    task_pool,
+                    "validate_query",
+                    _validate_query_task,
+                    task_input,
+                    affinity_key=model_key,
+                ),
+            )
         )
 
     @router.post("/generate_queries")
-    async def generate_queries(queries: MultiQueryInSchema):
-        return _raise_if_worker_error(
-            await asyncio.to_thread(
-                _generate_queries_task,
-                queries.model_dump(mode="json"),
-                enable_perf_logging,
+    async def generate_queries(queries: MultiQueryInSchema, request: Request):
+        queries, queries_input, model_key = await _prepare_request(
+            task_pool, model_sessions, blob_store, "generate_queries", queries, request
+        )
+        media_type = stream_media_type(request.headers.get("accept"))
+        if media_type is not None:
+            return StreamingResponse(
+                _stream_generate_queries(
+                    task_pool,
+                    queries_input,
+                    [q.label for q in queries.queries],
+                    enable_perf_logging,
+                    media_type,
+                    affinity_key=model_key,
+                ),
+                media_type=media_type,
             )
+        return await _unless_disconnected(
+            request,
+            _cached_response(
+                result_cache,
+                single_flight,
+                request_key("generate_queries", queries, model_key),
+                lambda: _run_generate_queries(
+                    task_pool,
+                    queries_input,
+                    len(queries.queries),
+                    enable_perf_logging,
+                    affinity_key=model_key,
+                ),
+            ),
         )
 
     @router.post("/generate_query")
-    async def generate_query(query: QueryInSchema):
-        return _raise_if_worker_error(
-            await asyncio.to_thread(
-                _generate_query_task,
-                query.model_dump(mode="json"),
-                enable_perf_logging,
-            )
+    async def generate_query(query: QueryInSchema, request: Request):
+        query, query_input, model_key = await _prepare_request(
+            task_pool, model_sessions, blob_store, "generate_query", query, request
+        )
+        return await _unless_disconnected(
+            request,
+            _cached_response(
+                result_cache,
+                single_flight,
+                request_key("generate_query", query, model_key),
+                lambda: _run_task(
+                    task_pool,
+                    "generate_query",
+                    _generate_query_task,
+                    query_input,
+                    enable_perf_logging,
+                    model_key,
+                    affinity_key=model_key,
+                ),
+            ),
         )
 
     @router.post("/parse_model")
-    async def parse_model(model: ModelInSchema):
-        return _raise_if_worker_error(
-            await asyncio.to_thread(
-                _parse_model_task,
-                model.model_dump(mode="json"),
-                enable_perf_logging,
+    async def parse_model(model: ModelInSchema, request: Request):
+        model_input: ModelInSchema | bytes | None = _resolve_blobs(blob_store, model)
+        if model_input is None:
+            model_input = model
+            if task_pool.mode_for("parse_model") == PROCESS:
+                model_input = await request.body()
+        return _json_response(
+            await _unless_disconnected(
+                request,
+                _run_task(
+                    task_pool,
+                    "parse_model",
+                    _parse_model_task,
+                    model_input,
+                    enable_perf_logging,
+                ),
+            )
+        )
+
+    def _session_out(session: ModelSession) -> ModelSessionOutSchema:
+        return ModelSessionOutSchema(
+            model_id=session.model_id, content_hash=session.content_hash
+        )
+
+    def _unknown_session(model_id: str) -> HTTPException:
+        return HTTPException(
+            status_code=404, detail=f"Unknown model session {model_id!r}"
+        )
+
+    @router.post("/models")
+    async def register_model(model: ModelInSchema) -> ModelSessionOutSchema:
+        model = _resolve_blobs(blob_store, model) or model
+        return _session_out(model_sessions.register(model))
+
+    @router.get("/models/{model_id}")
+    async def get_model(model_id: str) -> ModelSessionOutSchema:
+        session = model_sessions.get(model_id)
+        if session is None:
+            raise _unknown_session(model_id)
+        return _session_out(session)
+
+    @router.patch("/models/{model_id}")
+    async def update_model(
+        model_id: str, delta: ModelDeltaInSchema, request: Request
+    ) -> ModelSessionOutSchema:
+        """Apply a delta. With `If-Match: <content_hash>` it only applies to
+        that version of the model, and gets a `409` once the model changed."""
+        delta = _resolve_blobs(blob_store, delta) or delta
+        if_match = request.headers.get("if-match")
+        try:
+            session = model_sessions.update(
+                model_id,
+                delta.sources,
+                delta.removed,
+                expected_hash=if_match.strip().strip('"') if if_match else None,
             )
+        except StaleModelSession as exc:
+            raise HTTPException(status_code=409, detail=str(exc)) from exc
+        if session is None:
+            raise _unknown_session(model_id)
+        return _session_out(session)
+
+    @router.delete("/models/{model_id}", status_code=204)
+    async def delete_model(model_id: str) -> None:
+        if not model_sessions.delete(model_id):
+            raise _unknown_session(model_id)
+
+    @router.post("/blobs")
+    async def upload_blobs(blobs: BlobUploadInSchema) -> BlobUploadOutSchema:
+        return BlobUploadOutSchema(
+            hashes=[blob_store.put(contents) for contents in blobs.contents]
+        )
+
+    # editor channel action -> (endpoint, request schema, task)
+    editor_actions: dict[str, tuple[str, type[BaseModel], Callable]] = {
+        "validate": ("validate_query", ValidateQueryInSchema, _validate_query_task),
+        "format": ("format_query", QueryInSchema, _format_query_task),
+    }
+    editor_debounce = editor_debounce_seconds()
+
+    async def analyse_edit(
+        action: str, request: dict[str, Any], token: CancelToken
+    ) -> bytes:
+        endpoint, schema, task = editor_actions[action]
+        try:
+            query = schema.model_validate(request)
+        except ValidationError as exc:
+            raise HTTPException(status_code=422, detail=exc.errors(include_url=False))
+        query, model_key, _ = _resolve_model(model_sessions, blob_store, query)
+        task_input: BaseModel | bytes = query
+        if task_pool.mode_for(endpoint) == PROCESS:
+            task_input = _encode(query)
+        payload = await _run_task(
+            task_pool, endpoint, task, task_input, affinity_key=model_key, cancel=token
+        )
+        assert isinstance(payload, bytes)
+        return payload
+
+    @router.websocket("/editor")
+    async def editor(websocket: WebSocket):
+        await websocket.accept()
+        session = EditorSession(analyse_edit, websocket.send_text, editor_debounce)
+        try:
+            while True:
+                text = await websocket.receive_text()
+                try:
+                    message = EditorMessageInSchema.model_validate_json(text)
+                except ValidationError as exc:
+                    await session.reply(
+                        editor_reply(
+                            None, None, 422, detail=exc.errors(include_url=False)
+                        )
+                    )
+                    continue
+                session.submit(message.action, message.version, message.request)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await session.close()
+
+    @router.get("/metrics")
+    async def prometheus_metrics() -> Response:
+        return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+    @router.get("/admin/profile")
+    async def profile(
+        request: Request,
+        seconds: float = Query(default=10.0, gt=0, le=MAX_PROFILE_SECONDS),
+        hz: float = Query(default=100.0, gt=0, le=1000),
+        idle: bool = False,
+        lines: bool = False,
+    ) -> Response:
+        """Sample every thread of the server and its worker processes for
+        `seconds`, `hz` times a second, as folded stacks for a flame graph.
+        `idle` keeps threads that are waiting for work, and `lines` splits
+        functions by line number."""
+        _require_admin(request, admin_token)
+        profile_request = ProfileRequest(
+            seconds=seconds, interval=1 / hz, include_idle=idle, line_numbers=lines
+        )
+        try:
+            stacks = await asyncio.to_thread(task_pool.profile, profile_request)
+        except ProfilerBusy as exc:
+            raise HTTPException(status_code=409, detail=str(exc)) from exc
+        filename = f"trilogy-{time.strftime('%Y%m%dT%H%M%S')}.folded"
+        return PlainTextResponse(
+            render_folded(stacks),
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
         )
 
     @router.get("/")
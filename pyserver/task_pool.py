@@ -0,0 +1,694 @@
+"""Execution backends for the CPU-bound studio tasks.
+
+Parsing and SQL generation are pure Python, so running them with
+`asyncio.to_thread` serializes every request on the GIL. The `_*_task`
+functions in `studio_endpoints` take and return plain dicts, so they can run
+in a process pool as-is. Each endpoint picks one of three modes:
+
+- `inline`: run on the event loop (blocks every other request, including
+  health checks; meant for tests and debugging)
+- `thread`: run in the loop's default thread pool
+- `process`: run in a worker process, routed by model affinity
+
+Settings come from the environment:
+
+- `TRILOGY_POOL_MODE`: default mode for pooled endpoints (default `thread`;
+  `process` opts in to worker processes)
+- `TRILOGY_POOL_MODE_<ENDPOINT>`: per-endpoint override, e.g.
+  `TRILOGY_POOL_MODE_GENERATE_QUERY=thread`
+- `TRILOGY_PROCESS_POOL_SIZE`: worker processes (default 2)
+- `TRILOGY_POOL_LIMIT_<ENDPOINT>`: most tasks of one endpoint running at
+  once; further tasks wait for a slot (0 or unset means no limit)
+- `TRILOGY_POOL_MAX_QUEUE`: thread/process tasks allowed in flight before new
+  ones are rejected (default 128)
+- `TRILOGY_POOL_MAX_TASKS_PER_WORKER`: recycle a worker process after this
+  many tasks; 0 disables recycling (default 500)
+- `TRILOGY_POOL_WORKER_MAX_PENDING`: tasks a worker may hold (running plus
+  queued) before model-affinity routing spills to another worker (default 2)
+
+A task stops at its next `check_cancelled()` once its `CancelToken` is
+cancelled (see `cancellation`). Cancelling the coroutine awaiting
+`TaskPool.run` cancels the token too, so work nobody is waiting for any more
+gives its thread or worker process back at the next phase boundary.
+
+`TaskPool.profile` samples the stacks of the server and of every running
+worker process at once (see `profiling`), without restarting anything.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import importlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Iterator, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import (
+    AbstractAsyncContextManager,
+    contextmanager,
+    nullcontext,
+    suppress,
+)
+from dataclasses import dataclass, field, replace
+from logging import getLogger
+from multiprocessing.connection import Connection
+
+from cancellation import (
+    CancelToken,
+    TaskCancelled,
+    cancellation_scope,
+    check_cancelled,
+    install_shared_flags,
+)
+from metrics import METRICS, MetricsRegistry, TaskReport, task_report
+from profiling import ProfileRequest, sample_stacks, start_profile_listener
+from tracing import TRACER, Span, set_tracing_enabled, span, tracing_enabled
+
+logger = getLogger(__name__)
+perf_logger = getLogger("trilogy.performance")
+
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+POOL_MODES = (INLINE, THREAD, PROCESS)
+
+DEFAULT_POOL_MODE = THREAD
+DEFAULT_PROCESS_POOL_SIZE = 2
+DEFAULT_MAX_QUEUE_DEPTH = 128
+DEFAULT_MAX_TASKS_PER_WORKER = 500
+DEFAULT_MAX_PENDING_PER_WORKER = 2
+# affinity keys remembered per worker; a worker's environment cache holds
+# 64 models by default (see env_cache)
+WARM_KEYS_PER_WORKER = 64
+# process tasks that can hold a cancellable token at once; tasks beyond this
+# still run, they just cannot be cancelled once they reach a worker
+CANCEL_SLOTS = 1024
+
+# how long past the sampling window to wait for a worker's stacks
+PROFILE_REPLY_GRACE_SECONDS = 5.0
+
+# Modules imported by every worker before its first task, so a fresh or
+# recycled worker never pays the trilogy/lark import on a live request.
+WORKER_PRELOAD_MODULES = ("lark", "trilogy", "studio_endpoints")
+
+
+class TaskQueueFull(RuntimeError):
+    """Raised when a task is submitted while the queue is at capacity."""
+
+
+class ProfilerBusy(RuntimeError):
+    """Raised when a profile is requested while another is running."""
+
+
+def _parse_mode(value: str, name: str) -> str:
+    mode = value.strip().lower()
+    if mode not in POOL_MODES:
+        raise ValueError(
+            f"{name} must be one of {', '.join(POOL_MODES)}; got '{value}'"
+        )
+    return mode
+
+
+@dataclass
+class TaskPoolSettings:
+    default_mode: str = DEFAULT_POOL_MODE
+    endpoint_modes: dict[str, str] = field(default_factory=dict)
+    endpoint_limits: dict[str, int] = field(default_factory=dict)
+    process_pool_size: int = DEFAULT_PROCESS_POOL_SIZE
+    max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH
+    max_tasks_per_worker: int = DEFAULT_MAX_TASKS_PER_WORKER
+    max_pending_per_worker: int = DEFAULT_MAX_PENDING_PER_WORKER
+    preload_modules: tuple[str, ...] = WORKER_PRELOAD_MODULES
+
+    @classmethod
+    def from_env(
+        cls,
+        endpoint_defaults: Mapping[str, str] | None = None,
+        environ: Mapping[str, str] | None = None,
+        endpoint_limits: Mapping[str, int] | None = None,
+    ) -> "TaskPoolSettings":
+        """Read settings from `environ` (default `os.environ`).
+
+        `endpoint_defaults` are modes for endpoints that should not follow
+        `TRILOGY_POOL_MODE`, and `endpoint_limits` are default per-endpoint
+        concurrency limits; `TRILOGY_POOL_MODE_<ENDPOINT>` and
+        `TRILOGY_POOL_LIMIT_<ENDPOINT>` variables override them.
+        """
+        environ = os.environ if environ is None else environ
+        endpoint_modes = {
+            endpoint: _parse_mode(mode, endpoint)
+            for endpoint, mode in (endpoint_defaults or {}).items()
+        }
+        prefix = "TRILOGY_POOL_MODE_"
+        for key, value in environ.items():
+            if key.startswith(prefix) and value:
+                endpoint_modes[key[len(prefix) :].lower()] = _parse_mode(value, key)
+        limits = dict(endpoint_limits or {})
+        prefix = "TRILOGY_POOL_LIMIT_"
+        for key, value in environ.items():
+            if key.startswith(prefix) and value:
+                limits[key[len(prefix) :].lower()] = int(value)
+        return cls(
+            default_mode=_parse_mode(
+                environ.get("TRILOGY_POOL_MODE", DEFAULT_POOL_MODE),
+                "TRILOGY_POOL_MODE",
+            ),
+            endpoint_modes=endpoint_modes,
+            endpoint_limits={
+                endpoint: limit for endpoint, limit in limits.items() if limit > 0
+            },
+            process_pool_size=max(
+                1,
+                int(
+                    environ.get("TRILOGY_PROCESS_POOL_SIZE", DEFAULT_PROCESS_POOL_SIZE)
+                ),
+            ),
+            max_queue_depth=int(
+                environ.get("TRILOGY_POOL_MAX_QUEUE", DEFAULT_MAX_QUEUE_DEPTH)
+            ),
+            max_tasks_per_worker=int(
+                environ.get(
+                    "TRILOGY_POOL_MAX_TASKS_PER_WORKER", DEFAULT_MAX_TASKS_PER_WORKER
+                )
+            ),
+            max_pending_per_worker=max(
+                1,
+                int(
+                    environ.get(
+                        "TRILOGY_POOL_WORKER_MAX_PENDING",
+                        DEFAULT_MAX_PENDING_PER_WORKER,
+                    )
+                ),
+            ),
+        )
+
+    def mode_for(self, endpoint: str) -> str:
+        return self.endpoint_modes.get(endpoint, self.default_mode)
+
+    @property
+    def uses_processes(self) -> bool:
+        return PROCESS in (self.default_mode, *self.endpoint_modes.values())
+
+
+@dataclass
+class TaskPoolStats:
+    in_flight: int = 0
+    # of those, tasks still waiting for a thread, a worker or an endpoint slot
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    completed: int = 0
+    rejected: int = 0
+    pool_restarts: int = 0
+    affinity_routed: int = 0
+    spilled: int = 0
+    # tasks stopped by their cancel token before finishing
+    cancelled: int = 0
+    # estimated run time the cancelled tasks did not use: for each, the
+    # endpoint's mean run time less how long the task ran before stopping
+    cancelled_seconds_saved: float = 0.0
+    worker_in_flight: list[int] = field(default_factory=list)
+
+
+def _initialize_worker(
+    preload_modules: tuple[str, ...],
+    cancel_flags=None,
+    tracing: bool = False,
+    profile_connection: Connection | None = None,
+) -> None:
+    install_shared_flags(cancel_flags)
+    set_tracing_enabled(tracing)
+    if profile_connection is not None:
+        start_profile_listener(profile_connection)
+    for module in preload_modules:
+        importlib.import_module(module)
+
+
+def _timed_call(
+    task: Callable, args: tuple, token: CancelToken | None = None
+) -> tuple[object, float, TaskReport]:
+    start_time = time.perf_counter()
+    try:
+        with cancellation_scope(token), task_report() as report:
+            # a task cancelled while it queued is dropped before it starts
+            check_cancelled()
+            payload = task(*args)
+    except TaskCancelled as exc:
+        exc.run_time = time.perf_counter() - start_time
+        raise
+    return payload, time.perf_counter() - start_time, report
+
+
+def _worker_context():
+    """forkserver where available: workers fork from a clean server process
+    that has already imported the preload modules, instead of from a
+    threaded uvicorn worker."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+class ConsistentHashRing:
+    """Maps keys onto `nodes` workers with `replicas` virtual points each.
+
+    Resizing the pool only moves the keys owned by the added or removed
+    worker, so the remaining workers keep their warm caches.
+    """
+
+    def __init__(self, nodes: int, replicas: int = 64):
+        self.nodes = nodes
+        points = sorted(
+            (_ring_hash(f"worker-{node}:{replica}"), node)
+            for node in range(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def candidates(self, key: str) -> list[int]:
+        """Every node, in ring order starting from the key's home node."""
+        start = bisect.bisect(self._hashes, _ring_hash(key))
+        ordered: list[int] = []
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if node not in ordered:
+                ordered.append(node)
+                if len(ordered) == self.nodes:
+                    break
+        return ordered
+
+
+@dataclass
+class _WorkerSlot:
+    executor: ProcessPoolExecutor | None = None
+    in_flight: int = 0
+    # server end of the worker's profile pipe (see `profiling`)
+    profiler: Connection | None = None
+    # affinity keys of recent tasks, least recent first: models the worker
+    # has most likely cached
+    warm_keys: OrderedDict[str, None] = field(default_factory=OrderedDict)
+
+
+class TaskPool:
+    """Runs studio tasks inline, on a thread, or in a worker process.
+
+    Each worker process is its own single-worker executor, so tasks can be
+    routed to a specific worker (see `_route`). Workers are created on first
+    use, so importing this module (for example under gunicorn `--preload`)
+    never forks. Thread and process tasks share one in-flight budget;
+    submissions beyond it raise `TaskQueueFull` rather than queueing without
+    bound.
+    """
+
+    def __init__(
+        self, settings: TaskPoolSettings, metrics: MetricsRegistry | None = None
+    ):
+        self.settings = settings
+        # phase timings and worker cache stats of finished tasks go here
+        self.metrics = metrics or METRICS
+        self._slots = [_WorkerSlot() for _ in range(settings.process_pool_size)]
+        self._ring = ConsistentHashRing(settings.process_pool_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # thread tasks that have a thread; a busy worker runs one task
+        self._threads_running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._pool_restarts = 0
+        self._affinity_routed = 0
+        self._spilled = 0
+        self._cancelled = 0
+        self._cancelled_seconds_saved = 0.0
+        # endpoint -> (tasks completed, total run time), to value cancellations
+        self._run_times: dict[str, tuple[int, float]] = {}
+        # shared cancel flags for worker processes, created with the first
+        # worker so a `--preload`ed pool is never shared across forks
+        self._cancel_flags = None
+        self._free_cancel_slots = list(range(CANCEL_SLOTS))
+        self._profiling = threading.Lock()
+        self._profile_requests = 0
+        # asyncio primitives belong to one loop, and tests run several
+        self._limiters: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]
+        ] = weakref.WeakKeyDictionary()
+
+    def mode_for(self, endpoint: str) -> str:
+        return self.settings.mode_for(endpoint)
+
+    async def run(
+        self,
+        endpoint: str,
+        task: Callable,
+        *args,
+        affinity_key: str | None = None,
+        cancel: CancelToken | None = None,
+    ):
+        """Run `task(*args)` in the endpoint's mode.
+
+        `affinity_key` (usually a model content hash) pins process tasks to a
+        worker, so that worker's environment cache stays warm for the model.
+        Cancelling `cancel` makes the task raise `TaskCancelled` at its next
+        phase boundary. Cancelling the awaiting coroutine does the same, and
+        raises CancelledError once the task has stopped.
+        """
+        mode = self.mode_for(endpoint)
+        token = cancel or CancelToken()
+        start_time = time.perf_counter()
+        with span(endpoint, mode=mode) as task_span:
+            try:
+                if mode == INLINE:
+                    payload, run_time, report = _timed_call(task, args, token)
+                else:
+                    with self._lock:
+                        if self._in_flight >= self.settings.max_queue_depth:
+                            self._rejected += 1
+                            raise TaskQueueFull(
+                                f"Server is busy: {self._in_flight} tasks already queued"
+                            )
+                        self._in_flight += 1
+                    try:
+                        async with self._endpoint_limit(endpoint):
+                            if mode == THREAD:
+                                work = asyncio.to_thread(
+                                    self._run_in_thread, task, args, token
+                                )
+                            else:
+                                work = self._run_in_process(
+                                    task, args, affinity_key, token
+                                )
+                            payload, run_time, report = await self._until_stopped(
+                                endpoint, work, token
+                            )
+                    finally:
+                        with self._lock:
+                            self._in_flight -= 1
+            except TaskCancelled as exc:
+                self._record_cancelled(endpoint, exc.run_time)
+                raise
+            with self._lock:
+                self._completed += 1
+                runs, total = self._run_times.get(endpoint, (0, 0.0))
+                self._run_times[endpoint] = (runs + 1, total + run_time)
+            elapsed = time.perf_counter() - start_time
+            self.metrics.record_task(endpoint, elapsed - run_time, run_time, report)
+            task_span.set(process=report.process, queued=elapsed - run_time)
+            if report.spans and isinstance(task_span, Span):
+                TRACER.adopt(report.spans, task_span)
+            perf_logger.info(
+                "Pool task completed - Task: %s | Mode: %s | Queued: %.6fs | Run: %.6fs | Total: %.6fs",
+                endpoint,
+                mode,
+                elapsed - run_time,
+                run_time,
+                elapsed,
+            )
+        return payload
+
+    async def _until_stopped(
+        self, endpoint: str, work: Awaitable, token: CancelToken
+    ) -> tuple[object, float, TaskReport]:
+        """Await `work`. If the caller is cancelled first, cancel the task
+        and wait for it to stop, so the in-flight count and the worker's
+        pending count only drop once its thread or process is free."""
+        future = asyncio.ensure_future(work)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            token.cancel()
+            # a repeated cancel must not orphan the task either
+            while not future.done():
+                with suppress(asyncio.CancelledError):
+                    await asyncio.wait({future})
+            error = None if future.cancelled() else future.exception()
+            if isinstance(error, TaskCancelled):
+                self._record_cancelled(endpoint, error.run_time)
+            elif error is not None:
+                # nobody is waiting for the result any more
+                logger.debug("Abandoned %s task failed: %s", endpoint, error)
+            raise
+
+    def _record_cancelled(self, endpoint: str, run_time: float) -> None:
+        with self._lock:
+            self._cancelled += 1
+            runs, total = self._run_times.get(endpoint, (0, 0.0))
+            if runs:
+                self._cancelled_seconds_saved += max(0.0, total / runs - run_time)
+        perf_logger.info(
+            "Pool task cancelled - Task: %s | Ran: %.6fs", endpoint, run_time
+        )
+
+    def _endpoint_limit(self, endpoint: str) -> AbstractAsyncContextManager:
+        """Semaphore capping concurrent tasks for `endpoint`, if it has a limit.
+
+        Waiting tasks still count against the queue depth, so a flood of one
+        endpoint is rejected rather than queued without bound.
+        """
+        limit = self.settings.endpoint_limits.get(endpoint)
+        if not limit:
+            return nullcontext()
+        limiters = self._limiters.setdefault(asyncio.get_running_loop(), {})
+        if endpoint not in limiters:
+            limiters[endpoint] = asyncio.Semaphore(limit)
+        return limiters[endpoint]
+
+    def _run_in_thread(
+        self, task: Callable, args: tuple, token: CancelToken
+    ) -> tuple[object, float, TaskReport]:
+        with self._lock:
+            self._threads_running += 1
+        try:
+            return _timed_call(task, args, token)
+        finally:
+            with self._lock:
+                self._threads_running -= 1
+
+    async def _run_in_process(
+        self,
+        task: Callable,
+        args: tuple,
+        affinity_key: str | None,
+        cancel: CancelToken | None = None,
+    ):
+        slot = self._route(affinity_key)
+        try:
+            executor = self._get_executor(slot)
+            loop = asyncio.get_running_loop()
+            with self._bound(cancel):
+                payload, run_time, report = await loop.run_in_executor(
+                    executor, _timed_call, task, args, cancel
+                )
+            report.process = f"worker-{slot}"
+            if affinity_key is not None:
+                self._remember_warm(slot, affinity_key)
+            return payload, run_time, report
+        except BrokenProcessPool:
+            # the worker died mid-task (OOM kill, segfault); fail this request
+            # and start a fresh worker in its slot for the next one
+            logger.exception("Worker %s broke; restarting it", slot)
+            self._discard_executor(slot, executor)
+            raise
+        finally:
+            with self._lock:
+                self._slots[slot].in_flight -= 1
+
+    def _route(self, affinity_key: str | None) -> int:
+        """Pick a worker slot and count the task against it.
+
+        Keyed tasks go to the least-loaded worker that recently ran the key,
+        if one has fewer than `max_pending_per_worker` tasks. Otherwise they
+        go to the key's home worker on the ring, spilling to the next worker
+        along the ring when it is full, and to the least-loaded worker when
+        every worker is. Unkeyed tasks go to the least-loaded worker.
+        """
+        with self._lock:
+            slots = self._slots
+            least_loaded = min(range(len(slots)), key=lambda i: slots[i].in_flight)
+            chosen = least_loaded
+            if affinity_key is not None:
+                limit = self.settings.max_pending_per_worker
+                candidates = self._ring.candidates(affinity_key)
+                warm = [
+                    i
+                    for i in candidates
+                    if affinity_key in slots[i].warm_keys and slots[i].in_flight < limit
+                ]
+                if warm:
+                    chosen = min(warm, key=lambda i: slots[i].in_flight)
+                else:
+                    chosen = next(
+                        (i for i in candidates if slots[i].in_flight < limit),
+                        least_loaded,
+                    )
+                if chosen == candidates[0] or warm:
+                    self._affinity_routed += 1
+                else:
+                    self._spilled += 1
+            slots[chosen].in_flight += 1
+            return chosen
+
+    def _remember_warm(self, slot: int, affinity_key: str) -> None:
+        with self._lock:
+            warm_keys = self._slots[slot].warm_keys
+            warm_keys[affinity_key] = None
+            warm_keys.move_to_end(affinity_key)
+            while len(warm_keys) > WARM_KEYS_PER_WORKER:
+                warm_keys.popitem(last=False)
+
+    def warm_workers(self, affinity_key: str) -> int:
+        """How many worker processes recently ran a task for `affinity_key`,
+        and so most likely have its model cached."""
+        with self._lock:
+            return sum(affinity_key in slot.warm_keys for slot in self._slots)
+
+    @contextmanager
+    def _bound(self, token: CancelToken | None) -> Iterator[None]:
+        """Bind `token` to a shared flag its worker process can see."""
+        with self._lock:
+            flags = self._cancel_flags
+            cancel_slot = (
+                self._free_cancel_slots.pop()
+                if token is not None and flags is not None and self._free_cancel_slots
+                else None
+            )
+        if token is None or cancel_slot is None:
+            yield
+            return
+        token.bind(flags, cancel_slot)
+        try:
+            yield
+        finally:
+            token.unbind()
+            with self._lock:
+                self._free_cancel_slots.append(cancel_slot)
+
+    def _get_executor(self, slot: int) -> ProcessPoolExecutor:
+        with self._lock:
+            worker = self._slots[slot]
+            if worker.executor is None:
+                worker.profiler, worker_end = _worker_context().Pipe()
+                worker.executor = self._create_executor(worker_end)
+            return worker.executor
+
+    def _create_executor(
+        self, profile_connection: Connection | None = None
+    ) -> ProcessPoolExecutor:
+        context = _worker_context()
+        if context.get_start_method() == "forkserver":
+            context.set_forkserver_preload(list(self.settings.preload_modules))
+        kwargs: dict = {}
+        if self.settings.max_tasks_per_worker > 0:
+            if sys.version_info >= (3, 11):
+                kwargs["max_tasks_per_child"] = self.settings.max_tasks_per_worker
+            else:
+                logger.warning(
+                    "Worker recycling needs Python 3.11+; ignoring "
+                    "TRILOGY_POOL_MAX_TASKS_PER_WORKER"
+                )
+        # callers hold self._lock
+        if self._cancel_flags is None:
+            self._cancel_flags = context.RawArray("b", CANCEL_SLOTS)
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=context,
+            initializer=_initialize_worker,
+            initargs=(
+                self.settings.preload_modules,
+                self._cancel_flags,
+                tracing_enabled(),
+                profile_connection,
+            ),
+            **kwargs,
+        )
+
+    def _discard_executor(self, slot: int, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            worker = self._slots[slot]
+            if worker.executor is executor:
+                worker.executor = None
+                worker.profiler = None
+                worker.warm_keys.clear()
+                self._pool_restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def start(self) -> None:
+        """Spin up the worker processes ahead of the first request."""
+        if not self.settings.uses_processes:
+            return
+        for slot in range(len(self._slots)):
+            self._get_executor(slot).submit(int)
+
+    def profile(self, request: ProfileRequest) -> dict[str, dict[str, int]]:
+        """Sample the stacks of this process and of every started worker
+        process for `request.seconds`, keyed "server" and "worker-<slot>".
+
+        Blocks for the whole window. Raises ProfilerBusy if another profile
+        is running, since the workers' replies share one pipe each.
+        """
+        if not self._profiling.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            with self._lock:
+                self._profile_requests += 1
+                request = replace(request, request_id=self._profile_requests)
+                connections = {
+                    f"worker-{slot}": worker.profiler
+                    for slot, worker in enumerate(self._slots)
+                    if worker.profiler is not None
+                }
+            for connection in connections.values():
+                connection.send(request)
+            stacks = {"server": dict(sample_stacks(request))}
+            deadline = time.monotonic() + PROFILE_REPLY_GRACE_SECONDS
+            for process, connection in connections.items():
+                with suppress(EOFError, OSError):
+                    # a reply to an earlier, abandoned request may come first
+                    while connection.poll(max(0.0, deadline - time.monotonic())):
+                        request_id, worker_stacks = connection.recv()
+                        if request_id == request.request_id:
+                            stacks[process] = worker_stacks
+                            break
+            return stacks
+        finally:
+            self._profiling.release()
+
+    def stats(self) -> TaskPoolStats:
+        with self._lock:
+            running = self._threads_running + sum(
+                1 for slot in self._slots if slot.in_flight
+            )
+            return TaskPoolStats(
+                in_flight=self._in_flight,
+                queue_depth=max(0, self._in_flight - running),
+                max_queue_depth=self.settings.max_queue_depth,
+                completed=self._completed,
+                rejected=self._rejected,
+                pool_restarts=self._pool_restarts,
+                affinity_routed=self._affinity_routed,
+                spilled=self._spilled,
+                cancelled=self._cancelled,
+                cancelled_seconds_saved=self._cancelled_seconds_saved,
+                worker_in_flight=[slot.in_flight for slot in self._slots],
+            )
+
+    def shutdown(self) -> None:
+        """Stop the worker processes; workers are restarted on next use."""
+        with self._lock:
+            executors = [slot.executor for slot in self._slots]
+            for slot in self._slots:
+                slot.executor = None
+                slot.profiler = None
+                slot.warm_keys.clear()
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from benchmarks.harness import (
+    Benchmark,
+    BenchmarkSettings,
+    BenchmarkStats,
+    format_summary,
+    load_baseline,
+    regression,
+    write_results,
+)
+
+
+def test_benchmark_times_rounds_and_reports_each_result():
+    reported = []
+    calls = []
+    bench = Benchmark(
+        "append",
+        BenchmarkSettings(min_rounds=3, max_time=0),
+        on_result=lambda name, stats: reported.append((name, stats)),
+    )
+    assert bench.pedantic(calls.append, setup=lambda: ((1,), {})) is None
+    # one warm-up call, then one per round
+    assert len(calls) == 4
+    [(name, stats)] = reported
+    assert (name, stats.rounds, stats.iterations) == ("append", 3, 1)
+    assert stats.min <= stats.median <= stats.max
+    with pytest.raises(RuntimeError):
+        bench(calls.append, 1)
+
+
+def test_regressions_are_judged_on_the_median_against_a_baseline(tmp_path):
+    path = tmp_path / "baseline.json"
+    write_results(path, {"parse": BenchmarkStats.from_times([0.010, 0.012], 1)})
+    baseline = load_baseline(path)
+    assert baseline["machine"]["pytrilogy"]
+
+    slower = BenchmarkStats.from_times([0.011, 0.016, 0.020], 1)
+    regressed = regression("parse", slower, baseline, threshold=0.2)
+    assert regressed is not None
+    assert regressed.change == pytest.approx(0.016 / 0.011 - 1)
+    assert regression("parse", slower, baseline, threshold=0.5) is None
+    assert regression("compile", slower, baseline, threshold=0.0) is None
+
+    summary = format_summary({"parse": slower, "compile": slower}, baseline)
+    assert summary[1].split()[-1] == "new"
+    assert summary[2].split()[-1] == "+45.5%"
+
+    path.write_text(json.dumps({**baseline, "version": 0}))
+    with pytest.raises(ValueError):
+        load_baseline(path)
@@ -0,0 +1,109 @@
+import json
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from blob_store import BlobMismatch, BlobStore, MissingBlobs, blob_digest
+from io_models import ModelSourceInSchema
+from result_cache import ResultCache
+from studio_endpoints import create_trilogy_router
+from task_pool import THREAD, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+def test_budget_evicts_least_recently_used():
+    store = BlobStore(max_bytes=30)
+    a, b = store.put("a" * 10), store.put("b" * 10)
+    store.get(a)
+    store.put("c" * 15)
+    assert store.get(b) is None
+    assert store.get(a) == "a" * 10
+    assert store.stats().evictions == 1
+
+
+def test_spilled_blobs_outlive_eviction_and_are_shared(tmp_path):
+    store = BlobStore(max_bytes=10, spill_dir=tmp_path)
+    first = store.put("x" * 8)
+    store.put("y" * 8)
+    assert store.get(first) == "x" * 8
+    assert store.stats().spill_hits == 1
+    assert BlobStore(spill_dir=tmp_path).get(first) == "x" * 8
+
+
+def test_spill_directory_is_pruned_to_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr("blob_store.SPILL_SWEEP_INTERVAL", 1)
+    store = BlobStore(spill_dir=tmp_path, max_spill_bytes=25)
+    for char in "abc":
+        store.put(char * 10)
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 25
+
+
+def test_resolve_fills_known_hashes_and_reports_missing():
+    store = BlobStore()
+    known = store.put("key id int;")
+    resolved = store.resolve(
+        [
+            ModelSourceInSchema(alias="a", sha256=known),
+            ModelSourceInSchema(alias="b", contents="key x int;"),
+        ]
+    )
+    assert [source.contents for source in resolved] == ["key id int;", "key x int;"]
+
+    unknown = blob_digest("key y int;")
+    with pytest.raises(MissingBlobs) as missing:
+        store.resolve([ModelSourceInSchema(alias="c", sha256=unknown)])
+    assert missing.value.hashes == [unknown]
+
+    with pytest.raises(BlobMismatch):
+        store.resolve(
+            [ModelSourceInSchema(alias="d", contents="key z int;", sha256=unknown)]
+        )
+
+
+def test_an_empty_source_sent_with_its_hash_is_stored():
+    store = BlobStore()
+    empty = blob_digest("")
+    with pytest.raises(MissingBlobs):
+        store.resolve([ModelSourceInSchema(alias="a", sha256=empty)])
+    # the retry after a 409 carries the (empty) contents, and must stick
+    [resolved] = store.resolve(
+        [ModelSourceInSchema(alias="a", contents="", sha256=empty)]
+    )
+    assert resolved.contents == ""
+    [resolved] = store.resolve([ModelSourceInSchema(alias="a", sha256=empty)])
+    assert resolved.contents == ""
+
+
+def test_generate_query_negotiates_missing_sources():
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    sources = payload["full_model"]["sources"]
+    by_hash = json.loads(json.dumps(payload))
+    by_hash["full_model"]["sources"] = [
+        {"alias": s["alias"], "sha256": blob_digest(s["contents"])} for s in sources
+    ]
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(max_bytes=0),
+            blob_store=BlobStore(),
+        )
+    )
+    with TestClient(app) as client:
+        full = client.post("/generate_query", json=payload).json()
+
+        conflict = client.post("/generate_query", json=by_hash)
+        assert conflict.status_code == 409
+        need = conflict.json()["detail"]["need"]
+        assert need == [s["sha256"] for s in by_hash["full_model"]["sources"]]
+
+        uploaded = client.post(
+            "/blobs", json={"contents": [s["contents"] for s in sources]}
+        ).json()
+        assert uploaded["hashes"] == need
+        assert client.post("/generate_query", json=by_hash).json() == full
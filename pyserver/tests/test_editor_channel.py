@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from blob_store import BlobStore
+from cancellation import check_cancelled
+from editor_channel import EditorSession
+from result_cache import ResultCache
+from studio_endpoints import create_trilogy_router
+from task_pool import THREAD, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+def test_newer_versions_cancel_running_analyses():
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD))
+    started = threading.Event()
+    sent: list[dict] = []
+
+    def analysis(version: int) -> bytes:
+        started.set()
+        # the first version runs until it is cancelled
+        while version == 1:
+            check_cancelled()
+            threading.Event().wait(0.01)
+        return json.dumps({"analysed": version}).encode()
+
+    async def analyse(action, request, token):
+        return await pool.run("validate", analysis, request["version"], cancel=token)
+
+    async def send(message: str) -> None:
+        sent.append(json.loads(message))
+
+    async def scenario():
+        session = EditorSession(analyse, send, debounce_seconds=0.01)
+        session.submit("validate", 1, {"version": 1})
+        await asyncio.to_thread(started.wait, 5)
+        session.submit("validate", 2, {"version": 2})
+        session.submit("validate", 3, {"version": 3})
+        while not sent:
+            await asyncio.sleep(0.01)
+        await session.close()
+        return session.stats()
+
+    stats = asyncio.run(scenario())
+    assert sent == [
+        {
+            "action": "validate",
+            "version": 3,
+            "status_code": 200,
+            "result": {"analysed": 3},
+        }
+    ]
+    assert stats.received == 3
+    assert stats.cancelled == 1
+    assert stats.debounced == 1
+
+
+def test_editor_socket_replies_to_the_latest_version(monkeypatch):
+    monkeypatch.setenv("TRILOGY_EDITOR_DEBOUNCE_MS", "200")
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    validate = {
+        "query": payload["query"],
+        "imports": payload["imports"],
+        "sources": payload["full_model"]["sources"],
+    }
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(max_bytes=0),
+            blob_store=BlobStore(),
+        )
+    )
+    with TestClient(app) as client:
+        expected = client.post("/validate_query", json=validate).json()
+        formatted = client.post("/format_query", json=payload).json()
+
+        with client.websocket_connect("/editor") as socket:
+            for version in (1, 2):
+                socket.send_json(
+                    {"action": "validate", "version": version, "request": validate}
+                )
+            socket.send_json({"action": "format", "version": 2, "request": payload})
+            replies = {}
+            for _ in range(2):
+                reply = socket.receive_json()
+                replies[reply["action"]] = reply
+            assert replies["validate"]["version"] == 2
+            assert replies["validate"]["result"] == expected
+            assert replies["format"]["result"] == formatted
+
+            # version 1 was superseded and never answered
+            socket.send_json({"action": "validate", "version": 3, "request": {}})
+            invalid = socket.receive_json()
+            assert (invalid["version"], invalid["status_code"]) == (3, 422)
+
+            socket.send_text("not json")
+            assert socket.receive_json()["status_code"] == 422
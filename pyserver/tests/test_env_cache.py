@@ -0,0 +1,136 @@
+from trilogy.parser import parse_text
+
+from env_cache import EnvironmentCache, SourceEnvironmentCache, model_cache_key
+from env_helpers import fork_environment, source_subtree_hashes
+from io_models import ModelSourceInSchema
+
+ORDERS = ModelSourceInSchema(
+    alias="orders",
+    contents="""key order_id int;
+property order_id.amount float;
+datasource orders (
+    order_id: order_id,
+    amount: amount
+)
+grain (order_id)
+address orders;""",
+)
+CUSTOMERS = ModelSourceInSchema(
+    alias="customers",
+    contents="""key customer_id int;
+property customer_id.name string;
+datasource customers (
+    customer_id: customer_id,
+    name: name
+)
+grain (customer_id)
+address customers;""",
+)
+
+
+def test_model_cache_key_ignores_source_order():
+    assert model_cache_key([ORDERS, CUSTOMERS]) == model_cache_key([CUSTOMERS, ORDERS])
+
+
+def test_model_cache_key_tracks_every_input():
+    base = model_cache_key([ORDERS], ["import orders as orders;"])
+    edited = ModelSourceInSchema(
+        alias="orders", contents=ORDERS.contents + "\nkey other int;"
+    )
+    assert base != model_cache_key([edited], ["import orders as orders;"])
+    assert base != model_cache_key([ORDERS], ["import orders;"])
+    assert base != model_cache_key(
+        [ORDERS], ["import orders as orders;"], files=["orders.csv"]
+    )
+    assert base != model_cache_key(
+        [ORDERS], ["import orders as orders;"], working_path="/tmp/project"
+    )
+
+
+def test_cache_counts_hits_misses_and_evictions():
+    cache = EnvironmentCache(max_entries=1)
+    cache.get_environment([ORDERS], ["import orders as orders;"])
+    cache.get_environment([ORDERS], ["import orders as orders;"])
+    cache.get_environment([CUSTOMERS], ["import customers as customers;"])
+    stats = cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 2
+    assert stats.evictions == 1
+    assert stats.size == 1
+
+
+def test_forks_do_not_leak_into_cache():
+    cache = EnvironmentCache()
+    env = cache.get_environment([ORDERS], ["import orders as orders;"])
+    assert "orders.amount" in env.concepts
+    parse_text("auto doubled <- orders.amount * 2;", env)
+    assert "local.doubled" in env.concepts
+
+    fresh = cache.get_environment([ORDERS], ["import orders as orders;"])
+    assert "local.doubled" not in fresh.concepts
+    assert cache.stats().hits == 1
+
+
+def test_parsed_model_keeps_import_statements():
+    cache = EnvironmentCache()
+    parsed = cache.get_parsed_model([ORDERS], ["import orders as orders;"])
+    assert len(parsed.import_statements) == 1
+    assert parsed.environment.frozen
+
+
+def test_fork_shares_concepts_but_not_containers():
+    base = EnvironmentCache().get_parsed_model([ORDERS], ["import orders as orders;"])
+    fork = fork_environment(base.environment)
+    assert fork.concepts["orders.amount"] is base.environment.concepts["orders.amount"]
+    assert fork.config.import_resolver is base.environment.config.import_resolver
+
+    fork.remove_concept("orders.amount")
+    assert "orders.amount" in base.environment.concepts
+    assert base.is_intact()
+
+
+def test_in_place_edit_of_shared_datasource_invalidates_entry():
+    cache = EnvironmentCache()
+    parsed = cache.get_parsed_model([ORDERS], ["import orders as orders;"])
+    datasource = next(iter(parsed.environment.datasources.values()))
+    datasource.columns = datasource.columns[:1]
+    assert not parsed.is_intact()
+
+    rebuilt = cache.get_parsed_model([ORDERS], ["import orders as orders;"])
+    assert rebuilt is not parsed
+    stats = cache.stats()
+    assert stats.invalidations == 1
+    assert stats.misses == 2
+
+
+def test_rebuild_reuses_unchanged_sources():
+    sources = SourceEnvironmentCache()
+    cache = EnvironmentCache(source_cache=sources)
+    imports = ["import orders as orders;", "import customers as customers;"]
+    cache.get_parsed_model([ORDERS, CUSTOMERS], imports)
+    assert sources.stats().misses == 2
+
+    edited = ModelSourceInSchema(
+        alias="orders", contents=ORDERS.contents + "\nproperty order_id.note string;"
+    )
+    env = cache.get_environment([edited, CUSTOMERS], imports)
+    assert "orders.note" in env.concepts
+    assert "customers.name" in env.concepts
+    stats = sources.stats()
+    assert stats.hits == 1
+    assert stats.misses == 3
+
+
+def test_in_place_edit_of_cached_source_is_not_reused():
+    sources = SourceEnvironmentCache()
+    cache = EnvironmentCache(source_cache=sources)
+    cache.get_parsed_model([ORDERS], ["import orders as orders;"])
+    hashes = source_subtree_hashes([ORDERS])
+    (shared,) = sources.reusable_environments(hashes).values()
+    datasource = next(iter(shared.datasources.values()))
+    datasource.columns = datasource.columns[:1]
+
+    assert sources.reusable_environments(hashes) == {}
+    assert sources.stats().invalidations == 1
+    env = cache.get_environment([ORDERS], ["import orders;"])
+    assert len(next(iter(env.datasources.values())).columns) == 2
@@ -87,16 +87,13 @@ def _generate_sql(query_text: str, extra_filters: list[str]) -> str:
         "current_filename": None,
     }
     query = QueryInSchema.model_validate(payload)
-    target, columns, values, select_count, _ = generate_query_core(
-        query, dialect, enable_performance_logging=False
-    )
+    target, columns, values, select_count, _ = generate_query_core(query, dialect)
     output = query_to_output(
         target,
         columns,
         values,
         None,
         dialect,
-        enable_performance_logging=False,
         select_count=select_count,
     )
     return output.generated_sql or ""
@@ -8,6 +8,7 @@ Layers tested:
                           executed against a real in-memory DuckDB database
 """
 
+import json
 import re
 
 import duckdb
@@ -242,10 +243,8 @@ def _generate(
         parameters=parameters,
     )
     payload = _generate_query_task(request.model_dump(mode="json"), False)
-    assert "__http_error__" not in payload, payload.get("__http_error__", {}).get(
-        "detail"
-    )
-    return payload
+    assert isinstance(payload, bytes), payload["__http_error__"]["detail"]
+    return json.loads(payload)
 
 
 # ---------------------------------------------------------------------------
@@ -268,7 +267,7 @@ def test_resolver_string_eq_produces_placeholder():
 def test_resolver_date_concept_with_iso_timestamp_input():
     """Regression: Luxon DateTime serialises as a full ISO timestamp string
     (e.g. '1992-12-20T22:19:57.462Z'). The concept-type lookup must override
-    _trilogy_type_for's 'datetime' guess and declare the parameter as 'date'
+    trilogy_type_for's 'datetime' guess and declare the parameter as 'date'
     when the concept being filtered is a DATE column — preventing the
     'Cannot compare DATE and DATETIME' error seen in production."""
     sources = [ModelSourceInSchema(alias="events", contents=_EVENTS_SOURCE)]
@@ -285,7 +284,7 @@ def test_resolver_date_concept_with_iso_timestamp_input():
 
 
 def test_resolver_date_range_produces_placeholder():
-    """Regression: _trilogy_type_for must return 'date' for ISO strings so
+    """Regression: trilogy_type_for must return 'date' for ISO strings so
     Trilogy does not raise 'Cannot compare DATE and STRING'."""
     sources = [ModelSourceInSchema(alias="orders", contents=_ORDERS_SOURCE)]
     payload = _generate(
@@ -351,7 +350,7 @@ def test_e2e_numeric_filter_returns_correct_rows(species_db):
 def test_e2e_date_range_returns_correct_rows(orders_db):
     """Date BETWEEN filter returns only rows within the range.
 
-    Regression: previously _trilogy_type_for returned 'string' for ISO dates,
+    Regression: previously trilogy_type_for returned 'string' for ISO dates,
     causing a 'Cannot compare DATE and STRING' error at parse time.
     """
     sources = [ModelSourceInSchema(alias="orders", contents=_ORDERS_SOURCE)]
@@ -8,40 +8,42 @@ Instead they must travel as binding parameters so that downstream connections
 parameterized-query APIs.
 """
 
+import json
+
 from trilogy import Dialects
 
 from io_models import ModelInSchema, ModelSourceInSchema, QueryInSchema
-from query_helpers import _trilogy_type_for
+from query_helpers import trilogy_type_for
 from studio_endpoints import _generate_query_task
 
 # ---------------------------------------------------------------------------
-# _trilogy_type_for unit tests
+# trilogy_type_for unit tests
 # ---------------------------------------------------------------------------
 
 
 def test_trilogy_type_for_string():
-    assert _trilogy_type_for("hello") == "string"
+    assert trilogy_type_for("hello") == "string"
 
 
 def test_trilogy_type_for_date():
-    assert _trilogy_type_for("2024-01-15") == "date"
-    assert _trilogy_type_for("2023-12-31") == "date"
+    assert trilogy_type_for("2024-01-15") == "date"
+    assert trilogy_type_for("2023-12-31") == "date"
 
 
 def test_trilogy_type_for_timestamp_space():
-    assert _trilogy_type_for("2024-01-15 08:00:00") == "datetime"
+    assert trilogy_type_for("2024-01-15 08:00:00") == "datetime"
 
 
 def test_trilogy_type_for_timestamp_T():
-    assert _trilogy_type_for("2024-01-15T08:00:00") == "datetime"
+    assert trilogy_type_for("2024-01-15T08:00:00") == "datetime"
 
 
 def test_trilogy_type_for_int():
-    assert _trilogy_type_for(42) == "int"
+    assert trilogy_type_for(42) == "int"
 
 
 def test_trilogy_type_for_float():
-    assert _trilogy_type_for(3.14) == "float"
+    assert trilogy_type_for(3.14) == "float"
 
 
 # ---------------------------------------------------------------------------
@@ -85,10 +87,8 @@ def _run(
         parameters=parameters or {},
     )
     payload = _generate_query_task(request.model_dump(mode="json"), False)
-    assert "__http_error__" not in payload, payload.get("__http_error__", {}).get(
-        "detail"
-    )
-    return payload
+    assert isinstance(payload, bytes), payload["__http_error__"]["detail"]
+    return json.loads(payload)
 
 
 # ---------------------------------------------------------------------------
@@ -181,9 +181,9 @@ def test_null_byte_injection():
     )
     sql: str = payload["generated_sql"]
     # Value must not be embedded in SQL
-    assert (
-        "\x00" not in sql and "OR '1'='1" not in sql
-    ), f"Injection leaked into SQL: {sql}"
+    assert "\x00" not in sql and "OR '1'='1" not in sql, (
+        f"Injection leaked into SQL: {sql}"
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -257,10 +257,8 @@ def _run_date(
         parameters=parameters or {},
     )
     payload = _generate_query_task(request.model_dump(mode="json"), False)
-    assert "__http_error__" not in payload, payload.get("__http_error__", {}).get(
-        "detail"
-    )
-    return payload
+    assert isinstance(payload, bytes), payload["__http_error__"]["detail"]
+    return json.loads(payload)
 
 
 def test_date_eq_filter_type_matches():
@@ -276,7 +274,7 @@ def test_date_eq_filter_type_matches():
 
 def test_date_range_filter_type_matches():
     """ISO date values used in a BETWEEN expression must not cause a
-    DATE vs STRING type mismatch (regression: _trilogy_type_for returned
+    DATE vs STRING type mismatch (regression: trilogy_type_for returned
     'string' for all str values, including ISO dates)."""
     payload = _run_date(
         extra_filters=["local.order_date between :order_date_min and :order_date_max"],
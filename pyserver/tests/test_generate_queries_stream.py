@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import studio_endpoints
+from result_cache import ResultCache
+from studio_endpoints import (
+    NDJSON_MEDIA_TYPE,
+    SSE_MEDIA_TYPE,
+    create_trilogy_router,
+    stream_media_type,
+)
+from task_pool import THREAD, TaskPool, TaskPoolSettings
+
+MULTI_QUERY = {
+    "imports": [{"name": "flight", "alias": "flight"}],
+    "dialect": "duckdb",
+    "full_model": {
+        "name": "",
+        "sources": [
+            {
+                "alias": "flight",
+                "contents": """key id int;
+property id.distance int;
+datasource flight (id, distance) grain (id) address flight;""",
+            }
+        ],
+    },
+    "queries": [
+        {"query": "SELECT count(flight.id) as flights;", "label": "count"},
+        {"query": "SELECT nope;", "label": "broken"},
+        {"query": "SELECT sum(flight.distance) as total;", "label": "total"},
+    ],
+}
+
+
+def make_client() -> TestClient:
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(
+                TaskPoolSettings(default_mode=THREAD, process_pool_size=2)
+            ),
+            result_cache=ResultCache(max_bytes=0),
+        )
+    )
+    return TestClient(app)
+
+
+def test_stream_media_type_from_accept_header():
+    assert stream_media_type("application/x-ndjson") == NDJSON_MEDIA_TYPE
+    assert stream_media_type("text/event-stream, */*") == SSE_MEDIA_TYPE
+    assert stream_media_type("application/json") is None
+    assert stream_media_type(None) is None
+
+
+def test_ndjson_stream_matches_batch_response():
+    with make_client() as client:
+        batch = client.post("/generate_queries", json=MULTI_QUERY).json()
+        response = client.post(
+            "/generate_queries",
+            json=MULTI_QUERY,
+            headers={"Accept": NDJSON_MEDIA_TYPE},
+        )
+
+    assert response.headers["content-type"].startswith(NDJSON_MEDIA_TYPE)
+    items = [json.loads(line) for line in response.text.splitlines()]
+    by_index = {item["index"]: item for item in items}
+    assert sorted(by_index) == [0, 1, 2]
+    assert [by_index[i]["query"] for i in range(3)] == batch["queries"]
+    assert by_index[1]["label"] == "broken"
+    assert by_index[1]["query"]["error"]
+
+
+def test_sse_stream_frames_each_query_and_ends_with_done():
+    with make_client() as client:
+        response = client.post(
+            "/generate_queries", json=MULTI_QUERY, headers={"Accept": SSE_MEDIA_TYPE}
+        )
+
+    events = [e for e in response.text.split("\n\n") if e]
+    assert [e.splitlines()[0] for e in events] == ["event: query"] * 3 + ["event: done"]
+
+
+def test_stream_emits_fast_queries_before_slow_ones(monkeypatch):
+    release = threading.Event()
+
+    def fake_task(queries_data, enable_perf_logging, indices):
+        if indices == [0]:
+            # finish well after query 1 has been written to the stream
+            release.wait(5)
+            time.sleep(0.2)
+        else:
+            release.set()
+        return {"queries": [b'{"label":"%d"}' % indices[0]], "timings_ms": [1.0]}
+
+    monkeypatch.setattr(studio_endpoints, "_generate_queries_task", fake_task)
+    with make_client() as client:
+        response = client.post(
+            "/generate_queries",
+            json={**MULTI_QUERY, "queries": MULTI_QUERY["queries"][:2]},
+            headers={"Accept": NDJSON_MEDIA_TYPE},
+        )
+
+    indices = [json.loads(line)["index"] for line in response.text.splitlines()]
+    assert indices == [1, 0]
@@ -0,0 +1,114 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from metrics import PHASE_SECONDS, MetricsRegistry, Sample, TaskReport
+from result_cache import ResultCache
+from studio_endpoints import create_trilogy_router
+from task_pool import PROCESS, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+def test_histograms_render_cumulative_buckets():
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        registry.observe("latency_seconds", {"endpoint": 'a"b'}, value)
+    lines = registry.render().splitlines()
+    assert "# TYPE latency_seconds histogram" in lines
+    assert [line for line in lines if line.startswith("latency_seconds")] == [
+        'latency_seconds_bucket{endpoint="a\\"b",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="a\\"b",le="1.0"} 2',
+        'latency_seconds_bucket{endpoint="a\\"b",le="+Inf"} 3',
+        'latency_seconds_sum{endpoint="a\\"b"} 5.55',
+        'latency_seconds_count{endpoint="a\\"b"} 3',
+    ]
+
+
+def test_snapshots_of_sibling_processes_are_summed(tmp_path):
+    sibling = MetricsRegistry()
+    sibling.record_task("generate_query", 0.0, 0.2, TaskReport(phases=[("parse", 0.1)]))
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(sibling.snapshot()))
+
+    registry = MetricsRegistry(directory=tmp_path)
+    registry.record_task(
+        "generate_query", 0.0, 0.4, TaskReport(phases=[("parse", 0.3)])
+    )
+    try:
+        text = registry.render()
+    finally:
+        registry.shutdown()
+    labels = 'dialect="",endpoint="generate_query",phase="parse"'
+    assert f"{PHASE_SECONDS}_count{{{labels}}} 2" in text
+    assert 'trilogy_task_run_seconds_count{endpoint="generate_query"} 2' in text
+
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pid liveness check")
+def test_snapshots_of_exited_processes_are_dropped(tmp_path):
+    exited = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    sibling = MetricsRegistry()
+    sibling.add_collector(
+        "pool",
+        lambda: [Sample("trilogy_pool_queue_depth", "gauge", "Tasks waiting", {}, 3)],
+    )
+    snapshot = tmp_path / f"{exited.stdout.strip()}.json"
+    snapshot.write_text(json.dumps(sibling.snapshot()))
+
+    registry = MetricsRegistry(directory=tmp_path)
+    try:
+        text = registry.render()
+    finally:
+        registry.shutdown()
+    assert "trilogy_pool_queue_depth" not in text
+    assert not snapshot.exists()
+
+
+def test_metrics_cover_phases_and_worker_caches():
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    registry = MetricsRegistry()
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=PROCESS, process_pool_size=1, preload_modules=()),
+        metrics=registry,
+    )
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(task_pool=pool, result_cache=ResultCache(max_bytes=0))
+    )
+    try:
+        with TestClient(app) as client:
+            assert client.post("/generate_query", json=payload).status_code == 200
+            response = client.get("/metrics")
+    finally:
+        pool.shutdown()
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    for phase in ("env_setup", "imports", "parse", "generation", "compile"):
+        count, _ = registry.histogram(
+            PHASE_SECONDS,
+            {
+                "endpoint": "generate_query",
+                "dialect": payload["dialect"],
+                "phase": phase,
+            },
+        )
+        assert count == 1, phase
+    assert "trilogy_pool_in_flight 0" in response.text
+    assert (
+        'trilogy_cache_misses_total{cache="environment",process="worker-0"} 1'
+        in response.text
+    )
+    assert "# TYPE trilogy_cache_misses_total counter" in response.text
+    assert "# TYPE trilogy_cache_size gauge" in response.text
+    assert "trilogy_cache_misses{" not in response.text
@@ -0,0 +1,152 @@
+import pytest
+from trilogy.parsing import parse_engine_v2
+from trilogy.parsing.exceptions import ParseError
+
+from env_cache import SourceEnvironmentCache
+from env_helpers import (
+    model_to_response,
+    parse_model_graph,
+    source_import_targets,
+    source_subtree_hashes,
+    topological_sources,
+)
+from io_models import ModelInSchema, ModelSourceInSchema
+
+REGION = ModelSourceInSchema(
+    alias="region",
+    contents="""key id int;
+property id.name string;
+datasource regions (r_id: id, r_name: name) grain (id) address regions;""",
+)
+NATION = ModelSourceInSchema(
+    alias="nation",
+    contents="""import region as region;
+key id int;
+property id.name string;
+datasource nations (n_id: id, n_name: name, n_region: region.id)
+grain (id) address nations;""",
+)
+CUSTOMER = ModelSourceInSchema(
+    alias="customer",
+    contents="""import nation as nation;
+import region as home_region;
+key id int;
+property id.name string;
+def shout(x) -> upper(x);
+auto loud_name <- @shout(name);
+datasource customers (c_id: id, c_name: name, c_nation: nation.id)
+grain (id) address customers;""",
+)
+
+
+def test_source_import_targets_resolves_relative_imports():
+    text = "import region as region;\nimport ..shared.date;\nkey id int;"
+    assert source_import_targets(text, "raw/sales/orders") == [
+        "raw.sales.region",
+        "raw.shared.date",
+    ]
+
+
+def test_topological_sources_puts_imports_first():
+    ordered = [s.alias for s in topological_sources([CUSTOMER, NATION, REGION])]
+    assert ordered == ["region", "nation", "customer"]
+
+
+def test_topological_sources_keeps_cycles():
+    a = ModelSourceInSchema(alias="a", contents="import b as b;\nkey id int;")
+    b = ModelSourceInSchema(alias="b", contents="import a as a;\nkey id int;")
+    ordered = [s.alias for s in topological_sources([a, REGION, b])]
+    assert ordered == ["region", "a", "b"]
+
+
+def test_parse_model_graph_parses_each_source_once(monkeypatch):
+    parsed_texts: list[str] = []
+    original = parse_engine_v2.parse_syntax
+
+    def counting_parse_syntax(text, *args, **kwargs):
+        parsed_texts.append(text)
+        return original(text, *args, **kwargs)
+
+    monkeypatch.setattr(parse_engine_v2, "parse_syntax", counting_parse_syntax)
+    monkeypatch.setattr("env_helpers.parse_syntax", counting_parse_syntax)
+
+    environments = parse_model_graph([CUSTOMER, NATION, REGION])
+
+    model_texts = [
+        t for t in parsed_texts if t in {s.contents for s in (CUSTOMER, NATION, REGION)}
+    ]
+    assert sorted(model_texts) == sorted(
+        [CUSTOMER.contents, NATION.contents, REGION.contents]
+    )
+    assert "nation.region.name" in environments["customer"].concepts
+    assert "home_region.name" in environments["customer"].concepts
+
+
+def test_model_to_response_projects_each_source():
+    model = ModelInSchema(name="tpch", sources=[CUSTOMER, NATION, REGION])
+    response = model_to_response(model)
+
+    assert [s.alias for s in response.sources] == ["customer", "nation", "region"]
+    by_alias = {s.alias: s for s in response.sources}
+    assert {c.address for c in by_alias["region"].concepts} == {
+        "local.id",
+        "local.name",
+    }
+    customer_addresses = {c.address for c in by_alias["customer"].concepts}
+    assert "nation.region.name" in customer_addresses
+    assert {d.name for d in by_alias["customer"].datasources} >= {
+        "customers",
+        "nation.nations",
+    }
+    loud = next(c for c in by_alias["customer"].concepts if c.name == "loud_name")
+    assert [item.token for item in loud.lineage][:2] == ["shout", "("]
+
+
+def test_model_to_response_reports_failing_source():
+    broken = ModelSourceInSchema(alias="broken", contents="key id int\nproperty;")
+    with pytest.raises(ParseError, match="Unable to process file 'broken'"):
+        model_to_response(ModelInSchema(name="bad", sources=[REGION, broken]))
+
+
+def test_source_subtree_hashes_follow_imports():
+    base = source_subtree_hashes([CUSTOMER, NATION, REGION])
+    edited_nation = ModelSourceInSchema(
+        alias="nation", contents=NATION.contents + "\nkey other int;"
+    )
+    edited = source_subtree_hashes([CUSTOMER, edited_nation, REGION])
+    assert edited["region"] == base["region"]
+    assert edited["nation"] != base["nation"]
+    assert edited["customer"] != base["customer"]
+
+    a = ModelSourceInSchema(alias="a", contents="import b as b;\nkey id int;")
+    b = ModelSourceInSchema(alias="b", contents="import a as a;\nkey id int;")
+    assert set(source_subtree_hashes([a, b, REGION])) == {"region"}
+
+
+def test_source_cache_reparses_only_edited_subtree(monkeypatch):
+    parsed_texts: list[str] = []
+    original = parse_engine_v2.parse_syntax
+
+    def counting_parse_syntax(text, *args, **kwargs):
+        parsed_texts.append(text)
+        return original(text, *args, **kwargs)
+
+    monkeypatch.setattr(parse_engine_v2, "parse_syntax", counting_parse_syntax)
+    monkeypatch.setattr("env_helpers.parse_syntax", counting_parse_syntax)
+
+    cache = SourceEnvironmentCache()
+    cache.parse_model_graph([CUSTOMER, NATION, REGION])
+    assert cache.stats().misses == 3
+
+    parsed_texts.clear()
+    edited = ModelSourceInSchema(
+        alias="nation", contents=NATION.contents + "\nproperty id.code string;"
+    )
+    environments = cache.parse_model_graph([CUSTOMER, edited, REGION])
+    assert sorted(parsed_texts) == sorted([CUSTOMER.contents, edited.contents])
+    assert "nation.code" in environments["customer"].concepts
+    assert cache.stats().hits == 1
+
+    parsed_texts.clear()
+    cache.parse_model_graph([CUSTOMER, edited, REGION])
+    assert parsed_texts == []
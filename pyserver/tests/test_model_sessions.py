@@ -0,0 +1,283 @@
+import asyncio
+import json
+import os
+import stat
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from blob_store import BlobStore
+from env_cache import model_cache_key
+from io_models import ModelInSchema, ModelSourceInSchema, QueryInSchema
+from model_sessions import ModelSessionStore, StaleModelSession
+from result_cache import ResultCache
+from studio_endpoints import _prepare_request, create_trilogy_router
+from task_pool import PROCESS, THREAD, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+REGION = ModelSourceInSchema(alias="region", contents="key id int;")
+NATION = ModelSourceInSchema(alias="nation", contents="import region;\nkey id int;")
+
+
+def test_register_update_and_delete(tmp_path):
+    store = ModelSessionStore(directory=tmp_path)
+    session = store.register(ModelInSchema(name="m", sources=[REGION, NATION]))
+    assert session.content_hash == model_cache_key([REGION, NATION])
+    assert store.get(session.model_id) == session
+
+    edited = ModelSourceInSchema(alias="region", contents="key id string;")
+    extra = ModelSourceInSchema(alias="city", contents="key id int;")
+    updated = store.update(session.model_id, [edited, extra], removed=["nation"])
+    assert updated is not None
+    assert updated.model.sources == [edited, extra]
+    assert updated.content_hash == model_cache_key([edited, extra])
+
+    assert store.delete(session.model_id)
+    assert store.get(session.model_id) is None
+    assert store.update(session.model_id, [edited]) is None
+
+
+def test_other_processes_see_updates(tmp_path):
+    writer = ModelSessionStore(directory=tmp_path)
+    reader = ModelSessionStore(directory=tmp_path)
+    session = writer.register(ModelInSchema(name="m", sources=[REGION]))
+    assert reader.get(session.model_id) == session
+
+    edited = ModelSourceInSchema(alias="region", contents="key id string;")
+    writer.update(session.model_id, [edited])
+    seen = reader.get(session.model_id)
+    assert seen is not None and seen.model.sources == [edited]
+    assert reader.stats().reloads == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX permissions")
+def test_the_session_directory_is_private(tmp_path):
+    directory = tmp_path / "sessions"
+    ModelSessionStore(directory=directory).register(
+        ModelInSchema(name="m", sources=[REGION])
+    )
+    assert stat.S_IMODE(directory.stat().st_mode) == 0o700
+
+
+def test_concurrent_updates_from_other_processes_are_all_kept(tmp_path):
+    session = ModelSessionStore(directory=tmp_path).register(
+        ModelInSchema(name="m", sources=[REGION])
+    )
+    # a store each, as separate server processes would have
+    stores = [ModelSessionStore(directory=tmp_path) for _ in range(8)]
+    for store in stores:
+        store.get(session.model_id)
+    start = threading.Barrier(len(stores))
+
+    def add_source(index: int) -> None:
+        start.wait()
+        for step in range(5):
+            source = ModelSourceInSchema(
+                alias=f"city_{index}_{step}", contents="key id int;"
+            )
+            stores[index].update(session.model_id, [source])
+
+    threads = [
+        threading.Thread(target=add_source, args=(index,))
+        for index in range(len(stores))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    final = ModelSessionStore(directory=tmp_path).get(session.model_id)
+    assert final is not None
+    assert len(final.model.sources) == 1 + len(stores) * 5
+
+
+def test_updates_against_a_stale_hash_are_refused(tmp_path):
+    store = ModelSessionStore(directory=tmp_path)
+    session = store.register(ModelInSchema(name="m", sources=[REGION]))
+    edited = ModelSourceInSchema(alias="region", contents="key id string;")
+    updated = store.update(
+        session.model_id, [edited], expected_hash=session.content_hash
+    )
+    assert updated is not None
+    with pytest.raises(StaleModelSession) as raised:
+        store.update(session.model_id, [NATION], expected_hash=session.content_hash)
+    assert raised.value.content_hash == updated.content_hash
+    current = store.get(session.model_id)
+    assert current is not None and current.model.sources == [edited]
+
+
+def test_idle_sessions_expire(tmp_path):
+    store = ModelSessionStore(directory=tmp_path, ttl_seconds=60)
+    session = store.register(ModelInSchema(name="m", sources=[REGION]))
+    stale = time.time() - 120
+    os.utime(tmp_path / f"{session.model_id}.json", (stale, stale))
+    assert store.get(session.model_id) is None
+    assert store.stats().expirations == 1
+    assert not list(tmp_path.glob("*.json"))
+
+
+def test_register_evicts_least_recently_used(tmp_path):
+    store = ModelSessionStore(directory=tmp_path, max_sessions=2)
+    first, second = (
+        store.register(ModelInSchema(name=name, sources=[REGION]))
+        for name in ("a", "b")
+    )
+    past = time.time() - 10
+    os.utime(tmp_path / f"{first.model_id}.json", (past, past))
+    store.register(ModelInSchema(name="c", sources=[REGION]))
+    assert store.get(first.model_id) is None
+    assert store.get(second.model_id) is not None
+    assert store.stats().evictions == 1
+
+
+def test_unknown_or_malformed_ids_are_misses(tmp_path):
+    store = ModelSessionStore(directory=tmp_path)
+    assert store.get("0" * 32) is None
+    assert store.get("../../etc/passwd") is None
+
+
+def test_requests_reference_a_registered_model(tmp_path):
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(),
+            model_sessions=ModelSessionStore(directory=tmp_path),
+        )
+    )
+    by_reference = {k: v for k, v in payload.items() if k != "full_model"}
+    with TestClient(app) as client:
+        full = client.post("/generate_query", json=payload).json()
+        registered = client.post("/models", json=payload["full_model"]).json()
+        by_reference["model_id"] = registered["model_id"]
+
+        assert client.post("/generate_query", json=by_reference).json() == full
+        validated = client.post(
+            "/validate_query",
+            json={
+                "query": payload["query"],
+                "imports": payload["imports"],
+                "model_id": registered["model_id"],
+            },
+        )
+        assert validated.status_code == 200
+
+        # the cached response must not outlive a change to the session model
+        source = payload["full_model"]["sources"][0]
+        renamed = source["contents"].replace("property id.state", "property id.region")
+        patched = client.patch(
+            f"/models/{registered['model_id']}",
+            json={"sources": [{"alias": source["alias"], "contents": renamed}]},
+        ).json()
+        assert patched["content_hash"] != registered["content_hash"]
+        response = client.post("/generate_query", json=by_reference)
+        assert response.status_code == 422
+
+        assert client.delete(f"/models/{registered['model_id']}").status_code == 204
+        missing = client.post("/generate_query", json=by_reference)
+        assert missing.status_code == 404
+        assert "register the model again" in missing.json()["detail"]
+
+
+def test_requests_name_exactly_one_model(tmp_path):
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(),
+            model_sessions=ModelSessionStore(directory=tmp_path),
+        )
+    )
+    without_model = {k: v for k, v in payload.items() if k != "full_model"}
+    validate = {"query": payload["query"], "imports": payload["imports"]}
+    with TestClient(app) as client:
+        registered = client.post("/models", json=payload["full_model"]).json()
+        both = {**payload, "model_id": registered["model_id"]}
+        for path, body in (
+            ("/generate_query", without_model),
+            ("/generate_query", both),
+            ("/validate_query", validate),
+            (
+                "/validate_query",
+                {
+                    **validate,
+                    "sources": payload["full_model"]["sources"],
+                    "model_id": registered["model_id"],
+                },
+            ),
+        ):
+            response = client.post(path, json=body)
+            assert response.status_code == 422, (path, sorted(body))
+        # an explicitly empty model is still a model-free query
+        empty = {**payload, "full_model": {"name": "", "sources": []}}
+        empty["query"] = "select 1 as one;"
+        empty["imports"] = []
+        empty["extra_filters"] = []
+        assert client.post("/generate_query", json=empty).status_code == 200
+
+
+def test_patch_with_a_stale_if_match_is_a_conflict(tmp_path):
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(),
+            model_sessions=ModelSessionStore(directory=tmp_path),
+        )
+    )
+    with TestClient(app) as client:
+        registered = client.post(
+            "/models", json={"name": "m", "sources": [REGION.model_dump()]}
+        ).json()
+        path = f"/models/{registered['model_id']}"
+        delta = {"sources": [{"alias": "region", "contents": "key id string;"}]}
+        applied = client.patch(
+            path, json=delta, headers={"If-Match": f'"{registered["content_hash"]}"'}
+        )
+        assert applied.status_code == 200
+        stale = client.patch(
+            path,
+            json={"removed": ["region"]},
+            headers={"If-Match": registered["content_hash"]},
+        )
+        assert stale.status_code == 409
+        assert applied.json()["content_hash"] in stale.json()["detail"]
+        current = client.get(path).json()
+        assert current["content_hash"] == applied.json()["content_hash"]
+
+
+def test_process_workers_get_the_raw_body_unless_the_model_was_filled_in(tmp_path):
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    sessions = ModelSessionStore(directory=tmp_path)
+    pool = TaskPool(TaskPoolSettings(default_mode=PROCESS))
+    registered = sessions.register(ModelInSchema.model_validate(payload["full_model"]))
+    by_reference = {k: v for k, v in payload.items() if k != "full_model"}
+    by_reference["model_id"] = registered.model_id
+
+    def prepare(body: dict):
+        raw = json.dumps(body).encode()
+
+        async def receive():
+            return {"type": "http.request", "body": raw, "more_body": False}
+
+        request = Request({"type": "http", "method": "POST", "headers": []}, receive)
+        query = QueryInSchema.model_validate_json(raw)
+        return asyncio.run(
+            _prepare_request(
+                pool, sessions, BlobStore(), "generate_query", query, request
+            )
+        )
+
+    _, inline_input, _ = prepare(payload)
+    assert inline_input == json.dumps(payload).encode()
+    filled, filled_input, model_key = prepare(by_reference)
+    assert filled_input is filled
+    assert model_key == registered.content_hash
@@ -553,7 +553,7 @@ address airport;
 
     query = MultiQueryInSchema.model_validate(multi_query)
     dialect = get_dialect_generator(query.dialect)
-    results = generate_multi_query_core(query, dialect, cleanup_concepts=True)
+    results = generate_multi_query_core(query, dialect)
 
     assert len(results) == 4
 
@@ -725,32 +725,6 @@ address test_table;
     )  # The invalid query should not return a result
 
 
-def test_multi_query_performance_logging():
-    """Test that performance logging can be disabled"""
-    multi_query = {
-        "imports": [],
-        "dialect": "duckdb",
-        "full_model": {"name": "", "sources": []},
-        "queries": [
-            {"query": "SELECT 1 as num;", "label": "simple_1"},
-            {"query": "SELECT 2 as num2;", "label": "simple_2"},
-        ],
-    }
-
-    query = MultiQueryInSchema.model_validate(multi_query)
-    dialect = get_dialect_generator(query.dialect)
-
-    # Test with logging disabled
-    results = generate_multi_query_core(
-        query, dialect, enable_performance_logging=False
-    )
-    assert len(results) == 2
-
-    # Test with logging enabled (default)
-    results = generate_multi_query_core(query, dialect, enable_performance_logging=True)
-    assert len(results) == 2
-
-
 def test_multi_query_empty_queries():
     """Test handling of empty query list"""
     multi_query = {
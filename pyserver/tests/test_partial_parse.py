@@ -1,7 +1,7 @@
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
-from diagnostics import get_diagnostics
+from diagnostics import StatementCache, get_diagnostics, split_statements
 from io_models import ModelInSchema, ModelSourceInSchema, ValidateQueryInSchema
 from studio_endpoints import create_trilogy_router
 
@@ -191,3 +191,110 @@ def test_validate_query_with_parameterized_filters():
     payload = response.json()
     # The parameterized filter should parse without errors
     assert payload.get("filter_validation", []) == []
+
+
+CUSTOMER = ModelSourceInSchema(
+    alias="customer",
+    contents="key cuid int;\nproperty cuid.name string;\n",
+)
+
+
+def test_split_statements_skips_strings_and_comments():
+    text = "auto a <- 'x;y'; # note;\nauto b <- 1;\n  select a"
+    assert [(s.text, s.line, s.column) for s in split_statements(text)] == [
+        ("auto a <- 'x;y';", 1, 1),
+        (" # note;\nauto b <- 1;", 1, 17),
+        ("\n  select a", 2, 13),
+    ]
+
+
+def test_editing_the_tail_reanalyses_only_the_tail():
+    cache = StatementCache()
+    script = "import customer as cust;\n" + "".join(
+        f"auto x{i} <- cust.cuid + {i};\n" for i in range(20)
+    )
+    get_diagnostics(script + "select x1;", [CUSTOMER], statement_cache=cache)
+    before = cache.stats()
+
+    diagnostics = get_diagnostics(
+        script + "select x2;", [CUSTOMER], statement_cache=cache
+    )
+    after = cache.stats()
+    assert after.statement_misses - before.statement_misses == 1
+    assert after.state_misses - before.state_misses == 1
+    assert diagnostics.imports[0].alias == "cust"
+    assert any(item.label == "x19" for item in diagnostics.completion_items)
+
+
+def test_errors_are_reported_at_document_positions():
+    diagnostics = get_diagnostics(
+        "import customer as cust;\nauto x <- cust.cuid +;\nauto q <- 1;",
+        [CUSTOMER],
+        statement_cache=StatementCache(),
+    )
+    assert (diagnostics.items[0].startLineNumber, diagnostics.items[0].startColumn) == (
+        2,
+        22,
+    )
+    # statements after a broken one are still analysed
+    assert any(item.label == "q" for item in diagnostics.completion_items)
+
+
+def test_unparseable_statement_is_reported_once_at_its_span():
+    cache = StatementCache()
+    script = "import customer as cust;\nselect err\n  where;\n" + "".join(
+        f"auto x{i} <- cust.cuid + {i};\n" for i in range(30)
+    )
+    diagnostics = get_diagnostics(script, [CUSTOMER], statement_cache=cache)
+    spans = [
+        (i.startLineNumber, i.startColumn, i.endLineNumber, i.endColumn)
+        for i in diagnostics.items
+        if i.message == "Parse error"
+    ]
+    assert spans == [(2, 1, 3, 9)]
+    assert cache.stats().statement_misses == 32
+    assert any(item.label == "x29" for item in diagnostics.completion_items)
+
+
+def test_import_completions_are_shared_across_documents():
+    cache = StatementCache()
+    first = get_diagnostics(
+        "import customer as cust;\nselect cust.cuid;", [CUSTOMER], statement_cache=cache
+    )
+    second = get_diagnostics(
+        "# another tab\nimport customer as cust;\nauto x <- 1;",
+        [CUSTOMER],
+        statement_cache=cache,
+    )
+    assert cache.stats().index_hits == 1
+    by_label = {item.label: item for item in first.completion_items}
+    assert all(
+        item is by_label[item.label]
+        for item in second.completion_items
+        if item.label.startswith("cust.")
+    )
+
+
+def test_completion_prefix_filters_by_label():
+    diagnostics = get_diagnostics(
+        "import customer as cust;\nauto cust_total <- count(cust.cuid);",
+        [CUSTOMER],
+        statement_cache=StatementCache(),
+        completion_prefix="CUST.N",
+    )
+    assert [item.label for item in diagnostics.completion_items] == ["cust.name"]
+
+    app = FastAPI()
+    app.include_router(create_trilogy_router())
+    response = TestClient(app).post(
+        "/validate_query",
+        json={
+            "query": "import customer as cust;\nauto cust_total <- 1;",
+            "sources": [CUSTOMER.model_dump()],
+            "imports": [],
+            "completion_prefix": "cust_",
+        },
+    )
+    assert [item["label"] for item in response.json()["completion_items"]] == [
+        "cust_total"
+    ]
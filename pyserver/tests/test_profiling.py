@@ -0,0 +1,119 @@
+import json
+import threading
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from profiling import ProfileRequest, render_folded, sample_stacks
+from result_cache import ResultCache
+from studio_endpoints import create_trilogy_router
+from task_pool import PROCESS, ProfilerBusy, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+TOKEN = "secret-admin-token"
+
+
+def _client(pool: TaskPool, admin_token: str | None = TOKEN) -> TestClient:
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=pool,
+            result_cache=ResultCache(max_bytes=0),
+            admin_token=admin_token,
+        )
+    )
+    return TestClient(app)
+
+
+def test_sampling_skips_idle_threads_unless_asked():
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    busy = threading.Thread(target=busy_loop, name="busy")
+    idle = threading.Thread(target=stop.wait, name="idle")
+    busy.start()
+    idle.start()
+    try:
+        request = ProfileRequest(seconds=0.05, interval=0.005)
+        stacks = sample_stacks(request)
+        with_idle = sample_stacks(ProfileRequest(0.05, 0.005, include_idle=True))
+    finally:
+        stop.set()
+        busy.join()
+        idle.join()
+    assert any(stack.startswith("busy;") and "busy_loop" in stack for stack in stacks)
+    assert not any(stack.startswith("idle;") for stack in stacks)
+    assert any(stack.startswith("idle;") for stack in with_idle)
+    folded = render_folded({"server": stacks})
+    for line in folded.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert stack.startswith("server;")
+        assert int(count) > 0
+
+
+def test_profile_endpoint_requires_the_admin_token():
+    pool = TaskPool(TaskPoolSettings(preload_modules=()))
+    with _client(pool, admin_token=None) as client:
+        assert client.get("/admin/profile?seconds=0.01").status_code == 404
+    with _client(pool) as client:
+        response = client.get("/admin/profile?seconds=0.01")
+        assert response.status_code == 401
+        assert response.headers["www-authenticate"] == "Bearer"
+        response = client.get(
+            "/admin/profile?seconds=0.01",
+            headers={"Authorization": "Bearer wrong"},
+        )
+        assert response.status_code == 401
+        response = client.get(
+            "/admin/profile?seconds=500",
+            headers={"Authorization": f"Bearer {TOKEN}"},
+        )
+        assert response.status_code == 422
+
+
+def test_profile_endpoint_samples_the_worker_processes():
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=PROCESS, process_pool_size=1, preload_modules=())
+    )
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    try:
+        with _client(pool) as client:
+            # starts the worker
+            assert client.post("/generate_query", json=payload).status_code == 200
+            response = client.get(
+                "/admin/profile?seconds=0.2&hz=200&idle=true",
+                headers={"Authorization": f"Bearer {TOKEN}"},
+            )
+    finally:
+        pool.shutdown()
+    assert response.status_code == 200
+    assert ".folded" in response.headers["content-disposition"]
+    processes = set()
+    for line in response.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+        processes.add(stack.split(";", 1)[0])
+    assert processes == {"server", "worker-0"}
+
+
+def test_one_profile_at_a_time():
+    pool = TaskPool(TaskPoolSettings(preload_modules=()))
+    started = threading.Thread(
+        target=pool.profile, args=(ProfileRequest(seconds=0.3, interval=0.01),)
+    )
+    started.start()
+    try:
+        # give the first profile time to take the lock
+        threading.Event().wait(0.05)
+        with pytest.raises(ProfilerBusy):
+            pool.profile(ProfileRequest(seconds=0.01, interval=0.01))
+    finally:
+        started.join()
+    assert "server" in pool.profile(ProfileRequest(seconds=0.01, interval=0.01))
@@ -56,7 +56,7 @@ def test_validate_statement_empty():
     dialect = DuckDBDialect()
     target, columns, results, _, _ = generate_query_core(query, dialect)
     assert not results, results
-    query_to_output(target, columns, results, "default", dialect, False)
+    query_to_output(target, columns, results, "default", dialect)
 
 
 def test_validate_statement():
@@ -95,7 +95,7 @@ def test_validate_statement():
     dialect = DuckDBDialect()
     target, columns, results, _, _ = generate_query_core(query, dialect)
     assert len(results) == 19, results
-    query_to_output(target, columns, results, "default", dialect, False)
+    query_to_output(target, columns, results, "default", dialect)
 
 
 def test_generate_query_supports_relative_imports_from_current_filename():
@@ -299,9 +299,7 @@ def test_chart_statement_returns_layer_sql_and_roles():
     )
 
     target, columns, results, select_count, _ = generate_query_core(query, dialect)
-    out = query_to_output(
-        target, columns, results, "default", dialect, False, select_count
-    )
+    out = query_to_output(target, columns, results, "default", dialect, select_count)
 
     # One statement, so one select as far as callers policing multi-select input
     # are concerned - regardless of how many layers it holds.
@@ -329,9 +327,7 @@ def test_chart_statement_carries_settings_and_placements():
     )
 
     target, columns, results, select_count, _ = generate_query_core(query, dialect)
-    out = query_to_output(
-        target, columns, results, "default", dialect, False, select_count
-    )
+    out = query_to_output(target, columns, results, "default", dialect, select_count)
 
     assert out.chart is not None
     assert out.chart.hide_legend is True
@@ -352,9 +348,7 @@ def test_chart_statement_applies_extra_filters_to_layer_selects():
     )
 
     target, columns, results, select_count, _ = generate_query_core(query, dialect)
-    out = query_to_output(
-        target, columns, results, "default", dialect, False, select_count
-    )
+    out = query_to_output(target, columns, results, "default", dialect, select_count)
 
     assert out.chart is not None
     assert "'CA'" in (out.chart.layers[0].generated_sql or "")
@@ -376,7 +370,6 @@ def test_multi_layer_chart_reports_every_layer():
         results,
         "default",
         dialect,
-        False,
         select_count,
         layer_columns,
     )
@@ -0,0 +1,124 @@
+import json
+
+from trilogy import Dialects
+
+from env_cache import model_cache_key
+from io_models import Import, ModelInSchema, ModelSourceInSchema, QueryInSchema
+from query_templates import (
+    DATE,
+    IDENTITY,
+    QUERY_TEMPLATES,
+    UNSERIALIZED,
+    QueryTemplateCache,
+    build_template,
+    template_key,
+)
+from studio_endpoints import _generate_query_task
+
+ORDERS = ModelSourceInSchema(
+    alias="orders",
+    contents="""key id int;
+property id.status string;
+property id.order_date date;
+property id.quantity int;
+
+datasource orders (
+    id: id,
+    status: status,
+    order_date: order_date,
+    quantity: quantity
+)
+grain (id)
+address orders;""",
+)
+
+
+def make_query(parameters: dict, extra_filters: list[str] | None = None) -> dict:
+    return QueryInSchema(
+        imports=[Import(name="orders", alias="orders")],
+        query="select orders.id, orders.status;",
+        dialect=Dialects.DUCK_DB,
+        full_model=ModelInSchema(name="orders", sources=[ORDERS]),
+        extra_filters=extra_filters
+        or ["orders.status = :p1", "orders.order_date >= :p2"],
+        parameters=parameters,
+    ).model_dump(mode="json")
+
+
+def test_template_key_ignores_values_but_not_shape():
+    base = QueryInSchema.model_validate(
+        make_query({":p1": "open", ":p2": "2024-01-01"})
+    )
+    moved = QueryInSchema.model_validate(
+        make_query({":p1": "closed", ":p2": "2024-06-30"})
+    )
+    retyped = QueryInSchema.model_validate(make_query({":p1": 3, ":p2": "2024-01-01"}))
+    refiltered = QueryInSchema.model_validate(
+        make_query({":p1": "open"}, extra_filters=["orders.status != :p1"])
+    )
+    assert template_key(base) == template_key(moved)
+    assert template_key(base) != template_key(retyped)
+    assert template_key(base) != template_key(refiltered)
+    remodelled = base.model_copy(
+        update={
+            "full_model": ModelInSchema(
+                name="orders",
+                sources=[ORDERS.model_copy(update={"contents": ORDERS.text + "\n"})],
+            )
+        }
+    )
+    assert template_key(base) != template_key(remodelled)
+    # the router passes the model hash it already has
+    assert template_key(base, model_cache_key([ORDERS])) == template_key(base)
+    assert template_key(base.model_copy(update={"parameters": None})) is None
+
+
+def test_build_template_records_how_values_are_bound():
+    payload = {"generated_sql": "select * where a = :p1 and b >= :p2 and c = :p3"}
+    template = build_template(
+        {":p1": "open", ":p2": "2024-01-01", ":p3": "2024-01-01T10:00:00Z"},
+        {**payload, "parameters": {"p1": "open", "p3": "2024-01-01"}},
+    )
+    assert template is not None
+    assert template.transforms == {"p1": IDENTITY, "p2": UNSERIALIZED, "p3": DATE}
+
+
+def test_build_template_rejects_inlined_values():
+    assert build_template({":p1": 5}, {"generated_sql": "select * where a > 5"}) is None
+
+
+def test_templated_output_matches_full_generation(monkeypatch):
+    # generate every request in full, without the task's own template cache
+    monkeypatch.setattr(QUERY_TEMPLATES, "max_entries", 0)
+    QUERY_TEMPLATES.clear()
+    cache = QueryTemplateCache()
+    requests = [
+        make_query({":p1": status, ":p2": day})
+        for status, day in [
+            ("open", "2024-01-01"),
+            ("closed", "2024-03-05"),
+            ("pending", "2023-12-31"),
+        ]
+    ]
+    full = [json.loads(_generate_query_task(request, False)) for request in requests]
+    for request, expected in zip(requests, full):
+        query = QueryInSchema.model_validate(request)
+        key = template_key(query)
+        assert key is not None and query.parameters
+        rendered = cache.render(key, query.parameters)
+        if rendered is None:
+            assert cache.store(key, query.parameters, expected)
+        else:
+            assert rendered == expected
+    assert cache.stats().hits == 2
+
+
+def test_value_dependent_output_is_not_templated():
+    cache = QueryTemplateCache()
+    request = make_query({":p1": 3}, extra_filters=["orders.quantity > :p1"])
+    query = QueryInSchema.model_validate(request)
+    key = template_key(query)
+    assert key is not None and query.parameters
+    payload = json.loads(_generate_query_task(request, False))
+    assert not cache.store(key, query.parameters, payload)
+    assert cache.stats().value_dependent == 1
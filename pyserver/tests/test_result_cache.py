@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from result_cache import ENTRY_OVERHEAD_BYTES, ResultCache
+from studio_endpoints import CACHE_STATUS_HEADER, create_trilogy_router
+from task_pool import THREAD, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = ResultCache(max_bytes=10_000, ttl_seconds=10, clock=clock)
+    cache.put("k", b"{}")
+    assert cache.get("k") == b"{}"
+    clock.now = 10
+    assert cache.get("k") is None
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.expirations) == (1, 1, 1)
+    assert stats.size_bytes == 0
+
+
+def test_budget_evicts_least_recently_used():
+    body = b"x" * 100
+    entry_cost = 1 + len(body) + ENTRY_OVERHEAD_BYTES
+    cache = ResultCache(max_bytes=entry_cost * 4, ttl_seconds=60)
+    for key in "abcd":
+        assert cache.put(key, body)
+    cache.get("a")
+    cache.put("e", body)
+    assert cache.get("b") is None
+    assert cache.get("a") == body
+    stats = cache.stats()
+    assert stats.evictions == 1
+    assert stats.size_bytes == entry_cost * 4
+
+
+def test_oversized_and_disabled_entries_are_not_stored():
+    assert not ResultCache(max_bytes=1000).put("k", b"x" * 300)
+    assert not ResultCache(max_bytes=0).put("k", b"{}")
+
+
+def test_generate_query_reports_cache_status():
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=ResultCache(),
+        )
+    )
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    with TestClient(app) as client:
+        first = client.post("/generate_query", json=payload)
+        second = client.post("/generate_query", json=payload)
+        changed = client.post(
+            "/generate_query", json={**payload, "extra_filters": ["names.state = 'MA'"]}
+        )
+    assert first.status_code == 200
+    assert first.headers[CACHE_STATUS_HEADER] == "miss"
+    assert second.headers[CACHE_STATUS_HEADER] == "hit"
+    assert second.content == first.content
+    assert changed.headers[CACHE_STATUS_HEADER] == "miss"
+    assert changed.content != first.content
+
+
+def test_equivalent_requests_share_one_entry():
+    cache = ResultCache()
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            result_cache=cache,
+        )
+    )
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    headers = {"content-type": "application/json"}
+    with TestClient(app) as client:
+        first = client.post("/generate_query", json=payload)
+        reordered = client.post(
+            "/generate_query",
+            content=json.dumps(dict(reversed(payload.items())), indent=2),
+            headers=headers,
+        )
+    assert first.headers[CACHE_STATUS_HEADER] == "miss"
+    assert reordered.headers[CACHE_STATUS_HEADER] == "hit"
+    assert reordered.content == first.content
+    assert cache.stats().entries == 1
@@ -0,0 +1,158 @@
+import asyncio
+import json
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from io_models import QueryInSchema
+from single_flight import SingleFlight, canonical_payload_hash, request_key
+from studio_endpoints import create_trilogy_router
+from task_pool import THREAD, TaskPool, TaskPoolSettings
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+def test_canonical_payload_hash_ignores_key_order():
+    assert canonical_payload_hash({"a": 1, "b": [1, 2]}) == canonical_payload_hash(
+        {"b": [1, 2], "a": 1}
+    )
+    assert canonical_payload_hash({"a": 1}) != canonical_payload_hash({"a": 2})
+
+
+def test_request_key_covers_the_model_by_its_hash():
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    inline = QueryInSchema.model_validate(payload)
+    by_reference = QueryInSchema.model_validate(
+        {**{k: v for k, v in payload.items() if k != "full_model"}, "model_id": "m"}
+    )
+    key = request_key("generate_query", inline, "hash")
+    assert request_key("generate_query", by_reference, "hash") == key
+    assert request_key("generate_query", inline, "other") != key
+    assert request_key("generate_queries", inline, "hash") != key
+
+
+def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"sql": "select 1"}
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run("k", compute) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    stats = flight.stats()
+    assert (stats.leaders, stats.coalesced, stats.in_flight) == (1, 4, 0)
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad query")
+
+    async def scenario():
+        return await asyncio.gather(
+            *(flight.run("k", compute) for _ in range(3)), return_exceptions=True
+        )
+
+    assert all(isinstance(r, ValueError) for r in asyncio.run(scenario()))
+    asyncio.run(scenario())
+    assert flight.stats().leaders == 2
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def scenario():
+        leader = asyncio.create_task(flight.run("k", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.run("k", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(scenario()) == "done"
+
+
+def test_computation_is_cancelled_once_every_caller_is():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def compute():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def scenario():
+        callers = [asyncio.create_task(flight.run("k", compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert cancelled == [1]
+    assert flight.stats().in_flight == 0
+
+
+def test_identical_generate_requests_are_coalesced():
+    flight = SingleFlight()
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(
+            task_pool=TaskPool(TaskPoolSettings(default_mode=THREAD)),
+            single_flight=flight,
+        )
+    )
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    # the same request, written four ways
+    bodies = [
+        json.dumps(payload),
+        json.dumps(payload, indent=2),
+        json.dumps(dict(reversed(payload.items()))),
+        json.dumps(payload, separators=(",", ":")),
+    ]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    client.post(
+                        "/generate_query",
+                        content=body,
+                        headers={"content-type": "application/json"},
+                    )
+                    for body in bodies
+                )
+            )
+
+    responses = asyncio.run(scenario())
+    assert {response.status_code for response in responses} == {200}
+    assert len({response.text for response in responses}) == 1
+    assert flight.stats().leaders == 1
+    assert flight.stats().coalesced == 3
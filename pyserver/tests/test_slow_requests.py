@@ -0,0 +1,87 @@
+import json
+import threading
+from pathlib import Path
+
+from click.testing import CliRunner
+
+import studio_endpoints
+from main import cli
+from metrics import observe_phase, task_report
+from slow_requests import (
+    SlowRequestCapture,
+    SlowRequestSettings,
+    load_capture,
+    redact_request,
+    redact_text,
+)
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+def _capture(tmp_path: Path, threshold: float = 0.01, keep: int = 20):
+    return SlowRequestCapture(
+        SlowRequestSettings(
+            threshold_seconds=threshold,
+            directory=tmp_path,
+            keep=keep,
+            sample_seconds=0.001,
+        )
+    )
+
+
+def test_redaction_blanks_literals_and_comments_only():
+    text = "# Mary's query\nwhere name = 'Mary' and raw('''a\nb''') // x\n"
+    redacted = redact_text(text)
+    assert redacted == "#\nwhere name = 'xxxx' and raw('''x\nx''') //\n"
+    request = redact_request(
+        {"query": "select 'a';", "parameters": {"name": "Mary", "n": 3}}
+    )
+    assert request == {"query": "select 'x';", "parameters": {"name": "xxxx", "n": 0}}
+
+
+def test_late_tasks_are_sampled_and_the_ring_buffer_is_bounded(tmp_path):
+    capture = _capture(tmp_path, keep=2)
+
+    def slow_phase():
+        threading.Event().wait(0.05)
+
+    for index in range(3):
+        with (
+            task_report(),
+            capture.watch("generate_query", lambda index=index: {"n": index}),
+        ):
+            slow_phase()
+            observe_phase("parse", 0.05)
+        # a fast task is not captured
+        with capture.watch("generate_query", dict):
+            pass
+
+    captures = capture.captures()
+    assert [load_capture(path)["request"] for path in captures] == [
+        {"n": 1},
+        {"n": 2},
+    ]
+    saved = load_capture(captures[-1])
+    assert saved["phases"] == [["parse", 0.05]]
+    assert saved["profile"]["samples"] > 0
+    assert any("slow_phase" in stack for stack in saved["profile"]["stacks"])
+
+
+def test_captured_generate_query_replays_from_the_cli(tmp_path, monkeypatch):
+    capture = _capture(tmp_path, threshold=1e-9)
+    monkeypatch.setattr(studio_endpoints, "SLOW_REQUESTS", capture)
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    with task_report():
+        studio_endpoints._generate_query_task(payload, False)
+    [path] = capture.captures()
+    saved = load_capture(path)
+    assert saved["request"]["query"] == payload["query"]
+    assert "parse" in [name for name, _ in saved["phases"]]
+
+    result = CliRunner().invoke(cli, ["replay", str(path), "--limit", "5"])
+    assert result.exit_code == 0, result.output
+    assert "Status: 200" in result.output
+    assert "parse" in result.output
+    assert "function calls" in result.output
@@ -0,0 +1,487 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from cancellation import (
+    CancelToken,
+    TaskCancelled,
+    cancellation_scope,
+    check_cancelled,
+)
+from env_cache import model_cache_key
+from io_models import ModelSourceInSchema
+from result_cache import ResultCache
+from studio_endpoints import (
+    _drilldown_query_task,
+    _gather_or_cancel,
+    _unless_disconnected,
+    create_trilogy_router,
+    multi_query_chunks,
+)
+from task_pool import (
+    INLINE,
+    PROCESS,
+    THREAD,
+    ConsistentHashRing,
+    TaskPool,
+    TaskPoolSettings,
+    TaskQueueFull,
+)
+
+
+def test_settings_from_env_resolves_endpoint_modes():
+    settings = TaskPoolSettings.from_env(
+        endpoint_defaults={"format_query": INLINE},
+        environ={
+            "TRILOGY_POOL_MODE": "thread",
+            "TRILOGY_POOL_MODE_PARSE_MODEL": "Process",
+            "TRILOGY_POOL_LIMIT_FORMAT_QUERY": "3",
+            "TRILOGY_PROCESS_POOL_SIZE": "3",
+            "TRILOGY_POOL_MAX_QUEUE": "7",
+            "TRILOGY_POOL_MAX_TASKS_PER_WORKER": "0",
+        },
+    )
+    assert settings.mode_for("generate_query") == THREAD
+    assert settings.mode_for("format_query") == INLINE
+    assert settings.mode_for("parse_model") == PROCESS
+    assert settings.endpoint_limits == {"format_query": 3}
+    assert settings.process_pool_size == 3
+    assert settings.max_queue_depth == 7
+    assert settings.max_tasks_per_worker == 0
+
+
+def test_process_mode_is_opt_in():
+    assert TaskPoolSettings.from_env(environ={}).mode_for("generate_query") == THREAD
+
+
+def test_settings_reject_unknown_mode():
+    with pytest.raises(ValueError, match="TRILOGY_POOL_MODE"):
+        TaskPoolSettings.from_env(environ={"TRILOGY_POOL_MODE": "fibers"})
+
+
+def test_inline_and_thread_modes_run_tasks():
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=THREAD, endpoint_modes={"fast": INLINE})
+    )
+    main_thread = threading.get_ident()
+    assert asyncio.run(pool.run("fast", threading.get_ident)) == main_thread
+    assert asyncio.run(pool.run("slow", threading.get_ident)) != main_thread
+    assert pool.stats().completed == 2
+
+
+def test_queue_depth_is_bounded():
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD, max_queue_depth=1))
+    release = threading.Event()
+
+    async def scenario():
+        first = asyncio.create_task(pool.run("slow", release.wait, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(TaskQueueFull):
+            await pool.run("slow", release.wait, 5)
+        release.set()
+        return await first
+
+    assert asyncio.run(scenario()) is True
+    stats = pool.stats()
+    assert stats.rejected == 1
+    assert stats.in_flight == 0
+
+
+def test_router_maps_full_queue_to_429():
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD, max_queue_depth=0))
+    app = FastAPI()
+    app.include_router(create_trilogy_router(task_pool=pool))
+    with TestClient(app) as client:
+        response = client.post("/parse_model", json={"name": "empty", "sources": []})
+    assert response.status_code == 429
+
+
+def test_client_disconnect_cancels_the_request_task(monkeypatch):
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD))
+    monkeypatch.setattr(
+        "studio_endpoints._generate_query_task",
+        lambda query, perf, model_key: spin_until_cancelled(30),
+    )
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(task_pool=pool, result_cache=ResultCache(max_bytes=0))
+    )
+    body = json.dumps(MULTI_QUERY | {"query": "SELECT 1 as x;"}).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/generate_query",
+        "raw_path": b"/generate_query",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent: list[dict] = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(0.2)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    start = time.monotonic()
+    asyncio.run(app(scope, receive, send))
+    assert time.monotonic() - start < 10
+    assert sent[0]["status"] == 499
+    stats = pool.stats()
+    assert (stats.cancelled, stats.in_flight) == (1, 0)
+
+
+def test_process_mode_recycles_workers():
+    pool = TaskPool(
+        TaskPoolSettings(
+            default_mode=PROCESS,
+            process_pool_size=1,
+            max_tasks_per_worker=1,
+            preload_modules=(),
+        )
+    )
+
+    async def scenario():
+        return [await pool.run("pid", os.getpid) for _ in range(2)]
+
+    try:
+        first, second = asyncio.run(scenario())
+    finally:
+        pool.shutdown()
+    assert os.getpid() not in (first, second)
+    assert first != second
+
+
+def test_hash_ring_is_stable_and_visits_every_worker():
+    ring = ConsistentHashRing(4)
+    keys = [f"model-{i}" for i in range(200)]
+    homes = [ring.candidates(key)[0] for key in keys]
+    assert sorted(ring.candidates("model-0")) == [0, 1, 2, 3]
+    assert set(homes) == {0, 1, 2, 3}
+    assert homes == [ConsistentHashRing(4).candidates(key)[0] for key in keys]
+
+    # growing the pool only moves keys onto the new worker
+    grown = [ConsistentHashRing(5).candidates(key)[0] for key in keys]
+    assert all(new in (old, 4) for old, new in zip(homes, grown))
+
+
+def test_affinity_routing_spills_when_home_worker_is_saturated():
+    pool = TaskPool(
+        TaskPoolSettings(
+            default_mode=PROCESS, process_pool_size=3, max_pending_per_worker=2
+        )
+    )
+    home, second, third = pool._ring.candidates("model-a")
+    assert [pool._route("model-a") for _ in range(2)] == [home, home]
+    assert pool._route("model-a") == second
+    assert pool._route(None) == third
+    stats = pool.stats()
+    assert stats.affinity_routed == 2
+    assert stats.spilled == 1
+    assert stats.worker_in_flight[home] == 2
+
+
+def test_affinity_routing_prefers_workers_with_the_model_warm():
+    pool = TaskPool(
+        TaskPoolSettings(
+            default_mode=PROCESS, process_pool_size=3, max_pending_per_worker=2
+        )
+    )
+    home, second, third = pool._ring.candidates("model-a")
+    pool._remember_warm(third, "model-a")
+    pool._remember_warm(home, "model-a")
+    assert pool.warm_workers("model-a") == 2
+    # the least-loaded warm worker, rather than the next one along the ring
+    assert [pool._route("model-a") for _ in range(4)] == [home, third, home, third]
+    assert pool._route("model-a") == second
+    assert pool.stats().spilled == 1
+
+
+def test_process_tasks_with_one_key_share_a_worker():
+    pool = TaskPool(
+        TaskPoolSettings(
+            default_mode=PROCESS,
+            process_pool_size=2,
+            max_tasks_per_worker=0,
+            preload_modules=(),
+        )
+    )
+
+    async def scenario():
+        return {
+            await pool.run("pid", os.getpid, affinity_key="model-a") for _ in range(3)
+        }
+
+    try:
+        assert len(asyncio.run(scenario())) == 1
+    finally:
+        pool.shutdown()
+
+
+def test_endpoint_limit_caps_concurrent_tasks():
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=THREAD, endpoint_limits={"format_query": 2})
+    )
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def task():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.02)
+        with lock:
+            running[0] -= 1
+
+    async def scenario():
+        await asyncio.gather(*(pool.run("format_query", task) for _ in range(6)))
+
+    asyncio.run(scenario())
+    assert peak[0] == 2
+    assert pool.stats().completed == 6
+
+
+def test_queue_depth_counts_tasks_not_yet_running():
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=THREAD, endpoint_limits={"format_query": 1})
+    )
+    started = threading.Event()
+    release = threading.Event()
+
+    def task():
+        started.set()
+        release.wait(5)
+
+    async def scenario():
+        runs = [asyncio.create_task(pool.run("format_query", task)) for _ in range(3)]
+        await asyncio.to_thread(started.wait, 5)
+        await asyncio.sleep(0.01)
+        stats = pool.stats()
+        release.set()
+        await asyncio.gather(*runs)
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert (stats.in_flight, stats.queue_depth) == (3, 2)
+    assert (pool.stats().in_flight, pool.stats().queue_depth) == (0, 0)
+
+
+def spin_until_cancelled(timeout: float) -> str:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        check_cancelled()
+        time.sleep(0.01)
+    return "finished"
+
+
+@pytest.mark.parametrize("mode", [THREAD, PROCESS])
+def test_cancelled_tasks_stop_at_their_next_check(mode):
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=mode, process_pool_size=1, preload_modules=())
+    )
+    token = CancelToken()
+
+    async def scenario():
+        task = asyncio.create_task(
+            pool.run("spin", spin_until_cancelled, 30, cancel=token)
+        )
+        await asyncio.sleep(0.2)
+        token.cancel()
+        with pytest.raises(TaskCancelled):
+            await task
+        # the flag slot is released, and later tasks run to completion
+        return await pool.run("spin", spin_until_cancelled, 0, cancel=CancelToken())
+
+    start = time.monotonic()
+    try:
+        assert asyncio.run(scenario()) == "finished"
+    finally:
+        pool.shutdown()
+    assert time.monotonic() - start < 10
+    assert pool.stats().completed == 1
+
+
+def test_cancelling_the_caller_stops_the_task_and_values_the_saving():
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD))
+
+    async def scenario():
+        await pool.run("spin", spin_until_cancelled, 0.3)
+        waiting = asyncio.create_task(pool.run("spin", spin_until_cancelled, 30))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        # the thread has stopped by the time the caller sees the cancel
+        return pool.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats.completed, stats.cancelled, stats.in_flight) == (1, 1, 0)
+    assert 0.1 < stats.cancelled_seconds_saved < 0.3
+
+
+def test_cancelling_the_handler_cancels_the_pooled_task():
+    pool = TaskPool(TaskPoolSettings(default_mode=THREAD))
+    token = CancelToken()
+
+    async def receive():
+        # the client stays connected
+        await asyncio.sleep(60)
+
+    async def scenario():
+        request = Request({"type": "http", "method": "POST", "headers": []}, receive)
+        work = pool.run("spin", spin_until_cancelled, 30, cancel=token)
+        handler = asyncio.create_task(_unless_disconnected(request, work))
+        await asyncio.sleep(0.1)
+        handler.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await handler
+
+    start = time.monotonic()
+    asyncio.run(scenario())
+    assert token.cancelled
+    assert time.monotonic() - start < 5
+    assert pool.stats().cancelled == 1
+
+
+def test_task_cancelled_before_it_starts_never_runs():
+    pool = TaskPool(TaskPoolSettings(default_mode=INLINE))
+    token = CancelToken()
+    token.cancel()
+    ran = []
+    with pytest.raises(TaskCancelled):
+        asyncio.run(pool.run("fast", ran.append, 1, cancel=token))
+    assert ran == []
+
+
+def test_drilldown_stops_at_its_checkpoints():
+    token = CancelToken()
+    token.cancel()
+    request = {
+        "imports": [{"name": "test", "alias": ""}],
+        "query": "select name;",
+        "dialect": "duckdb",
+        "drilldown_remove": "name",
+        "drilldown_add": ["last_name"],
+        "drilldown_filter": "local.name='bob'",
+        "full_model": {
+            "name": "",
+            "sources": [
+                {
+                    "alias": "test",
+                    "contents": "key id int;\nproperty id.name string;\n"
+                    "property id.last_name string;",
+                }
+            ],
+        },
+    }
+    with cancellation_scope(token), pytest.raises(TaskCancelled):
+        _drilldown_query_task(request)
+
+
+MULTI_QUERY = {
+    "imports": [{"name": "flight", "alias": "flight"}],
+    "dialect": "duckdb",
+    "full_model": {
+        "name": "",
+        "sources": [
+            {
+                "alias": "flight",
+                "contents": """key id int;
+property id.distance int;
+datasource flight (id, distance) grain (id) address flight;""",
+            }
+        ],
+    },
+    "queries": [
+        {"query": "SELECT count(flight.id) as flights;", "label": "count"},
+        {"query": "SELECT sum(flight.distance) as total;", "label": "total"},
+        {"query": "SELECT flight.id, flight.distance;", "label": "rows"},
+        {"query": "SELECT nope;", "label": "broken"},
+        {"query": "SELECT max(flight.distance) as longest;", "label": "longest"},
+    ],
+}
+
+
+def test_multi_query_chunks_cover_every_index():
+    assert multi_query_chunks(5, 2) == [[0, 2, 4], [1, 3]]
+    assert multi_query_chunks(1, 4) == [[0]]
+
+
+def test_process_fan_out_matches_single_task_output():
+    def client_for(pool):
+        app = FastAPI()
+        app.include_router(
+            create_trilogy_router(task_pool=pool, result_cache=ResultCache(max_bytes=0))
+        )
+        return TestClient(app)
+
+    def generate(client):
+        response = client.post("/generate_queries", json=MULTI_QUERY)
+        assert response.status_code == 200
+        return response.json()
+
+    with client_for(TaskPool(TaskPoolSettings(default_mode=INLINE))) as client:
+        single = generate(client)
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=PROCESS, process_pool_size=2, preload_modules=())
+    )
+    model_key = model_cache_key(
+        [
+            ModelSourceInSchema.model_validate(source)
+            for source in MULTI_QUERY["full_model"]["sources"]
+        ]
+    )
+    with client_for(pool) as client:
+        # a cold model runs as one task, so only one worker parses it
+        cold = generate(client)
+        assert pool.stats().completed == 1
+        assert pool.warm_workers(model_key) == 1
+        # once the model is cached on both workers, the request is split
+        for slot in range(2):
+            pool._remember_warm(slot, model_key)
+        fanned = generate(client)
+        assert pool.stats().completed == 3
+
+    assert cold["queries"] == single["queries"]
+    assert fanned["queries"] == single["queries"]
+    assert [q["label"] for q in fanned["queries"]] == [
+        q["label"] for q in MULTI_QUERY["queries"]
+    ]
+    assert len(fanned["timings_ms"]) == len(MULTI_QUERY["queries"])
+
+
+def test_a_failed_chunk_cancels_its_siblings():
+    cancelled = []
+
+    async def fails():
+        raise ValueError("broken chunk")
+
+    async def runs_on():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await _gather_or_cancel([runs_on(), fails()])
+
+    asyncio.run(scenario())
+    assert cancelled == [True]
@@ -0,0 +1,144 @@
+import json
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from opentelemetry import trace
+
+from metrics import task_report
+from result_cache import ResultCache
+from studio_endpoints import create_trilogy_router
+from task_pool import PROCESS, TaskPool, TaskPoolSettings
+from tracing import (
+    JsonLinesExporter,
+    OpenTelemetryExporter,
+    configure_tracing,
+    phase,
+    span,
+)
+
+PAYLOAD_FILE = (
+    Path(__file__).parent.parent / "scripts" / "payloads" / "small_names.json"
+)
+
+
+@pytest.fixture
+def traced():
+    exported: list = []
+
+    class Collect:
+        def export(self, spans):
+            exported.append(spans)
+
+    configure_tracing(exporters=[Collect()])
+    try:
+        yield exported
+    finally:
+        configure_tracing(exporters=[])
+
+
+def test_disabled_spans_are_one_shared_no_op():
+    configure_tracing(exporters=[])
+    first = span("parse", query_chars=10)
+    assert first is span("compile")
+    assert not first.recording
+    with task_report() as report, first as opened, phase("parse"):
+        opened.set(statement_count=1)
+    assert report.spans == []
+    assert [name for name, _ in report.phases] == ["parse"]
+
+
+def test_a_trace_is_exported_whole_once_its_root_ends(traced):
+    with span("request", query_chars=12) as root:
+        with phase("parse") as parse:
+            parse.set(statement_count=2)
+        assert traced == []
+    [spans] = traced
+    assert [span.name for span in spans] == ["parse", "request"]
+    assert spans[0].parent_id == root.span_id
+    assert {span.trace_id for span in spans} == {root.trace_id}
+    assert spans[0].attributes == {"statement_count": 2}
+
+
+def test_worker_spans_join_the_pool_task_span(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    configure_tracing(exporters=[JsonLinesExporter(path)])
+    payload = json.loads(PAYLOAD_FILE.read_text())
+    pool = TaskPool(
+        TaskPoolSettings(default_mode=PROCESS, process_pool_size=1, preload_modules=())
+    )
+    app = FastAPI()
+    app.include_router(
+        create_trilogy_router(task_pool=pool, result_cache=ResultCache(max_bytes=0))
+    )
+    try:
+        with TestClient(app) as client:
+            assert client.post("/generate_query", json=payload).status_code == 200
+    finally:
+        pool.shutdown()
+        configure_tracing(exporters=[])
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    by_id = {record["span_id"]: record for record in records}
+    [root] = [record for record in records if record["parent_id"] is None]
+    assert root["name"] == "generate_query"
+    assert root["attributes"]["process"] == "worker-0"
+    assert {record["trace_id"] for record in records} == {root["trace_id"]}
+    names = {record["name"]: record for record in records}
+    for name in ("env_setup", "imports", "fork", "parse", "generation", "compile"):
+        record = names[name]
+        while record["parent_id"] is not None:
+            record = by_id[record["parent_id"]]
+        assert record is root, name
+    assert names["parse"]["attributes"]["query_chars"] == len(payload["query"])
+    assert names["env_setup"]["attributes"]["concept_count"] > 0
+    assert names["compile"]["attributes"]["sql_chars"] > 0
+
+
+class _RecordingTracer(trace.Tracer):
+    def __init__(self):
+        self.started: list[tuple[str, object, int]] = []
+        self.ended: dict[str, int] = {}
+
+    def start_span(self, name, context=None, *args, start_time=None, **kwargs):
+        parent = trace.get_current_span(context).get_span_context()
+        self.started.append((name, parent.span_id, start_time))
+        tracer = self
+
+        class Recorded(trace.NonRecordingSpan):
+            def end(self, end_time=None):
+                tracer.ended[name] = end_time
+
+        return Recorded(
+            trace.SpanContext(trace_id=1, span_id=len(self.started), is_remote=False)
+        )
+
+    def start_as_current_span(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+class _RecordingProvider(trace.TracerProvider):
+    def __init__(self):
+        self.tracer = _RecordingTracer()
+
+    def get_tracer(self, *args, **kwargs):
+        return self.tracer
+
+
+def test_otel_export_replays_the_tree_with_original_times(traced):
+    provider = _RecordingProvider()
+    with span("request") as root, span("parse"):
+        pass
+    OpenTelemetryExporter(provider).export(traced[0])
+
+    started = provider.tracer.started
+    # parents first, each child pointing at its replayed parent
+    assert [(name, parent) for name, parent, _ in started] == [
+        ("request", 0),
+        ("parse", 1),
+    ]
+    assert started[0][2] == int(root.start_time * 1e9)
+    assert provider.tracer.ended["request"] == int(root.start_time * 1e9) + int(
+        root.duration * 1e9
+    )
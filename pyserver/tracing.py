@@ -0,0 +1,366 @@
+"""Span-based tracing for the request pipeline.
+
+`span(name, **attributes)` times the block it wraps, and spans opened inside
+it become its children. Attributes can also be added as the block learns
+them:
+
+    with span("parse", query_chars=len(query)) as parse:
+        statements = ...
+        parse.set(statement_count=len(statements))
+
+`phase(...)` is a span that also feeds `trilogy_phase_seconds` (see
+`metrics`), so it times its block whether or not tracing is on.
+
+With tracing off, `span` returns one shared object whose methods do nothing,
+so a span costs a function call and a global lookup. Attributes that are not
+cheap to compute should be set only `if span.recording`.
+
+A trace is exported once its root span ends, so an exporter always sees the
+whole tree. The spans a pooled task opens are carried back with its result
+and joined to the pool's span for the task, whether the task ran inline, in
+a thread or in a worker process.
+
+`configure_tracing` takes a comma-separated list of exporters, as found in
+`TRILOGY_TRACE`:
+
+- `jsonl`: append each span as a JSON object to `TRILOGY_TRACE_FILE`
+  (default `trilogy-trace.jsonl`), one per line
+- `otel`: hand spans to OpenTelemetry. Uses the tracer provider the process
+  already installed, if any; otherwise, when `opentelemetry-sdk` and the OTLP
+  HTTP exporter are installed, sends them to the collector at
+  `OTEL_EXPORTER_OTLP_ENDPOINT` (default `http://localhost:4318`)
+- `log`: log a one-line breakdown of each trace to `trilogy.performance`
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+from contextvars import ContextVar, Token
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Protocol
+
+from metrics import current_report, observe_phase
+from utility import safe_percentage
+
+logger = getLogger(__name__)
+perf_logger = getLogger("trilogy.performance")
+
+DEFAULT_TRACE_FILE = "trilogy-trace.jsonl"
+OTEL_SERVICE_NAME = "trilogy-studio"
+
+# True while any exporter is configured; set in worker processes by the pool
+_enabled = False
+
+_current_span: ContextVar["Span | None"] = ContextVar("trilogy_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "_reset",
+        "_started",
+        "attributes",
+        "duration",
+        "name",
+        "parent_id",
+        "phase",
+        "span_id",
+        "start_time",
+        "trace_id",
+    )
+
+    recording = True
+
+    def __init__(self, name: str, attributes: dict[str, Any], phase: bool = False):
+        self.name = name
+        self.attributes = attributes
+        self.phase = phase
+        self.span_id = random.getrandbits(64)
+        self.trace_id = 0
+        self.parent_id: int | None = None
+        # wall-clock seconds since the epoch, comparable across processes
+        self.start_time = 0.0
+        self.duration = 0.0
+        self._reset: Token | None = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is None:
+            self.trace_id = random.getrandbits(128)
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        self._reset = _current_span.set(self)
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.duration = time.perf_counter() - self._started
+        if self._reset is not None:
+            _current_span.reset(self._reset)
+            # a context token does not pickle, and a worker's spans have to
+            self._reset = None
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        elif self.phase:
+            observe_phase(self.name, self.duration)
+        TRACER.finish(self)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    recording = False
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class _PhaseTimer(_NoopSpan):
+    """A phase with tracing off: timed for the metrics, and nothing else."""
+
+    __slots__ = ("_started", "name")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            observe_phase(self.name, time.perf_counter() - self._started)
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attributes: Any) -> Span | _NoopSpan:
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def phase(name: str, **attributes: Any) -> Span | _NoopSpan:
+    """A span named after a `trilogy_phase_seconds` phase."""
+    if not _enabled:
+        return _PhaseTimer(name)
+    return Span(name, attributes, phase=True)
+
+
+def tracing_enabled() -> bool:
+    return _enabled
+
+
+def set_tracing_enabled(enabled: bool) -> None:
+    """Turn span recording on or off without touching the exporters; worker
+    processes record spans but leave exporting to the server."""
+    global _enabled
+    _enabled = enabled
+
+
+def span_record(span: Span) -> dict[str, Any]:
+    return {
+        "trace_id": f"{span.trace_id:032x}",
+        "span_id": f"{span.span_id:016x}",
+        "parent_id": None if span.parent_id is None else f"{span.parent_id:016x}",
+        "name": span.name,
+        "start_time": span.start_time,
+        "duration": span.duration,
+        "attributes": span.attributes,
+    }
+
+
+class SpanExporter(Protocol):
+    def export(self, spans: list[Span]) -> None:
+        """Export one finished trace, its spans in the order they ended."""
+
+
+class JsonLinesExporter:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[Span]) -> None:
+        lines = "".join(json.dumps(span_record(span)) + "\n" for span in spans)
+        # one append per trace, so processes sharing the file do not
+        # interleave within a trace
+        with self._lock, self.path.open("a", encoding="utf-8") as file:
+            file.write(lines)
+
+
+class LogExporter:
+    def export(self, spans: list[Span]) -> None:
+        root = spans[-1]
+        parts = [
+            f"{span.name}: {span.duration:.4f}s "
+            f"({safe_percentage(span.duration, root.duration):.1f}%)"
+            for span in sorted(spans[:-1], key=lambda span: span.start_time)
+        ]
+        attributes = " ".join(
+            f"{key}={value}" for key, value in root.attributes.items()
+        )
+        perf_logger.info(
+            "Trace %s - Total: %.4fs | %s | %s",
+            root.name,
+            root.duration,
+            " | ".join(parts),
+            attributes,
+        )
+
+
+class OpenTelemetryExporter:
+    """Replays each finished trace through an OpenTelemetry tracer, keeping
+    the original start and end times."""
+
+    def __init__(self, tracer_provider=None):
+        from opentelemetry import trace
+
+        self._trace = trace
+        self._tracer = trace.get_tracer(
+            OTEL_SERVICE_NAME, tracer_provider=tracer_provider
+        )
+
+    def export(self, spans: list[Span]) -> None:
+        ids = {span.span_id for span in spans}
+        children: dict[int | None, list[Span]] = defaultdict(list)
+        for span in spans:
+            children[span.parent_id if span.parent_id in ids else None].append(span)
+        self._replay(children, None, None)
+
+    def _replay(self, children, parent_id: int | None, context) -> None:
+        # a parent has to be started before its children can point at it
+        for span in children.get(parent_id, ()):
+            start = int(span.start_time * 1e9)
+            replayed = self._tracer.start_span(
+                span.name,
+                context=context,
+                attributes=span.attributes,
+                start_time=start,
+            )
+            if "error" in span.attributes:
+                replayed.set_status(self._trace.StatusCode.ERROR)
+            self._replay(
+                children, span.span_id, self._trace.set_span_in_context(replayed)
+            )
+            replayed.end(end_time=start + int(span.duration * 1e9))
+
+
+def _otel_exporter() -> OpenTelemetryExporter:
+    from opentelemetry import trace
+
+    if not isinstance(trace.get_tracer_provider(), trace.ProxyTracerProvider):
+        # e.g. under `opentelemetry-instrument`
+        return OpenTelemetryExporter()
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning(
+            "TRILOGY_TRACE=otel without opentelemetry-sdk and "
+            "opentelemetry-exporter-otlp-proto-http; spans go to the global "
+            "tracer provider only"
+        )
+        return OpenTelemetryExporter()
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": OTEL_SERVICE_NAME})
+    )
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    return OpenTelemetryExporter(provider)
+
+
+def exporters_from_setting(setting: str) -> list[SpanExporter]:
+    exporters: list[SpanExporter] = []
+    for name in filter(None, (part.strip().lower() for part in setting.split(","))):
+        if name == "jsonl":
+            exporters.append(
+                JsonLinesExporter(
+                    os.environ.get("TRILOGY_TRACE_FILE", DEFAULT_TRACE_FILE)
+                )
+            )
+        elif name == "otel":
+            exporters.append(_otel_exporter())
+        elif name == "log":
+            exporters.append(LogExporter())
+        else:
+            raise ValueError(
+                f"TRILOGY_TRACE exporters are jsonl, otel and log; got '{name}'"
+            )
+    return exporters
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.exporters: list[SpanExporter] = []
+        self._lock = threading.Lock()
+        # trace id -> its finished spans, until the root span ends
+        self._pending: dict[int, list[Span]] = {}
+
+    def finish(self, span: Span) -> None:
+        report = current_report()
+        if report is not None:
+            # the pool joins the task's spans to its own once the task returns
+            report.spans.append(span)
+            return
+        if span.parent_id is not None:
+            with self._lock:
+                self._pending.setdefault(span.trace_id, []).append(span)
+            return
+        with self._lock:
+            spans = self._pending.pop(span.trace_id, [])
+        spans.append(span)
+        self.export(spans)
+
+    def adopt(self, spans: Iterable[Span], parent: Span) -> None:
+        """Make `spans`, recorded by a task, part of `parent`'s trace."""
+        adopted = []
+        for span in spans:
+            span.trace_id = parent.trace_id
+            if span.parent_id is None:
+                span.parent_id = parent.span_id
+            adopted.append(span)
+        with self._lock:
+            self._pending.setdefault(parent.trace_id, []).extend(adopted)
+
+    def export(self, spans: list[Span]) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception:
+                # a broken exporter must not fail the request it traced
+                logger.exception("Exporting a trace to %r failed", exporter)
+
+
+TRACER = Tracer()
+
+
+def configure_tracing(
+    setting: str | None = None, exporters: list[SpanExporter] | None = None
+) -> None:
+    """Export spans to `exporters`, or to those named by `setting` (default
+    `TRILOGY_TRACE`). No exporters turns tracing off."""
+    if exporters is None:
+        exporters = exporters_from_setting(
+            os.environ.get("TRILOGY_TRACE", "") if setting is None else setting
+        )
+    TRACER.exporters = exporters
+    set_tracing_enabled(bool(exporters))